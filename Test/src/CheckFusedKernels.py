@@ -0,0 +1,333 @@
+"""
+This script compares the fused numba kernels with the scipy and numpy references they replace.
+A random neighbor file is generated in a temporary folder in the same format as
+partial_correlation_matrix.h5. Then the following paths are checked:
+
+    1. The symmetric distance matrix in csr from load_distance_matrix and get_symmetric_distance_csr
+       against (M + M^T) / 2 + |M - M^T| / 2 with scipy sparse matrices.
+    2. The symmetric normalized laplacian matrix from convert_to_laplacian_matrix and get_laplacian_csr
+       against I - D^(-1/2) W D^(-1/2) with scipy sparse matrices.
+    3. The heap merges update_top_k, merge_top_k, update_top_k_rows and merge_candidates against
+       a sort of all the candidates.
+    4. find_tau with the histogram of the distances against the density curve of all the distances.
+    5. A calculation resumed from a checkpoint against the uninterrupted calculation.
+
+The script prints the result of each check and exits with 1 if any check fails.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+import h5py as h5
+import scipy.sparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../.."))
+
+from pDiffusionMap import util
+from pDiffusionMap import Graph
+
+# Parse the parameters
+parser = argparse.ArgumentParser()
+parser.add_argument('--pattern_number', default=2000, type=int, help="The number of random patterns.")
+parser.add_argument('--pattern_length', default=64, type=int, help="The length of each random pattern.")
+parser.add_argument('--neighbor_number', default=20, type=int, help="The number of neighbors in the file.")
+parser.add_argument('--tau', default=0.5, type=float, help="The tau of the laplacian matrix.")
+parser.add_argument('--seed', default=0, type=int, help="The seed of the random patterns.")
+parser.add_argument('--tolerance', default=1e-12, type=float, help="The tolerance of the comparisons.")
+
+args = parser.parse_args()
+pattern_number = args.pattern_number
+neighbor_number = args.neighbor_number
+tolerance = args.tolerance
+rng = np.random.RandomState(args.seed)
+
+failures = []
+
+
+def report(name, passed, detail=""):
+    """
+    Print the result of a check and remember the failures.
+    :param name: The name of the check.
+    :param passed: Whether the check passed.
+    :param detail: Additional information to print.
+    :return: None
+    """
+    print("{:<60} {} {}".format(name, "PASS" if passed else "FAIL", detail))
+    if not passed:
+        failures.append(name)
+
+
+def compare_sparse(name, matrix, reference):
+    """
+    Compare two sparse matrices entry by entry.
+    :param name: The name of the check.
+    :param matrix: The sparse matrix from the fused kernels.
+    :param reference: The sparse matrix from the scipy reference.
+    :return: None
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    reference = scipy.sparse.csr_matrix(reference)
+    error = abs(matrix - reference).max() if matrix.shape == reference.shape else np.inf
+    report(name, error <= tolerance, "max error {:.3e}".format(error))
+
+
+def reference_symmetric_distance(values, idx_dim1, matrix_shape, keep_diagonal):
+    """
+    The symmetric distance matrix with temporary scipy sparse matrices.
+    """
+    idx_dim0 = np.repeat(np.arange(values.shape[0]), values.shape[1])
+    matrix = scipy.sparse.coo_matrix((values.reshape(-1), (idx_dim0, idx_dim1.reshape(-1))),
+                                     shape=tuple(matrix_shape))
+    matrix_trans = matrix.transpose(copy=True)
+    matrix_sym = (matrix + matrix_trans) / 2.
+    matrix_asym = (matrix - matrix_trans) / 2.
+    np.absolute(matrix_asym.data, out=matrix_asym.data)
+    matrix_sym += matrix_asym
+    if not keep_diagonal:
+        matrix_sym.setdiag(values=0, k=0)
+    return scipy.sparse.csr_matrix(matrix_sym)
+
+
+def reference_laplacian(distance_matrix, tau):
+    """
+    The symmetric normalized laplacian matrix with temporary scipy sparse matrices.
+    """
+    weight_matrix = scipy.sparse.coo_matrix(distance_matrix, copy=True)
+    np.exp(-weight_matrix.data / tau, out=weight_matrix.data)
+    degree = Graph.inverse_sqrt_degree_mat(weight_matrix=weight_matrix)
+    return Graph.get_symmetric_normalized_laplacian(degree_matrix=degree, weight_matrix=weight_matrix)
+
+
+def reference_top_k(val_holder, idx_holder, values, indexes, skip_duplicates):
+    """
+    Keep the largest values among the holder and the candidates of each row by sorting them.
+    """
+    val_out = np.empty_like(val_holder)
+    idx_out = np.empty_like(idx_holder)
+    for l in range(val_holder.shape[0]):
+        val_row = np.concatenate([val_holder[l], values[l]])
+        idx_row = np.concatenate([idx_holder[l], indexes[l]])
+        if skip_duplicates:
+            # The first appearance of each index is kept since the holder comes first.
+            _, first = np.unique(idx_row, return_index=True)
+            keep = np.zeros(idx_row.shape[0], dtype=bool)
+            keep[first] = True
+            keep[:val_holder.shape[1]] = True
+            val_row, idx_row = val_row[keep], idx_row[keep]
+        order = np.argsort(-val_row, kind='stable')[:val_holder.shape[1]]
+        val_out[l] = val_row[order]
+        idx_out[l] = idx_row[order]
+    return val_out, idx_out
+
+
+def reference_find_tau(mat_data, log_eps_min=-10.0, log_eps_max=10.0, search_num=20):
+    """
+    Find tau from the density curve of all the distances.
+    """
+    eps = np.exp(np.linspace(log_eps_min, log_eps_max, num=search_num))
+    density = np.zeros(search_num)
+    for i, e in enumerate(eps):
+        density[i] = np.log(np.sum(np.exp(-mat_data / e)) + 1e-10)
+    normlized_density = density - np.min(density)
+    normlized_density /= np.max(normlized_density)
+    return eps[np.argmax(np.gradient(normlized_density))]
+
+
+"""
+Step One: Generate a neighbor file
+"""
+# Random patterns in a few clusters so that the neighbors are not uniform
+centers = rng.randn(8, args.pattern_length)
+patterns = centers[rng.randint(0, 8, size=pattern_number)] + 0.5 * rng.randn(pattern_number, args.pattern_length)
+patterns -= np.mean(patterns, axis=1, keepdims=True)
+patterns /= np.std(patterns, axis=1, keepdims=True)
+similarity = patterns.dot(patterns.T) / args.pattern_length
+
+# The nearest neighbors with the largest values first
+order = np.argsort(-similarity, axis=1)[:, :neighbor_number]
+neighbor_values = np.take_along_axis(similarity, order, axis=1)
+# The values in the file are distances, and they do not have to be symmetric.
+neighbor_values = 1. - neighbor_values + 0.01 * rng.rand(pattern_number, neighbor_number)
+neighbor_index = order.astype(np.int64)
+matrix_shape = np.array([pattern_number, pattern_number], dtype=np.int64)
+
+output_folder = tempfile.mkdtemp()
+correlation_matrix_file = output_folder + "/partial_correlation_matrix.h5"
+with h5.File(correlation_matrix_file, 'w') as h5file:
+    h5file.create_dataset('values', data=neighbor_values, dtype=np.float64)
+    h5file.create_dataset('index_dim1', data=neighbor_index, dtype=np.int64)
+    h5file.create_dataset('matrix_shape', data=matrix_shape, dtype=np.int64)
+
+try:
+    """
+    Step Two: The symmetric distance matrix and the laplacian matrix
+    """
+    for keep_diagonal in [False, True]:
+        reference = reference_symmetric_distance(neighbor_values, neighbor_index, matrix_shape, keep_diagonal)
+
+        distance_matrix, _ = util.load_distance_matrix(correlation_matrix_file=correlation_matrix_file,
+                                                       neighbor_number=neighbor_number,
+                                                       keep_diagonal=keep_diagonal)
+        compare_sparse("load_distance_matrix keep_diagonal={}".format(keep_diagonal),
+                       distance_matrix, reference)
+
+        matrix = util.get_symmetric_distance_matrix_from_neighbors(values=neighbor_values,
+                                                                   index_dim1=neighbor_index,
+                                                                   neighbor_number=neighbor_number // 2,
+                                                                   matrix_shape=matrix_shape,
+                                                                   keep_diagonal=keep_diagonal)
+        compare_sparse("get_symmetric_distance_matrix_from_neighbors keep_diagonal={}".format(keep_diagonal),
+                       matrix, reference_symmetric_distance(neighbor_values[:, :neighbor_number // 2],
+                                                            neighbor_index[:, :neighbor_number // 2],
+                                                            matrix_shape, keep_diagonal))
+
+        # The rows of one process. The transposed entries belonging to the rows come from all the rows.
+        start, end = pattern_number // 3, 2 * pattern_number // 3
+        idx_dim0 = np.repeat(np.arange(pattern_number, dtype=np.int64), neighbor_number)
+        belong = (neighbor_index.reshape(-1) >= start) & (neighbor_index.reshape(-1) < end)
+        rows = util.get_symmetric_distance_csr(values=np.array(neighbor_values[start:end]),
+                                               index_dim1=np.array(neighbor_index[start:end]),
+                                               rows_trans=neighbor_index.reshape(-1)[belong],
+                                               cols_trans=idx_dim0[belong],
+                                               values_trans=neighbor_values.reshape(-1)[belong],
+                                               row_range=(start, end),
+                                               column_num=pattern_number,
+                                               keep_diagonal=keep_diagonal)
+        compare_sparse("get_symmetric_distance_csr rows keep_diagonal={}".format(keep_diagonal),
+                       rows, reference[start:end])
+
+        laplacian_reference = reference_laplacian(reference, args.tau)
+        laplacian = util.convert_to_laplacian_matrix(laplacian_type="symmetric normalized laplacian",
+                                                     distance_matrix=distance_matrix,
+                                                     tau=args.tau)
+        compare_sparse("convert_to_laplacian_matrix keep_diagonal={}".format(keep_diagonal),
+                       laplacian, laplacian_reference)
+
+        # The rows of one process with the degrees of all the rows
+        weight = scipy.sparse.csr_matrix(reference, copy=True)
+        np.exp(-weight.data / args.tau, out=weight.data)
+        inv_sqrt_degree = 1. / np.sqrt(np.asarray(weight.sum(axis=1)).reshape(-1))
+        rows.data = np.exp(-rows.data / args.tau)
+        rows.sort_indices()
+        compare_sparse("get_laplacian_csr rows keep_diagonal={}".format(keep_diagonal),
+                       util.get_laplacian_csr(weight_matrix=rows, row_start=start, inv_sqrt_degree=inv_sqrt_degree),
+                       laplacian_reference.tocsr()[start:end])
+
+    """
+    Step Three: The heap merges
+    """
+    holder_size = np.array([pattern_number, neighbor_number], dtype=np.int64)
+    block_start, block_end = pattern_number // 4, pattern_number // 2
+    block = similarity[:, block_start:block_end]
+
+    for dtype in [np.float64, np.float32]:
+        val_to_keep = np.ascontiguousarray(-np.sort(-similarity[:, :neighbor_number], axis=1))
+        idx_to_keep_dim1 = np.ascontiguousarray(np.argsort(-similarity[:, :neighbor_number], axis=1))
+        val_reference, idx_reference = reference_top_k(
+            val_to_keep, idx_to_keep_dim1, block.astype(dtype).astype(np.float64),
+            np.tile(np.arange(block_start, block_end), (pattern_number, 1)), skip_duplicates=False)
+        Graph.update_top_k(np.ascontiguousarray(block, dtype=dtype), block_start, idx_to_keep_dim1, val_to_keep,
+                           holder_size)
+        report("update_top_k {}".format(np.dtype(dtype).name),
+               np.array_equal(idx_to_keep_dim1, idx_reference) and np.array_equal(val_to_keep, val_reference))
+
+    # Candidates with explicit indexes, some of which are among the nearest neighbors already
+    candidate_index = rng.randint(0, pattern_number, size=(pattern_number, 3 * neighbor_number)).astype(np.int64)
+    candidate_value = np.take_along_axis(similarity, candidate_index, axis=1)
+    initial_index = np.ascontiguousarray(np.argsort(-similarity, axis=1)[:, 2 * neighbor_number:3 * neighbor_number])
+    initial_value = np.ascontiguousarray(np.take_along_axis(similarity, initial_index, axis=1))
+
+    val_to_keep, idx_to_keep_dim1 = initial_value.copy(), initial_index.copy()
+    val_reference, idx_reference = reference_top_k(val_to_keep, idx_to_keep_dim1, candidate_value, candidate_index,
+                                                   skip_duplicates=False)
+    Graph.merge_top_k(candidate_value, candidate_index, idx_to_keep_dim1, val_to_keep, holder_size)
+    report("merge_top_k", np.array_equal(idx_to_keep_dim1, idx_reference) and
+           np.array_equal(val_to_keep, val_reference))
+
+    val_to_keep, idx_to_keep_dim1 = initial_value.copy(), initial_index.copy()
+    rows = rng.permutation(pattern_number)[:pattern_number // 2].astype(np.int64)
+    cols = rng.permutation(pattern_number)[:neighbor_number].astype(np.int64)
+    matrix = np.ascontiguousarray(similarity[np.ix_(rows, cols)])
+    val_reference, idx_reference = val_to_keep.copy(), idx_to_keep_dim1.copy()
+    val_reference[rows], idx_reference[rows] = reference_top_k(val_to_keep[rows], idx_to_keep_dim1[rows], matrix,
+                                                               np.tile(cols, (rows.shape[0], 1)),
+                                                               skip_duplicates=True)
+    Graph.update_top_k_rows(matrix, rows, cols, idx_to_keep_dim1, val_to_keep, holder_size)
+    report("update_top_k_rows", np.array_equal(idx_to_keep_dim1, idx_reference) and
+           np.array_equal(val_to_keep, val_reference))
+
+    val_to_keep, idx_to_keep_dim1 = initial_value.copy(), initial_index.copy()
+    val_reference, idx_reference = reference_top_k(val_to_keep, idx_to_keep_dim1, candidate_value, candidate_index,
+                                                   skip_duplicates=True)
+    offsets = np.arange(pattern_number + 1, dtype=np.int64) * candidate_index.shape[1]
+    update_num = np.zeros(pattern_number, dtype=np.int64)
+    Graph.merge_candidates(offsets, candidate_index.reshape(-1), candidate_value.reshape(-1),
+                           idx_to_keep_dim1, val_to_keep, update_num, holder_size)
+    report("merge_candidates", np.array_equal(idx_to_keep_dim1, idx_reference) and
+           np.array_equal(val_to_keep, val_reference))
+
+    """
+    Step Four: find_tau with the histogram of the distances
+    """
+    mat_data = distance_matrix.data[distance_matrix.data > 0]
+    tau_reference = reference_find_tau(mat_data)
+    tau_exact = util.find_tau(mat_data=mat_data, exact_number=mat_data.size)
+    report("find_tau without histogram", tau_exact == tau_reference,
+           "tau {} reference {}".format(tau_exact, tau_reference))
+    tau = util.find_tau(mat_data=mat_data, exact_number=256, bin_num=256, sample_number=mat_data.size // 4)
+    report("find_tau with histogram", tau == tau_reference, "tau {} reference {}".format(tau, tau_reference))
+
+    """
+    Step Five: Resume from a checkpoint
+    """
+    checkpoint_prefix = output_folder + "/checkpoint_rank_0"
+    signature = np.array([pattern_number, neighbor_number, args.seed], dtype=np.int64)
+    batch_ends = np.linspace(0, pattern_number, num=9).astype(np.int64)
+
+    def run_batches(start_batch, val_to_keep, idx_to_keep_dim1, stop_batch=None):
+        """
+        Merge the batches of columns into the holders and save a checkpoint after each batch.
+        """
+        for batch_idx in range(start_batch, batch_ends.shape[0] - 1 if stop_batch is None else stop_batch):
+            Graph.update_top_k(np.ascontiguousarray(similarity[:, batch_ends[batch_idx]:batch_ends[batch_idx + 1]]),
+                               batch_ends[batch_idx], idx_to_keep_dim1, val_to_keep, holder_size)
+            util.save_checkpoint(checkpoint_prefix=checkpoint_prefix, progress=batch_idx + 1, signature=signature,
+                                 idx_to_keep_dim1=idx_to_keep_dim1, val_to_keep=val_to_keep)
+
+    val_uninterrupted = (-2e+100) * np.ones((pattern_number, neighbor_number), dtype=np.float64)
+    idx_uninterrupted = np.zeros((pattern_number, neighbor_number), dtype=np.int64)
+    run_batches(0, val_uninterrupted, idx_uninterrupted)
+    util.remove_checkpoints(checkpoint_prefix=checkpoint_prefix)
+
+    # Interrupt after five batches
+    val_to_keep = (-2e+100) * np.ones((pattern_number, neighbor_number), dtype=np.float64)
+    idx_to_keep_dim1 = np.zeros((pattern_number, neighbor_number), dtype=np.int64)
+    run_batches(0, val_to_keep, idx_to_keep_dim1, stop_batch=5)
+    checkpoints = util.load_checkpoints(checkpoint_prefix=checkpoint_prefix, signature=signature)
+    report("load_checkpoints generations", [int(x["progress"]) for x in checkpoints] == [5, 4])
+
+    # Resume from the previous generation as if the latest one was damaged
+    val_to_keep = np.array(checkpoints[1]["val_to_keep"])
+    idx_to_keep_dim1 = np.array(checkpoints[1]["idx_to_keep_dim1"])
+    run_batches(int(checkpoints[1]["progress"]), val_to_keep, idx_to_keep_dim1)
+    report("resume from checkpoint", np.array_equal(idx_to_keep_dim1, idx_uninterrupted) and
+           np.array_equal(val_to_keep, val_uninterrupted))
+
+    try:
+        util.load_checkpoints(checkpoint_prefix=checkpoint_prefix, signature=signature + 1)
+        report("load_checkpoints with another signature", False)
+    except Exception:
+        report("load_checkpoints with another signature", True)
+    util.remove_checkpoints(checkpoint_prefix=checkpoint_prefix)
+
+finally:
+    shutil.rmtree(output_folder)
+
+if failures:
+    print("{} checks failed.".format(len(failures)))
+    sys.exit(1)
+print("All checks passed.")
@@ -21,6 +21,74 @@ CONFIGURATIONS = {
     "neighbor_number_similarity_matrix": int(1000),
     "zeros_mean_shift": True,  # shift the pattern so that the mean is 0.
     "normalize_by_std": True,  # normalize the pattern so that the standard deviation is 1
+    # Only calculate one of each pair of mirror tiles (i, j) and (j, i) of the symmetric similarity
+    # matrix. When this is True, batch_num_dim1 is ignored and the batches along dimension 1 are
+    # the same as those along dimension 0.
+    "symmetric_tiling": bool(False),
+    # When this is True, rank 0 hands out the tiles to the workers on demand instead of giving each
+    # worker one fixed batch along dimension 0. Faster workers then process more tiles.
+    "task_queue": bool(False),
+    # Batch number along dimension 0 in the task queue mode. Without the task queue, this is comm_size - 1.
+    "batch_num_dim0": int(1),
+    # Load the next batch along dimension 1 in a background thread while the current one is processed.
+    # This holds two batches along dimension 1 in memory at the same time.
+    "prefetch": bool(False),
+    # The number of h5 data files each process keeps open, and the total chunk cache of these files in
+    # bytes. Each file gets h5_chunk_cache_total_nbytes // h5_file_pool_size bytes, i.e. the 1MB default
+    # of h5py. A chunk of the datasets, e.g. one pattern, larger than this share is never cached. In this
+    # case, raise the total or reduce the number of files.
+    "h5_file_pool_size": int(64),
+    "h5_chunk_cache_total_nbytes": int(64 * 1024 ** 2),
+    # The number of threads to read the files of a batch with. h5py serializes the calls to the HDF5
+    # library, so more than one thread only helps on file systems with a high latency.
+    "h5_read_thread_num": int(1),
+    # A node-local folder, e.g. /tmp, to hold a cache of all the masked patterns. The processes on the
+    # same node share the cache so the h5 files are only read once per node. Leave empty to read the
+    # h5 files directly. The cache is removed at the end of the calculation.
+    "pattern_cache_folder": str(""),
+    "pattern_cache_dtype": str("float64"),  # The dtype of the patterns in the cache.
+    # The dtype to calculate the inner product matrix with. With float32, the candidates close to the
+    # boundary of the nearest neighbors are checked again in float64 so that the neighbors stay accurate.
+    "compute_dtype": str("float32"),
+    # The float32 value of a candidate within recheck_tolerance * (upper bound of the value) of the
+    # smallest kept value is calculated again in float64. None derives it from the number of unmasked
+    # pixels, or the projection dimension, with abbr.get_recheck_tolerance.
+    "recheck_tolerance": None,
+    # Standardize each masked pattern once when it is loaded or cached so that each tile is a plain
+    # inner product. This requires zeros_mean_shift and normalize_by_std to be True. The inner product is
+    # then divided by the number of unmasked pixels to give the Pearson correlation. When this is False,
+    # it is divided by the total number of pixels as in the original flow.
+    "standardize_on_load": bool(False),
+    # Project the standardized patterns to projection_dimension dimensions before the similarity is
+    # calculated. "" keeps the full patterns. "gaussian" uses a random Gaussian matrix. "randomized_svd"
+    # fits the leading singular vectors of the dataset with two extra passes through the dataset.
+    # This requires standardize_on_load to be True for WeightMat.py.
+    "projection_method": str(""),
+    "projection_dimension": int(256),
+    "projection_seed": int(0),
+    # A folder to save the checkpoints of the nearest neighbors in. Leave empty to disable the checkpoints.
+    # A checkpoint is saved after every checkpoint_interval batches along dimension 1, rounds of the
+    # symmetric tiling or finished tiles of the task queue. The checkpoints are removed at the end.
+    "checkpoint_folder": str(""),
+    "checkpoint_interval": int(1),
+    # Continue the calculation from the checkpoints in checkpoint_folder. The configuration and the
+    # number of processes have to be the same as those of the interrupted calculation.
+    "resume": bool(False),
+
+    ###############################################################################################
+    # Specify parameters to calculate the similarity matrix approximately with WeightMatApprox.py
+    ###############################################################################################
+    # Stop improving the nearest neighbors once the recall measured against the exact nearest neighbors
+    # of a random sample of patterns reaches this value.
+    "approximate_recall_target": float(0.95),
+    "approximate_recall_sample_number": int(1000),  # The number of patterns to measure the recall with.
+    "approximate_tree_number": int(8),  # The number of random projection trees for the initial neighbors.
+    # The maximal number of patterns in each leaf. This is at least twice the number of nearest neighbors.
+    "approximate_leaf_size": int(200),
+    # The number of nearest neighbors and reverse neighbors to follow in the nearest neighbor descent.
+    "approximate_sample_number": int(15),
+    "approximate_max_iteration": int(10),  # The maximal number of iterations of the nearest neighbor descent.
+    "approximate_seed": int(0),  # The seed of the random projections and of the recall sample.
 
 
     ###############################################################################################
@@ -31,6 +99,22 @@ CONFIGURATIONS = {
     # The neighbor to use when one convert the similarity matrix into the Laplacian matrix
     "neighbor_number_Laplacian_matrix": int(1000),
     "eig_num": int(10),  # The number of (eigenvector, eigenvalue) pairs to compute.
+    # The solver of EigensScipy.py which runs in a single process without MPI, PETSc and SLEPc.
+    # "arpack" uses the Lanczos method of scipy.sparse.linalg.eigsh. "lobpcg" uses scipy.sparse.linalg.lobpcg.
+    "eigensolver": str("arpack"),
+    "eigensolver_tolerance": float(1e-8),  # The relative tolerance of the eigenvalues in EigensScipy.py.
+    "eigensolver_max_iteration": int(10000),  # The maximal number of iterations in EigensScipy.py.
+    # The eigensystem_*.h5 file of a previous calculation, e.g. with another tau or neighbor number. The
+    # eigensolver starts from its eigenvectors instead of random vectors. Leave empty to start from scratch.
+    "initial_eigensystem_file": str(""),
+    # A folder to keep the symmetrized distance matrix in. The next calculation with the same neighbor number
+    # loads it instead of reading and symmetrizing partial_correlation_matrix.h5 again. Leave empty to disable.
+    "distance_cache_folder": str(""),
+    # EigensSweep.py loads the nearest neighbors once and solves the eigensystem for each pair of a neighbor
+    # number in sweep_neighbor_number_list and a tau in sweep_tau_list. A tau can also be "auto". The results
+    # are recorded in output_folder/sweep_index.csv.
+    "sweep_neighbor_number_list": [int(100), int(1000)],
+    "sweep_tau_list": [float(0.5), float(1.0)],
 
     # tau: The similarity matrix in the program is essentially the Pearson correlation coefficient
     #        This value can be negative which is not valid for a similarity matrix. Therefore one
@@ -78,6 +162,81 @@ def check():
     if not (type(config["neighbor_number_similarity_matrix"]) is int):
         raise Exception("neighbor_number_similarity_matrix has to be an integer.")
 
+    if not (type(config["symmetric_tiling"]) is bool):
+        raise Exception("symmetric_tiling has to be a boolean value.")
+
+    if not (type(config["task_queue"]) is bool):
+        raise Exception("task_queue has to be a boolean value.")
+
+    if not (type(config["batch_num_dim0"]) is int):
+        raise Exception("batch_num_dim0 has to be an integer.")
+
+    if not (type(config["prefetch"]) is bool):
+        raise Exception("prefetch has to be a boolean value.")
+
+    if not (type(config["h5_file_pool_size"]) is int and config["h5_file_pool_size"] > 0):
+        raise Exception("h5_file_pool_size has to be a positive integer.")
+
+    if not (type(config["h5_chunk_cache_total_nbytes"]) is int and config["h5_chunk_cache_total_nbytes"] >= 0):
+        raise Exception("h5_chunk_cache_total_nbytes has to be a non-negative integer.")
+
+    if not (type(config["h5_read_thread_num"]) is int and config["h5_read_thread_num"] > 0):
+        raise Exception("h5_read_thread_num has to be a positive integer.")
+
+    if not (type(config["pattern_cache_folder"]) is str):
+        raise Exception("pattern_cache_folder has to be a python string.")
+
+    if not (config["pattern_cache_dtype"] in ["float32", "float64"]):
+        raise Exception("pattern_cache_dtype has to be either \"float32\" or \"float64\".")
+
+    if not (config["compute_dtype"] in ["float32", "float64"]):
+        raise Exception("compute_dtype has to be either \"float32\" or \"float64\".")
+
+    if not (config["recheck_tolerance"] is None or type(config["recheck_tolerance"]) is float):
+        raise Exception("recheck_tolerance has to be None or a float value.")
+
+    if not (type(config["standardize_on_load"]) is bool):
+        raise Exception("standardize_on_load has to be a boolean value.")
+
+    if not (config["projection_method"] in ["", "gaussian", "randomized_svd"]):
+        raise Exception("projection_method has to be \"\", \"gaussian\" or \"randomized_svd\".")
+
+    if not (type(config["projection_dimension"]) is int):
+        raise Exception("projection_dimension has to be an integer.")
+
+    if not (type(config["projection_seed"]) is int):
+        raise Exception("projection_seed has to be an integer.")
+
+    if not (type(config["checkpoint_folder"]) is str):
+        raise Exception("checkpoint_folder has to be a python string.")
+
+    if not (type(config["checkpoint_interval"]) is int):
+        raise Exception("checkpoint_interval has to be an integer.")
+
+    if not (type(config["resume"]) is bool):
+        raise Exception("resume has to be a boolean value.")
+
+    if not (type(config["approximate_recall_target"]) is float):
+        raise Exception("approximate_recall_target has to be a float value.")
+
+    if not (type(config["approximate_recall_sample_number"]) is int):
+        raise Exception("approximate_recall_sample_number has to be an integer.")
+
+    if not (type(config["approximate_tree_number"]) is int):
+        raise Exception("approximate_tree_number has to be an integer.")
+
+    if not (type(config["approximate_leaf_size"]) is int):
+        raise Exception("approximate_leaf_size has to be an integer.")
+
+    if not (type(config["approximate_sample_number"]) is int):
+        raise Exception("approximate_sample_number has to be an integer.")
+
+    if not (type(config["approximate_max_iteration"]) is int):
+        raise Exception("approximate_max_iteration has to be an integer.")
+
+    if not (type(config["approximate_seed"]) is int):
+        raise Exception("approximate_seed has to be an integer.")
+
     if not (type(config["Laplacian_matrix"]) is str):
         raise Exception("Laplacian_matrix has to be a python string.")
 
@@ -87,6 +246,29 @@ def check():
     if not (type(config["eig_num"]) is int):
         raise Exception("eig_num has to be an integer.")
 
+    if not (config["eigensolver"] in ["arpack", "lobpcg"]):
+        raise Exception("eigensolver has to be either \"arpack\" or \"lobpcg\".")
+
+    if not (type(config["eigensolver_tolerance"]) is float):
+        raise Exception("eigensolver_tolerance has to be a float value.")
+
+    if not (type(config["eigensolver_max_iteration"]) is int):
+        raise Exception("eigensolver_max_iteration has to be an integer.")
+
+    if not (type(config["initial_eigensystem_file"]) is str):
+        raise Exception("initial_eigensystem_file has to be a python string.")
+
+    if not (type(config["distance_cache_folder"]) is str):
+        raise Exception("distance_cache_folder has to be a python string.")
+
+    if not (type(config["sweep_neighbor_number_list"]) is list and
+            all(type(x) is int for x in config["sweep_neighbor_number_list"])):
+        raise Exception("sweep_neighbor_number_list has to be a list of integers.")
+
+    if not (type(config["sweep_tau_list"]) is list and
+            all(type(x) is float or x == "auto" for x in config["sweep_tau_list"])):
+        raise Exception("sweep_tau_list has to be a list of float values or \"auto\".")
+
     if not (type(config["tau"]) is float):
         raise Exception("tau has to be a float value.")
 
@@ -96,3 +278,19 @@ def check():
     if config["neighbor_number_Laplacian_matrix"] > config["neighbor_number_similarity_matrix"]:
         raise Exception("neighbor_number_Laplacian_matrix can not be " +
                         "larger than neighbor_number_similarity_matrix.")
+
+    if max(config["sweep_neighbor_number_list"], default=0) > config["neighbor_number_similarity_matrix"]:
+        raise Exception("The neighbor numbers in sweep_neighbor_number_list can not be " +
+                        "larger than neighbor_number_similarity_matrix.")
+
+    if config["standardize_on_load"] and not (config["zeros_mean_shift"] and config["normalize_by_std"]):
+        raise Exception("standardize_on_load requires both zeros_mean_shift and normalize_by_std to be True.")
+
+    if config["resume"] and not config["checkpoint_folder"]:
+        raise Exception("resume requires checkpoint_folder to be specified.")
+
+    if config["checkpoint_interval"] < 1:
+        raise Exception("checkpoint_interval has to be at least 1.")
+
+    if not (0. < config["approximate_recall_target"] <= 1.):
+        raise Exception("approximate_recall_target has to be in (0, 1].")
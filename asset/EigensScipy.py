@@ -0,0 +1,122 @@
+import sys
+
+sys.path.append("/reg/neh/home/haoyuan/Documents/my_repos/DiffusionMap")
+
+import time, numpy
+import h5py
+from pDiffusionMap import util
+
+try:
+    import Config
+except ImportError:
+    raise Exception("This package use Config.py file to set parameters. "
+                    "Please use the start_a_new_project.py "
+                    "script to get a folder \'proj_***\'. Move "
+                    "this folder to a desirable address and modify"
+                    "the Config.py file in"
+                    " the folder \'proj_***/pDiffusionMap\' and "
+                    "execute DiffusionMap calculation"
+                    "in this folder.")
+# Check if the configuration information is valid
+Config.check()
+
+# Parse
+neighbor_number = Config.CONFIGURATIONS["neighbor_number_Laplacian_matrix"]
+eig_num = Config.CONFIGURATIONS["eig_num"]
+output_folder = Config.CONFIGURATIONS["output_folder"]
+laplacian_type = Config.CONFIGURATIONS['Laplacian_matrix']
+solver = Config.CONFIGURATIONS["eigensolver"]
+tolerance = Config.CONFIGURATIONS["eigensolver_tolerance"]
+max_iteration = Config.CONFIGURATIONS["eigensolver_max_iteration"]
+initial_eigensystem_file = Config.CONFIGURATIONS["initial_eigensystem_file"]
+distance_cache_folder = Config.CONFIGURATIONS["distance_cache_folder"]
+
+# Get the tau value
+if Config.CONFIGURATIONS["tau"] == "auto":
+    auto_tau = True
+else:
+    auto_tau = False
+
+"""
+Step One: Load the partial weight matrix and construct the Laplacian matrix
+"""
+print("Begin loading the data", flush=True)
+tic = time.time()
+correlation_matrix_file = str(output_folder + "/partial_correlation_matrix.h5")
+
+# Load the symmetrized matrix from the cache of a previous calculation if possible.
+matrix = None
+if distance_cache_folder:
+    with h5py.File(correlation_matrix_file, 'r') as h5file:
+        mat_size = numpy.array(h5file['matrix_shape'])
+    cache_prefix = distance_cache_folder + "/distance_matrix"
+    cache_signature = util.get_distance_matrix_cache_signature(correlation_matrix_file=correlation_matrix_file,
+                                                               neighbor_number=neighbor_number,
+                                                               keep_diagonal=False,
+                                                               row_range=(0, mat_size[0]))
+    matrix = util.load_distance_matrix_cache(cache_prefix=cache_prefix, signature=cache_signature)
+
+if matrix is None:
+    matrix, mat_size = util.load_distance_matrix(correlation_matrix_file=correlation_matrix_file,
+                                                 neighbor_number=neighbor_number,
+                                                 symmetric=True,
+                                                 keep_diagonal=False)
+    if distance_cache_folder:
+        util.save_distance_matrix_cache(cache_prefix=cache_prefix, matrix=matrix, signature=cache_signature)
+
+# Get tau
+if auto_tau:
+    tau = util.find_tau(mat_data=matrix.data,
+                        target_value=0.5,
+                        log_eps_min=-10.0,
+                        log_eps_max=10.0,
+                        search_num=200)
+else:
+    tau = float(Config.CONFIGURATIONS["tau"])
+
+# Get the laplacian matrix
+csr_matrix = util.convert_to_laplacian_matrix(laplacian_type=laplacian_type,
+                                              distance_matrix=matrix,
+                                              tau=tau)
+del matrix
+
+"""
+Step Two: Solve for the eigenvalues and eigenvectors
+"""
+# Start from the eigenvectors of a previous calculation
+initial_vectors = None
+if initial_eigensystem_file:
+    initial_vectors = util.load_initial_eigenvectors(eigensystem_file=initial_eigensystem_file,
+                                                     matrix_size=csr_matrix.shape[0])
+
+print("Begin solving the eigensystem with {}".format(solver), flush=True)
+vals, eigenvectors = util.solve_laplacian_eigensystem(laplacian_matrix=csr_matrix,
+                                                      eig_num=eig_num,
+                                                      solver=solver,
+                                                      tol=tolerance,
+                                                      max_iteration=max_iteration,
+                                                      initial_vectors=initial_vectors)
+del initial_vectors
+
+"""
+Step Three: Inspect the result
+"""
+print("")
+print("        k          ||Ax-kx||/||kx|| ")
+print("----------------- ------------------")
+for i in range(eig_num):
+    error = (numpy.linalg.norm(csr_matrix.dot(eigenvectors[i]) - vals[i] * eigenvectors[i]) /
+             numpy.linalg.norm(vals[i] * eigenvectors[i]))
+    print(" %12f       %12g" % (vals[i], error))
+print("")
+
+# Save the result
+util.save_eigensystem_and_calculation_parameters(eigenvalues=vals,
+                                                 eigenvectors=eigenvectors,
+                                                 tau=tau,
+                                                 config=Config.CONFIGURATIONS)
+
+# Finishes everything.
+print("Finishes all calculation.", flush=True)
+toc = time.time()
+print("The total calculation time is {}".format(toc - tic), flush=True)
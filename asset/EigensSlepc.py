@@ -3,6 +3,7 @@ import sys
 sys.path.append("/reg/neh/home/haoyuan/Documents/my_repos/DiffusionMap")
 
 import time, numpy
+import h5py
 from pDiffusionMap import util
 from petsc4py import PETSc
 from slepc4py import SLEPc
@@ -27,6 +28,8 @@ neighbor_number = Config.CONFIGURATIONS["neighbor_number_Laplacian_matrix"]
 eig_num = Config.CONFIGURATIONS["eig_num"]
 output_folder = Config.CONFIGURATIONS["output_folder"]
 laplacian_type = Config.CONFIGURATIONS['Laplacian_matrix']
+initial_eigensystem_file = Config.CONFIGURATIONS["initial_eigensystem_file"]
+distance_cache_folder = Config.CONFIGURATIONS["distance_cache_folder"]
 
 # Get the tau value
 if Config.CONFIGURATIONS["tau"] == "auto":
@@ -40,51 +43,16 @@ comm_rank = comm.Get_rank()
 comm_size = comm.Get_size()
 
 """
-Step One: Load the partial weight matrix and construct the Laplacian matrix
+Step One: Load the rows of the partial weight matrix owned by each process and construct the Laplacian matrix
 """
 print("Begin loading the data", flush=True)
 tic = time.time()
+correlation_matrix_file = str(output_folder + "/partial_correlation_matrix.h5")
 
-# The node 0 handle all the data IO first and
-# then pass the data to the other nodes.
-if comm_rank == 0:
-    matrix, mat_size = util.load_distance_matrix(
-        correlation_matrix_file=str(output_folder +
-                                    "/partial_correlation_matrix.h5"),
-        neighbor_number=neighbor_number,
-        symmetric=True,
-        keep_diagonal=False)
-
-    # TODO: Later, I'll add these parameters to the configuration file
-    # The Node 0 calculate the optimal sigma and the matrix to solve
-
-    # Get tau
-    if auto_tau:
-        tau = util.find_tau(mat_data=matrix.data,
-                            target_value=0.5,
-                            log_eps_min=-10.0,
-                            log_eps_max=10.0,
-                            search_num=200)
-
-    else:
-        tau = float(Config.CONFIGURATIONS["tau"])
-
-    # Get the laplacian matrix
-    csr_matrix = util.convert_to_laplacian_matrix(laplacian_type=laplacian_type,
-                                                  distance_matrix=matrix,
-                                                  tau=tau)
-
-else:
-    csr_matrix = None
-    mat_size = None
+# Let PETSc decide which rows each process owns.
+with h5py.File(correlation_matrix_file, 'r') as h5file:
+    mat_size = tuple(numpy.array(h5file['matrix_shape']))
 
-# Load the matrix
-csr_matrix = comm.bcast(obj=csr_matrix, root=0)
-mat_size = comm.bcast(obj=mat_size, root=0)
-comm.Barrier()  # Synchronize
-"""
-Step Two: Initialize the petsc matrix
-"""
 petsc_mat = PETSc.Mat()
 petsc_mat.create(PETSc.COMM_WORLD)
 
@@ -94,15 +62,63 @@ petsc_mat.setPreallocationNNZ(neighbor_number)
 petsc_mat.setUp()
 rstart, rend = petsc_mat.getOwnershipRange()
 print(rstart, rend)
+row_range_list = comm.allgather((rstart, rend))
+
+# Load the symmetrized rows from the cache of a previous calculation if possible.
+matrix = None
+if distance_cache_folder:
+    cache_prefix = distance_cache_folder + "/distance_matrix_rank_{}".format(comm_rank)
+    cache_signature = util.get_distance_matrix_cache_signature(correlation_matrix_file=correlation_matrix_file,
+                                                               neighbor_number=neighbor_number,
+                                                               keep_diagonal=False,
+                                                               row_range=(rstart, rend))
+    matrix = util.load_distance_matrix_cache(cache_prefix=cache_prefix, signature=cache_signature)
+
+# All the processes have to take part in the symmetrization if any of them misses the cache.
+if comm.allreduce(matrix is None, op=MPI.LOR):
+    # Each process loads its own rows and receives the transposed entries of its rows from the other processes.
+    values, index_dim1, mat_size = util.load_distance_matrix_rows(correlation_matrix_file=correlation_matrix_file,
+                                                                   neighbor_number=neighbor_number,
+                                                                   row_range=(rstart, rend))
+    matrix = util.get_symmetric_distance_matrix_rows(comm=comm,
+                                                     values=values,
+                                                     index_dim1=index_dim1,
+                                                     row_range_list=row_range_list,
+                                                     matrix_shape=mat_size,
+                                                     keep_diagonal=False)
+    del values, index_dim1
+
+    if distance_cache_folder:
+        util.save_distance_matrix_cache(cache_prefix=cache_prefix, matrix=matrix, signature=cache_signature)
+
+# Get tau
+if auto_tau:
+    tau = util.find_tau_parallel(comm=comm,
+                                 mat_data=matrix.data,
+                                 target_value=0.5,
+                                 log_eps_min=-10.0,
+                                 log_eps_max=10.0,
+                                 search_num=200)
 
-p1 = csr_matrix.indptr
-p2 = csr_matrix.indices
-p3 = csr_matrix.data
+else:
+    tau = float(Config.CONFIGURATIONS["tau"])
+
+# Get the rows of the laplacian matrix
+csr_matrix = util.convert_to_laplacian_matrix_rows(comm=comm,
+                                                   laplacian_type=laplacian_type,
+                                                   distance_matrix=matrix,
+                                                   row_range=(rstart, rend),
+                                                   tau=tau)
+del matrix
+comm.Barrier()  # Synchronize
 
+"""
+Step Two: Initialize the petsc matrix
+"""
 petsc_mat.createAIJ(size=mat_size,
-                    csr=(p1[rstart:rend + 1] - p1[rstart],
-                         p2[p1[rstart]:p1[rend]],
-                         p3[p1[rstart]:p1[rend]]))
+                    csr=(csr_matrix.indptr,
+                         csr_matrix.indices,
+                         csr_matrix.data))
 petsc_mat.assemble()
 
 """
@@ -117,6 +133,19 @@ E = SLEPc.EPS().create()
 E.setOperators(petsc_mat, None)
 E.setDimensions(nev=eig_num, ncv=PETSc.DECIDE)
 E.setProblemType(SLEPc.EPS.ProblemType.HEP)
+
+# Start from the eigenvectors of a previous calculation
+if initial_eigensystem_file:
+    initial_vectors = util.load_initial_eigenvectors(eigensystem_file=initial_eigensystem_file,
+                                                     matrix_size=mat_size[0],
+                                                     row_range=(rstart, rend))
+    initial_space = []
+    for local_vector in initial_vectors:
+        vector = petsc_mat.createVecRight()
+        vector.setArray(local_vector)
+        initial_space.append(vector)
+    E.setInitialSpace(initial_space)
+    del initial_vectors
 E.setFromOptions()
 
 # Solve the eigensystem
@@ -0,0 +1,109 @@
+import sys
+
+sys.path.append("/reg/neh/home/haoyuan/Documents/my_repos/DiffusionMap")
+
+import time, numpy
+import h5py
+import scipy.sparse
+from pDiffusionMap import util
+
+try:
+    import Config
+except ImportError:
+    raise Exception("This package use Config.py file to set parameters. "
+                    "Please use the start_a_new_project.py "
+                    "script to get a folder \'proj_***\'. Move "
+                    "this folder to a desirable address and modify"
+                    "the Config.py file in"
+                    " the folder \'proj_***/pDiffusionMap\' and "
+                    "execute DiffusionMap calculation"
+                    "in this folder.")
+# Check if the configuration information is valid
+Config.check()
+
+# Parse
+eig_num = Config.CONFIGURATIONS["eig_num"]
+output_folder = Config.CONFIGURATIONS["output_folder"]
+laplacian_type = Config.CONFIGURATIONS['Laplacian_matrix']
+solver = Config.CONFIGURATIONS["eigensolver"]
+tolerance = Config.CONFIGURATIONS["eigensolver_tolerance"]
+max_iteration = Config.CONFIGURATIONS["eigensolver_max_iteration"]
+neighbor_number_list = Config.CONFIGURATIONS["sweep_neighbor_number_list"]
+tau_list = Config.CONFIGURATIONS["sweep_tau_list"]
+
+"""
+Step One: Load the nearest neighbors once with the largest neighbor number
+"""
+print("Begin loading the data", flush=True)
+tic = time.time()
+correlation_matrix_file = str(output_folder + "/partial_correlation_matrix.h5")
+index_file = str(output_folder + "/sweep_index.csv")
+
+with h5py.File(correlation_matrix_file, 'r') as h5file:
+    row_num = int(numpy.array(h5file['matrix_shape'])[0])
+
+values, index_dim1, mat_size = util.load_distance_matrix_rows(correlation_matrix_file=correlation_matrix_file,
+                                                               neighbor_number=max(neighbor_number_list),
+                                                               row_range=(0, row_num))
+
+"""
+Step Two: Solve the eigensystem for each pair of parameters
+"""
+# Each solve starts from the eigenvectors of the previous one.
+initial_vectors = None
+calculation_idx = 0
+
+for neighbor_number in neighbor_number_list:
+
+    # Symmetrize the distance matrix once for all the tau values
+    matrix = util.get_symmetric_distance_matrix_from_neighbors(values=values,
+                                                               index_dim1=index_dim1,
+                                                               neighbor_number=neighbor_number,
+                                                               matrix_shape=mat_size,
+                                                               keep_diagonal=False)
+
+    for tau in tau_list:
+        if tau == "auto":
+            tau = util.find_tau(mat_data=matrix.data,
+                                target_value=0.5,
+                                log_eps_min=-10.0,
+                                log_eps_max=10.0,
+                                search_num=200)
+
+        # The laplacian matrix shares the indices of the distance matrix and only copies the data.
+        csr_matrix = util.convert_to_laplacian_matrix(laplacian_type=laplacian_type,
+                                                      distance_matrix=scipy.sparse.csr_matrix(
+                                                          (matrix.data.copy(), matrix.indices, matrix.indptr),
+                                                          shape=matrix.shape),
+                                                      tau=tau)
+
+        vals, eigenvectors = util.solve_laplacian_eigensystem(laplacian_matrix=csr_matrix,
+                                                              eig_num=eig_num,
+                                                              solver=solver,
+                                                              tol=tolerance,
+                                                              max_iteration=max_iteration,
+                                                              initial_vectors=initial_vectors)
+        initial_vectors = eigenvectors
+        del csr_matrix
+
+        # Save the result and record the parameters in the index
+        eigensystem_file = util.save_eigensystem_and_calculation_parameters(eigenvalues=vals,
+                                                                            eigenvectors=eigenvectors,
+                                                                            tau=tau,
+                                                                            config=Config.CONFIGURATIONS,
+                                                                            neighbor_number=neighbor_number,
+                                                                            suffix="_{:0>3d}".format(calculation_idx))
+        util.append_to_sweep_index(index_file=index_file,
+                                   eigensystem_file=eigensystem_file,
+                                   neighbor_number=neighbor_number,
+                                   tau=tau)
+        calculation_idx += 1
+
+        print("neighbor_number={}, tau={:.6g}, eigenvalues={}".format(neighbor_number, tau, vals), flush=True)
+
+    del matrix
+
+# Finishes everything.
+print("Finishes all calculation.", flush=True)
+toc = time.time()
+print("The total calculation time is {}".format(toc - tic), flush=True)
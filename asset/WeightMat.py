@@ -1,7 +1,9 @@
 import sys
 sys.path.append("/reg/neh/home/haoyuan/Documents/my_repos/DiffusionMap")
 
+import os
 import time
+import datetime
 import numpy as np
 from pDiffusionMap import util, abbr, DataSource
 from mpi4py import MPI
@@ -23,7 +25,6 @@ Config.check()
 comm = MPI.COMM_WORLD
 comm_rank = comm.Get_rank()
 comm_size = comm.Get_size()
-batch_num_dim0 = comm_size - 1
 
 # Parse
 batch_num_dim1 = Config.CONFIGURATIONS["batch_num_dim1"]
@@ -32,6 +33,39 @@ output_folder = Config.CONFIGURATIONS["output_folder"]
 mask_file = Config.CONFIGURATIONS["mask_file"]
 zeros_mean_shift = Config.CONFIGURATIONS["zeros_mean_shift"]
 normalize_by_std = Config.CONFIGURATIONS["normalize_by_std"]
+symmetric_tiling = Config.CONFIGURATIONS["symmetric_tiling"]
+task_queue = Config.CONFIGURATIONS["task_queue"]
+prefetch = Config.CONFIGURATIONS["prefetch"]
+pattern_cache_folder = Config.CONFIGURATIONS["pattern_cache_folder"]
+pattern_cache_dtype = Config.CONFIGURATIONS["pattern_cache_dtype"]
+compute_dtype = np.dtype(Config.CONFIGURATIONS["compute_dtype"])
+recheck_tolerance = Config.CONFIGURATIONS["recheck_tolerance"]
+standardize_on_load = Config.CONFIGURATIONS["standardize_on_load"]
+projection_method = Config.CONFIGURATIONS["projection_method"]
+checkpoint_folder = Config.CONFIGURATIONS["checkpoint_folder"]
+checkpoint_interval = Config.CONFIGURATIONS["checkpoint_interval"]
+resume = Config.CONFIGURATIONS["resume"]
+
+# Keep the h5 data files open between the batches
+util.set_h5_file_pool(max_file_num=Config.CONFIGURATIONS["h5_file_pool_size"],
+                      total_rdcc_nbytes=Config.CONFIGURATIONS["h5_chunk_cache_total_nbytes"],
+                      read_thread_num=Config.CONFIGURATIONS["h5_read_thread_num"])
+
+if standardize_on_load:
+    # The patterns are standardized when they are loaded. Each tile is then a plain inner product.
+    zeros_mean_shift = False
+    normalize_by_std = False
+
+if task_queue:
+    # Rank 0 hands out the tiles on demand. The tiles are smaller than the share of each worker.
+    batch_num_dim0 = Config.CONFIGURATIONS["batch_num_dim0"]
+else:
+    # Each worker holds one batch along dimension 0.
+    batch_num_dim0 = comm_size - 1
+
+if symmetric_tiling:
+    # Use the same batches along both dimensions so that each tile has a mirror tile.
+    batch_num_dim1 = batch_num_dim0
 
 if Config.CONFIGURATIONS["keep_diagonal"]:
     neighbor_number = Config.CONFIGURATIONS["neighbor_number_similarity_matrix"]
@@ -41,6 +75,12 @@ else:
     # remove the diagonal value.
     neighbor_number = Config.CONFIGURATIONS["neighbor_number_similarity_matrix"] + 1
 
+if checkpoint_folder:
+    # Each process saves its own checkpoints.
+    checkpoint_prefix = checkpoint_folder + "/checkpoint_rank_{}".format(comm_rank)
+else:
+    checkpoint_prefix = None
+
 """
 Step One: Initialization
 """
@@ -64,112 +104,341 @@ print("Process {} receives the datasource."
 comm.Barrier()  # Synchronize
 
 """
-Step Two: Calculate mean and std
+Step One and a Quarter: Fit the projection of the standardized patterns
 """
+if projection_method:
+    if not standardize_on_load:
+        raise Exception("The projection requires standardize_on_load to be True.")
+
+    tic_local = time.time()
+    projection = abbr.fit_projection(comm=comm,
+                                     data_source=data_source,
+                                     data_shape=data_source.source_dict["shape"],
+                                     bool_mask_1d=util.get_bool_mask_1d(np.load(mask_file)),
+                                     method=projection_method,
+                                     dimension=Config.CONFIGURATIONS["projection_dimension"],
+                                     seed=Config.CONFIGURATIONS["projection_seed"])
+    toc_local = time.time()
+    print("Process {} spends {} seconds on fitting the projection.".format(comm_rank, toc_local - tic_local))
+else:
+    projection = None
+
+"""
+Step One and a Half: Build the node-local pattern cache
+"""
+if pattern_cache_folder:
+    # All the processes on the same node share one cache file. Each node has its own cache file even if
+    # pattern_cache_folder is shared between the nodes.
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    stamp = comm.bcast(datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d_%H_%M_%S'), root=0)
+    host_name = node_comm.bcast(MPI.Get_processor_name(), root=0)
+    cache_file = pattern_cache_folder + "/pattern_cache_{}_{}.npy".format(stamp, host_name)
+    stat_file = pattern_cache_folder + "/pattern_stat_{}_{}.npy".format(stamp, host_name)
+
+    tic_local = time.time()
+    pattern_cache, pattern_stat = abbr.build_pattern_cache(node_comm=node_comm,
+                                                           data_source=data_source,
+                                                           data_shape=data_source.source_dict["shape"],
+                                                           bool_mask_1d=util.get_bool_mask_1d(np.load(mask_file)),
+                                                           cache_file=cache_file,
+                                                           stat_file=stat_file,
+                                                           dtype=pattern_cache_dtype,
+                                                           standardize=standardize_on_load,
+                                                           projection=projection)
+    toc_local = time.time()
+    print("Process {} spends {} seconds on building the pattern cache.".format(comm_rank, toc_local - tic_local))
+else:
+    pattern_cache = None
+    pattern_stat = None
+
 # Global timer
 tic = time.time()
-if comm_rank != 0:
 
-    # Get the correct chunk size
-    data_shape = data_source.source_dict["shape"]
-    chunk_size = tuple([100, ] + list(data_shape))
-    data_num = data_source.batch_num_list_dim0[comm_rank - 1]
+# A checkpoint is only used to resume the same calculation.
+checkpoint_signature = np.array([comm_size, data_source.data_num_total, batch_num_dim0, batch_num_dim1,
+                                 neighbor_number, int(symmetric_tiling), int(task_queue)], dtype=np.int64)
 
-    # Construct the data for diagonal patch
-    info_holder_dim0 = data_source.batch_ends_local_dim0[comm_rank - 1]
+if task_queue:
+    """
+    Step Two to Four: Rank 0 hands out the tiles to the workers on demand and merges the results.
+    """
+    if comm_rank == 0:
+        values_all, idx_dim1_all, mean_all, std_all = abbr.task_queue_master(comm=comm,
+                                                                             data_source=data_source,
+                                                                             neighbor_number=neighbor_number,
+                                                                             symmetric_tiling=symmetric_tiling,
+                                                                             checkpoint_prefix=checkpoint_prefix,
+                                                                             checkpoint_interval=checkpoint_interval,
+                                                                             resume=resume,
+                                                                             signature=checkpoint_signature)
+        global_idx_range_dim0 = (0, data_source.data_num_total)
+    else:
+        abbr.task_queue_worker(comm=comm, data_source=data_source, mask_file=mask_file,
+                               neighbor_number=neighbor_number, symmetric_tiling=symmetric_tiling,
+                               zeros_mean_shift=zeros_mean_shift, normalize_by_std=normalize_by_std,
+                               pattern_cache=pattern_cache, dtype=compute_dtype,
+                               recheck_tolerance=recheck_tolerance, pattern_stat=pattern_stat,
+                               standardize=standardize_on_load, projection=projection)
+        # The workers do not hold any rows.
+        values_all, idx_dim1_all, mean_all, std_all, global_idx_range_dim0 = None, None, None, None, None
+    comm.Barrier()  # Synchronize
 
-    # Load data and calculate the mean and std
-    [dataset_dim0, data_mean_dim0,
-     data_std_dim0, bool_mask_1d, mask] = abbr.get_data_and_stat(batch_info=info_holder_dim0,
-                                                                 maskfile=mask_file,
-                                                                 data_num=data_num,
-                                                                 data_shape=data_shape)
+else:
+    """
+    Step Two: Calculate mean and std
+    """
+    if comm_rank != 0:
 
-    # Create a holder for all standard variations and means
-    std_all = np.empty(data_source.data_num_total, dtype=np.float64)
-    mean_all = np.empty(data_source.data_num_total, dtype=np.float64)
-    print("Process {} finishes the first stage.".format(comm_rank))
+        # Get the correct chunk size
+        data_shape = data_source.source_dict["shape"]
+        chunk_size = tuple([100, ] + list(data_shape))
+        data_num = data_source.batch_num_list_dim0[comm_rank - 1]
 
-else:
-    # Auxiliary variables.
-    data_std_dim0 = None
-    data_mean_dim0 = None
+        # Construct the data for diagonal patch
+        info_holder_dim0 = data_source.batch_ends_local_dim0[comm_rank - 1]
+        global_idx_range_dim0 = data_source.batch_global_idx_range_dim0[comm_rank - 1]
 
-# Let the master node to gather and assemble all the norms.
-std_data = comm.gather(data_std_dim0, root=0)
-mean_data = comm.gather(data_mean_dim0, root=0)
-comm.Barrier()  # Synchronize
+        # Load data and calculate the mean and std
+        [dataset_dim0, data_mean_dim0,
+         data_std_dim0, bool_mask_1d, mask] = abbr.get_data_and_stat(batch_info=info_holder_dim0,
+                                                                     maskfile=mask_file,
+                                                                     data_num=data_num,
+                                                                     data_shape=data_shape,
+                                                                     pattern_cache=pattern_cache,
+                                                                     global_idx_range=global_idx_range_dim0,
+                                                                     dtype=compute_dtype,
+                                                                     pattern_stat=pattern_stat,
+                                                                     standardize=standardize_on_load,
+                                                                     projection=projection)
 
-"""
-Step Three: The master node receive and organize all the norms
-"""
-if comm_rank == 0:
-    std_all = np.concatenate(std_data[1:], axis=0)
-    mean_all = np.concatenate(mean_data[1:], axis=0)
-    print("This is process {}, the shape of mean_all is {}".format(comm_rank, mean_all.shape))
+        # Create a holder for all standard variations and means
+        std_all = np.empty(data_source.data_num_total, dtype=np.float64)
+        mean_all = np.empty(data_source.data_num_total, dtype=np.float64)
+        print("Process {} finishes the first stage.".format(comm_rank))
 
-# Share this information to all worker nodes.
-comm.Bcast(std_all, root=0)
-comm.Bcast(mean_all, root=0)
-comm.Barrier()  # Synchronize
+    else:
+        # Auxiliary variables.
+        data_std_dim0 = None
+        data_mean_dim0 = None
 
-"""
-Step Four: Calculate the sparse weight matrix
-"""
-if comm_rank != 0:
-
-    # Create holders to store the largest values and the
-    #  corresponding indexes of the correlation matrix
-    holder_size = np.array([data_num, neighbor_number], dtype=np.int64)  # Auxiliary variable
-    idx_to_keep_dim1 = np.zeros((data_num, neighbor_number), dtype=np.int64)
-    val_to_keep = (-2e+100) * np.ones((data_num, neighbor_number), dtype=np.float64)
-
-    #  Loop through each rows.
-    for batch_idx_dim1 in range(batch_num_dim1):
-        print("Node {} begins to process batch {}.".format(comm_rank, batch_idx_dim1, ) +
-              " There are {} more batches to process.".format(batch_num_dim1 -
-                                                              batch_idx_dim1 - 1))
-
-        abbr.update_nearest_neighbors(data_source=data_source, dataset_dim0=dataset_dim0,
-                                      data_num=data_num, std_all=std_all, mean_all=mean_all,
-                                      neighbor_number=neighbor_number, data_shape=data_shape,
-                                      batch_idx_dim1=batch_idx_dim1, bool_mask_1d=bool_mask_1d,
-                                      data_std_dim0=data_std_dim0, data_mean_dim0=data_mean_dim0,
-                                      holder_size=holder_size, idx_to_keep_dim1=idx_to_keep_dim1,
-                                      val_to_keep=val_to_keep, normalize_by_std=normalize_by_std,
-                                      zeros_mean_shift=zeros_mean_shift)
+    """
+    Step Three: The master node receive and organize all the norms
+    """
+    if standardize_on_load:
+        # The tiles do not need the norms. Each worker saves the norms of its own rows in Step Five.
+        if comm_rank != 0:
+            # The standardized patterns have zero mean and unit standard deviation.
+            std_all = np.ones(data_source.data_num_total, dtype=np.float64)
+            mean_all = np.zeros(data_source.data_num_total, dtype=np.float64)
 
-else:
-    # Auxiliary variables.
-    idx_to_keep_dim1 = None
-    val_to_keep = None
-    idx_pre_dim1 = None
-
-# Let the master node to gather and assemble the matrix.
-index_to_keep_dim1_data = comm.gather(idx_to_keep_dim1, root=0)
-value_to_keep_data = comm.gather(val_to_keep, root=0)
-comm.Barrier()  # Synchronize
+    else:
+        # Let the master node to gather and assemble all the norms.
+        std_data = comm.gather(data_std_dim0, root=0)
+        mean_data = comm.gather(data_mean_dim0, root=0)
+        comm.Barrier()  # Synchronize
+
+        if comm_rank == 0:
+            std_all = np.concatenate(std_data[1:], axis=0)
+            mean_all = np.concatenate(mean_data[1:], axis=0)
+            print("This is process {}, the shape of mean_all is {}".format(comm_rank, mean_all.shape))
+
+        # Share this information to all worker nodes.
+        comm.Bcast(std_all, root=0)
+        comm.Bcast(mean_all, root=0)
+        comm.Barrier()  # Synchronize
+
+    """
+    Step Four: Calculate the sparse weight matrix
+    """
+    # The workers synchronize with each other before they save the checkpoints of the symmetric tiling.
+    worker_comm = comm.Split(color=int(comm_rank != 0), key=comm_rank)
+
+    if comm_rank != 0:
+
+        # Create holders to store the largest values and the
+        #  corresponding indexes of the correlation matrix
+        holder_size = np.array([data_num, neighbor_number], dtype=np.int64)  # Auxiliary variable
+        idx_to_keep_dim1 = np.zeros((data_num, neighbor_number), dtype=np.int64)
+        val_to_keep = (-2e+100) * np.ones((data_num, neighbor_number), dtype=np.float64)
+
+        # Load the checkpoints of the interrupted calculation.
+        if resume:
+            checkpoints = util.load_checkpoints(checkpoint_prefix=checkpoint_prefix,
+                                                signature=checkpoint_signature)
+        else:
+            checkpoints = []
+
+        if symmetric_tiling:
+            # Each pair of mirror tiles is only calculated once.
+            batch_idx_dim0 = comm_rank - 1
+            global_idx_range_dim0 = data_source.batch_global_idx_range_dim0[batch_idx_dim0]
+            tile_schedule = util.get_symmetric_tile_schedule(batch_num=batch_num_dim0)
+            round_num = tile_schedule.shape[0]
+
+            # The mirror tiles are exchanged in each round. Therefore, all the workers have to
+            # resume from the same round.
+            start_round = 0
+            if resume:
+                start_round = worker_comm.allreduce(int(checkpoints[0]["progress"]) if checkpoints else 0,
+                                                    op=MPI.MIN)
+                checkpoints = [x for x in checkpoints if int(x["progress"]) == start_round]
+                if start_round > 0 and not checkpoints:
+                    raise Exception("Process {} has no checkpoint of round {}.".format(comm_rank, start_round))
+
+            if checkpoints:
+                idx_to_keep_dim1[:] = checkpoints[0]["idx_to_keep_dim1"]
+                val_to_keep[:] = checkpoints[0]["val_to_keep"]
+                print("Process {} resumes from round {}.".format(comm_rank, start_round))
+
+            # The batches along dimension 1 to load in each round
+            batch_iterator = abbr.get_masked_batches_dim1(
+                data_source=data_source,
+                batch_idx_list=[x for x in tile_schedule[start_round:, batch_idx_dim0]
+                                if x >= 0 and x != batch_idx_dim0],
+                data_shape=data_shape, bool_mask_1d=bool_mask_1d, prefetch=prefetch,
+                pattern_cache=pattern_cache, dtype=compute_dtype, standardize=standardize_on_load,
+                projection=projection)
+
+            for round_idx in range(start_round, round_num):
+                batch_idx_dim1 = tile_schedule[round_idx, batch_idx_dim0]
+                print("Node {} begins to process round {}.".format(comm_rank, round_idx, ) +
+                      " There are {} more rounds to process.".format(round_num - round_idx - 1))
+
+                request = None
+                if batch_idx_dim1 >= 0:
+                    global_idx_range_dim1 = data_source.batch_global_idx_range_dim1[batch_idx_dim1]
+
+                    if batch_idx_dim1 == batch_idx_dim0:
+                        dataset_dim1 = dataset_dim0
+                    else:
+                        _, dataset_dim1 = next(batch_iterator)
+
+                    mirror_holders = abbr.update_nearest_neighbors_symmetric(
+                        dataset_dim0=dataset_dim0, dataset_dim1=dataset_dim1,
+                        global_idx_range_dim0=global_idx_range_dim0,
+                        global_idx_range_dim1=global_idx_range_dim1,
+                        neighbor_number=neighbor_number, bool_mask_1d=bool_mask_1d,
+                        data_std_dim0=data_std_dim0, data_mean_dim0=data_mean_dim0,
+                        data_std_dim1=std_all[global_idx_range_dim1[0]:global_idx_range_dim1[1]],
+                        data_mean_dim1=mean_all[global_idx_range_dim1[0]:global_idx_range_dim1[1]],
+                        holder_size=holder_size, idx_to_keep_dim1=idx_to_keep_dim1,
+                        val_to_keep=val_to_keep, normalize_by_std=normalize_by_std,
+                        zeros_mean_shift=zeros_mean_shift, recheck_tolerance=recheck_tolerance,
+                        standardize=standardize_on_load)
+
+                    # Send the nearest neighbors found in the mirror tile to the owner of batch_idx_dim1
+                    if mirror_holders is not None:
+                        request = comm.isend(mirror_holders, dest=batch_idx_dim1 + 1, tag=round_idx)
+
+                # Receive the nearest neighbors found in the mirror tile of this batch
+                source_batch = (batch_idx_dim0 - round_idx) % batch_num_dim0
+                if round_idx > 0 and tile_schedule[round_idx, source_batch] == batch_idx_dim0:
+                    idx_mirror, val_mirror = comm.recv(source=source_batch + 1, tag=round_idx)
+                    abbr.merge_nearest_neighbors(values=val_mirror, indexes=idx_mirror, holder_size=holder_size,
+                                                 idx_to_keep_dim1=idx_to_keep_dim1, val_to_keep=val_to_keep)
+
+                if request is not None:
+                    request.wait()
+
+                if checkpoint_prefix is not None and (round_idx + 1) % checkpoint_interval == 0:
+                    # Make sure that all the workers have finished this round so that the
+                    # checkpoints of different workers differ by at most one checkpoint.
+                    worker_comm.Barrier()
+                    util.save_checkpoint(checkpoint_prefix=checkpoint_prefix,
+                                         progress=round_idx + 1,
+                                         signature=checkpoint_signature,
+                                         idx_to_keep_dim1=idx_to_keep_dim1,
+                                         val_to_keep=val_to_keep)
+
+        else:
+            start_batch = 0
+            if checkpoints:
+                start_batch = int(checkpoints[0]["progress"])
+                idx_to_keep_dim1[:] = checkpoints[0]["idx_to_keep_dim1"]
+                val_to_keep[:] = checkpoints[0]["val_to_keep"]
+                print("Process {} resumes from batch {}.".format(comm_rank, start_batch))
+
+            #  Loop through each rows.
+            batch_iterator = abbr.get_masked_batches_dim1(data_source=data_source,
+                                                          batch_idx_list=range(start_batch, batch_num_dim1),
+                                                          data_shape=data_shape, bool_mask_1d=bool_mask_1d,
+                                                          prefetch=prefetch, pattern_cache=pattern_cache,
+                                                          dtype=compute_dtype, standardize=standardize_on_load,
+                                                          projection=projection)
+            for batch_idx_dim1, dataset_dim1 in batch_iterator:
+                print("Node {} begins to process batch {}.".format(comm_rank, batch_idx_dim1, ) +
+                      " There are {} more batches to process.".format(batch_num_dim1 -
+                                                                      batch_idx_dim1 - 1))
+
+                abbr.update_nearest_neighbors(data_source=data_source, dataset_dim0=dataset_dim0,
+                                              data_num=data_num, std_all=std_all, mean_all=mean_all,
+                                              neighbor_number=neighbor_number, data_shape=data_shape,
+                                              batch_idx_dim1=batch_idx_dim1, bool_mask_1d=bool_mask_1d,
+                                              data_std_dim0=data_std_dim0, data_mean_dim0=data_mean_dim0,
+                                              holder_size=holder_size, idx_to_keep_dim1=idx_to_keep_dim1,
+                                              val_to_keep=val_to_keep, normalize_by_std=normalize_by_std,
+                                              zeros_mean_shift=zeros_mean_shift, dataset_dim1=dataset_dim1,
+                                              recheck_tolerance=recheck_tolerance,
+                                              standardize=standardize_on_load, projection=projection)
+
+                if checkpoint_prefix is not None and (batch_idx_dim1 + 1) % checkpoint_interval == 0:
+                    util.save_checkpoint(checkpoint_prefix=checkpoint_prefix,
+                                         progress=batch_idx_dim1 + 1,
+                                         signature=checkpoint_signature,
+                                         idx_to_keep_dim1=idx_to_keep_dim1,
+                                         val_to_keep=val_to_keep)
+
+        # Each worker saves its own rows.
+        values_all, idx_dim1_all = val_to_keep, idx_to_keep_dim1
+        mean_all, std_all = data_mean_dim0, data_std_dim0
+
+    else:
+        # The master does not hold any rows.
+        values_all, idx_dim1_all, mean_all, std_all, global_idx_range_dim0 = None, None, None, None, None
 
 """
-Step Five: Collect all the patches and assemble them.
+Step Five: Each process writes its rows into the output file.
 """
+util.save_correlation_values_and_positions_parallel(comm=comm,
+                                                    values=values_all,
+                                                    index_dim1=idx_dim1_all,
+                                                    means=mean_all,
+                                                    std=std_all,
+                                                    global_idx_range=global_idx_range_dim0,
+                                                    mask=np.load(mask_file),
+                                                    output_address=output_folder)
+
+# Keep the mean and std of the patterns next to the list of the h5 files for the later stages
+stat_data = comm.gather((global_idx_range_dim0, mean_all, std_all), root=0)
 if comm_rank == 0:
-    values_all = np.concatenate(value_to_keep_data[1:], axis=0)
-    idx_dim1_all = np.concatenate(index_to_keep_dim1_data[1:], axis=0)
-
-    # Constuct the holder for index for each point along dimension 0
-    holder_size = (data_source.data_num_total, neighbor_number)
-    idx_dim0_all = np.outer(np.arange(data_source.data_num_total, dtype=np.int),
-                            np.ones(neighbor_number, dtype=np.int))
-    # Load the mask
+    means = np.empty(data_source.data_num_total, dtype=np.float64)
+    std = np.empty(data_source.data_num_total, dtype=np.float64)
+    for idx_range, mean_part, std_part in stat_data:
+        if idx_range is not None:
+            means[idx_range[0]:idx_range[1]] = mean_part
+            std[idx_range[0]:idx_range[1]] = std_part
+
     mask = np.load(mask_file)
-    util.save_correlation_values_and_positions(values=values_all,
-                                               index_dim0=idx_dim0_all,
-                                               index_dim1=idx_dim1_all,
-                                               output_address=output_folder,
-                                               mask=mask,
-                                               means=mean_all,
-                                               std=std_all)
+    util.save_pattern_stat(stat_file=util.get_pattern_stat_file(input_file_list),
+                           means=means,
+                           std=std,
+                           mask=mask,
+                           signature=util.get_pattern_stat_signature(source_dict=data_source.source_dict,
+                                                                     mask=mask))
+if comm_rank == 0:
     # Finishes the calculation.
     toc = time.time()
     print("The total calculation time is {} seconds".format(toc - tic))
+
+# The result is saved. Remove the checkpoints.
+comm.Barrier()  # Synchronize
+if checkpoint_prefix is not None:
+    util.remove_checkpoints(checkpoint_prefix=checkpoint_prefix)
+
+# Remove the pattern cache
+if pattern_cache is not None:
+    del pattern_cache, pattern_stat
+    node_comm.Barrier()  # Synchronize
+    if node_comm.Get_rank() == 0:
+        os.remove(cache_file)
+        os.remove(stat_file)
@@ -0,0 +1,244 @@
+import sys
+sys.path.append("/reg/neh/home/haoyuan/Documents/my_repos/DiffusionMap")
+
+import os
+import time
+import datetime
+import numpy as np
+from pDiffusionMap import util, abbr, DataSource
+from mpi4py import MPI
+
+try:
+    import Config
+except ImportError:
+    raise Exception("This package use Config.py file to set parameters. "
+                    "Please use the start_a_new_project.py "
+                    "script to get a folder \'proj_***\'. Move this folder"
+                    " to a desirable address and modify"
+                    "the Config.py file in the folder \'proj_***/pDiffusionMap\' "
+                    "and execute DiffusionMap calculation"
+                    "in this folder.")
+# Check if the configuration information is valid and compatible with the MPI setup
+Config.check()
+
+# Initialize the MPI
+comm = MPI.COMM_WORLD
+comm_rank = comm.Get_rank()
+comm_size = comm.Get_size()
+
+# Parse
+batch_num_dim1 = Config.CONFIGURATIONS["batch_num_dim1"]
+input_file_list = Config.CONFIGURATIONS["input_file_list"]
+output_folder = Config.CONFIGURATIONS["output_folder"]
+mask_file = Config.CONFIGURATIONS["mask_file"]
+pattern_cache_folder = Config.CONFIGURATIONS["pattern_cache_folder"]
+pattern_cache_dtype = Config.CONFIGURATIONS["pattern_cache_dtype"]
+recall_target = Config.CONFIGURATIONS["approximate_recall_target"]
+recall_sample_number = Config.CONFIGURATIONS["approximate_recall_sample_number"]
+tree_number = Config.CONFIGURATIONS["approximate_tree_number"]
+leaf_size = Config.CONFIGURATIONS["approximate_leaf_size"]
+sample_number = Config.CONFIGURATIONS["approximate_sample_number"]
+max_iteration = Config.CONFIGURATIONS["approximate_max_iteration"]
+seed = Config.CONFIGURATIONS["approximate_seed"]
+projection_method = Config.CONFIGURATIONS["projection_method"]
+
+# Keep the h5 data files open between the batches
+util.set_h5_file_pool(max_file_num=Config.CONFIGURATIONS["h5_file_pool_size"],
+                      total_rdcc_nbytes=Config.CONFIGURATIONS["h5_chunk_cache_total_nbytes"],
+                      read_thread_num=Config.CONFIGURATIONS["h5_read_thread_num"])
+
+if not (Config.CONFIGURATIONS["zeros_mean_shift"] and Config.CONFIGURATIONS["normalize_by_std"]):
+    raise Exception("WeightMatApprox.py only supports the Pearson correlation coefficient. "
+                    "Please set both zeros_mean_shift and normalize_by_std to True.")
+
+if not pattern_cache_folder:
+    # The approximate method needs random access to all the patterns. The output folder is usually shared
+    # between the nodes, so the name of each cache contains the host name below.
+    pattern_cache_folder = output_folder
+
+if Config.CONFIGURATIONS["keep_diagonal"]:
+    neighbor_number = Config.CONFIGURATIONS["neighbor_number_similarity_matrix"]
+else:
+    # If one does not want to keep the diagonal value,
+    # then just calculate for one more value and then
+    # remove the diagonal value.
+    neighbor_number = Config.CONFIGURATIONS["neighbor_number_similarity_matrix"] + 1
+
+# Each leaf has to contain enough candidates for the nearest neighbors of its patterns.
+leaf_size = max(leaf_size, 2 * neighbor_number)
+
+"""
+Step One: Initialization
+"""
+if comm_rank == 0:
+    data_source = DataSource.DataSourceFromH5pyList(source_list_file=input_file_list)
+
+    # Build the batches. The batches along dimension 1 are used to fill the pattern cache.
+    tic_local = time.time()
+    data_source.make_batches(batch_num_dim0=comm_size, batch_num_dim1=batch_num_dim1)
+    toc_local = time.time()
+    print("It takes {} seconds to construct the batches.".format(toc_local - tic_local))
+
+else:
+    data_source = None
+
+comm.Barrier()  # Synchronize
+data_source = comm.bcast(obj=data_source, root=0)
+data_num_total = data_source.data_num_total
+bool_mask_1d = util.get_bool_mask_1d(np.load(mask_file))
+pixel_num = int(np.sum(bool_mask_1d))
+comm.Barrier()  # Synchronize
+
+"""
+Step One and a Half: Fit the projection of the standardized patterns
+"""
+if projection_method:
+    tic_local = time.time()
+    projection = abbr.fit_projection(comm=comm,
+                                     data_source=data_source,
+                                     data_shape=data_source.source_dict["shape"],
+                                     bool_mask_1d=bool_mask_1d,
+                                     method=projection_method,
+                                     dimension=Config.CONFIGURATIONS["projection_dimension"],
+                                     seed=Config.CONFIGURATIONS["projection_seed"])
+    toc_local = time.time()
+    print("Process {} spends {} seconds on fitting the projection.".format(comm_rank, toc_local - tic_local))
+else:
+    projection = None
+
+"""
+Step Two: Build the node-local cache of the standardized patterns
+"""
+# All the processes on the same node share one cache file. Each node has its own cache file even if
+# pattern_cache_folder is shared between the nodes.
+node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+stamp = comm.bcast(datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d_%H_%M_%S'), root=0)
+host_name = node_comm.bcast(MPI.Get_processor_name(), root=0)
+cache_file = pattern_cache_folder + "/pattern_cache_{}_{}.npy".format(stamp, host_name)
+stat_file = pattern_cache_folder + "/pattern_stat_{}_{}.npy".format(stamp, host_name)
+
+tic_local = time.time()
+pattern_cache, pattern_stat = abbr.build_pattern_cache(node_comm=node_comm,
+                                                       data_source=data_source,
+                                                       data_shape=data_source.source_dict["shape"],
+                                                       bool_mask_1d=bool_mask_1d,
+                                                       cache_file=cache_file,
+                                                       stat_file=stat_file,
+                                                       dtype=pattern_cache_dtype,
+                                                       standardize=True,
+                                                       projection=projection)
+toc_local = time.time()
+print("Process {} spends {} seconds on building the pattern cache.".format(comm_rank, toc_local - tic_local))
+
+# Global timer
+tic = time.time()
+
+"""
+Step Three: Calculate the exact nearest neighbors of a random sample to measure the recall
+"""
+# Each process holds the nearest neighbors of a range of the patterns.
+row_range_list = abbr.get_row_range_list(data_num=data_num_total, process_num=comm_size)
+row_start, row_end = row_range_list[comm_rank]
+
+if comm_rank == 0:
+    random_state = np.random.RandomState(seed)
+    sample_idx = np.sort(random_state.choice(data_num_total, size=min(recall_sample_number, data_num_total),
+                                             replace=False)).astype(np.int64)
+else:
+    sample_idx = None
+sample_idx = comm.bcast(sample_idx, root=0)
+
+# Each process calculates the sampled patterns in its range.
+sample_idx = sample_idx[(sample_idx >= row_start) & (sample_idx < row_end)]
+idx_exact, _ = abbr.get_exact_nearest_neighbors(dataset=pattern_cache,
+                                                global_idx_array=sample_idx,
+                                                neighbor_number=neighbor_number,
+                                                pixel_num=pixel_num)
+comm.Barrier()  # Synchronize
+
+"""
+Step Four: Build the approximate nearest neighbors
+"""
+# Create holders to store the largest values and the corresponding indexes
+holder_size = np.array([row_end - row_start, neighbor_number], dtype=np.int64)  # Auxiliary variable
+idx_dim1_all = -np.ones((row_end - row_start, neighbor_number), dtype=np.int64)
+values_all = (-2e+100) * np.ones((row_end - row_start, neighbor_number), dtype=np.float64)
+
+# Initial nearest neighbors from the leaves of the random projection trees
+tic_local = time.time()
+leaves = abbr.get_random_projection_leaves(dataset=pattern_cache, tree_number=tree_number,
+                                           leaf_size=leaf_size, seed=seed, comm=comm)
+abbr.update_nearest_neighbors_in_leaves(dataset=pattern_cache, leaves=leaves, holder_size=holder_size,
+                                        idx_to_keep_dim1=idx_dim1_all, val_to_keep=values_all,
+                                        pixel_num=pixel_num, row_range=(row_start, row_end))
+del leaves
+toc_local = time.time()
+print("Process {} takes {} seconds to search the leaves of {} trees.".format(comm_rank, toc_local - tic_local,
+                                                                             tree_number))
+
+# Improve the nearest neighbors with the nearest neighbor descent until the recall is reached.
+is_new = np.ones(data_num_total, dtype=np.bool_)
+recall = util.get_recall_parallel(comm=comm, index_approximate=idx_dim1_all[sample_idx - row_start],
+                                  index_exact=idx_exact)
+if comm_rank == 0:
+    print("The recall of the random projection trees is {}.".format(recall))
+
+for iteration in range(max_iteration):
+    if recall >= recall_target:
+        break
+
+    tic_local = time.time()
+    update_num, is_new = abbr.nn_descent_iteration_parallel(comm=comm, dataset=pattern_cache,
+                                                            row_range_list=row_range_list, holder_size=holder_size,
+                                                            idx_to_keep_dim1=idx_dim1_all, val_to_keep=values_all,
+                                                            is_new=is_new, sample_number=sample_number,
+                                                            pixel_num=pixel_num)
+    toc_local = time.time()
+
+    recall = util.get_recall_parallel(comm=comm, index_approximate=idx_dim1_all[sample_idx - row_start],
+                                      index_exact=idx_exact)
+    if comm_rank == 0:
+        print("Iteration {} takes {} seconds, finds {} new neighbors. The recall is {}.".format(
+            iteration, toc_local - tic_local, update_num, recall))
+
+    if update_num == 0:
+        break
+
+if comm_rank == 0 and recall < recall_target:
+    print("The recall {} does not reach the target {}.".format(recall, recall_target))
+
+"""
+Step Five: Save the nearest neighbors.
+"""
+# Load the mask
+mask = np.load(mask_file)
+
+# Each process writes its own rows.
+has_rows = row_end > row_start
+util.save_correlation_values_and_positions_parallel(comm=comm,
+                                                    values=values_all if has_rows else None,
+                                                    index_dim1=idx_dim1_all if has_rows else None,
+                                                    means=np.array(pattern_stat[0, row_start:row_end]),
+                                                    std=np.array(pattern_stat[1, row_start:row_end]),
+                                                    global_idx_range=(row_start, row_end),
+                                                    mask=mask,
+                                                    output_address=output_folder)
+
+if comm_rank == 0:
+    # Keep the mean and std of the patterns next to the list of the h5 files for the later stages
+    util.save_pattern_stat(stat_file=util.get_pattern_stat_file(input_file_list),
+                           means=np.array(pattern_stat[0]),
+                           std=np.array(pattern_stat[1]),
+                           mask=mask,
+                           signature=util.get_pattern_stat_signature(source_dict=data_source.source_dict,
+                                                                     mask=mask))
+    # Finishes the calculation.
+    toc = time.time()
+    print("The total calculation time is {} seconds. The measured recall is {}.".format(toc - tic, recall))
+
+# Remove the pattern cache
+del pattern_cache, pattern_stat
+node_comm.Barrier()  # Synchronize
+if node_comm.Get_rank() == 0:
+    os.remove(cache_file)
+    os.remove(stat_file)
@@ -0,0 +1,220 @@
+import sys
+sys.path.append("/reg/neh/home/haoyuan/Documents/my_repos/DiffusionMap")
+
+import os
+import time
+import datetime
+import h5py
+import numpy as np
+from pDiffusionMap import util, abbr, DataSource
+from mpi4py import MPI
+
+try:
+    import Config
+except ImportError:
+    raise Exception("This package use Config.py file to set parameters. "
+                    "Please use the start_a_new_project.py "
+                    "script to get a folder \'proj_***\'. Move this folder"
+                    " to a desirable address and modify"
+                    "the Config.py file in the folder \'proj_***/pDiffusionMap\' "
+                    "and execute DiffusionMap calculation"
+                    "in this folder.")
+# Check if the configuration information is valid and compatible with the MPI setup
+Config.check()
+
+# Initialize the MPI
+comm = MPI.COMM_WORLD
+comm_rank = comm.Get_rank()
+comm_size = comm.Get_size()
+
+# Parse
+batch_num_dim1 = Config.CONFIGURATIONS["batch_num_dim1"]
+input_file_list = Config.CONFIGURATIONS["input_file_list"]
+output_folder = Config.CONFIGURATIONS["output_folder"]
+mask_file = Config.CONFIGURATIONS["mask_file"]
+prefetch = Config.CONFIGURATIONS["prefetch"]
+
+# Keep the h5 data files open between the batches
+util.set_h5_file_pool(max_file_num=Config.CONFIGURATIONS["h5_file_pool_size"],
+                      total_rdcc_nbytes=Config.CONFIGURATIONS["h5_chunk_cache_total_nbytes"],
+                      read_thread_num=Config.CONFIGURATIONS["h5_read_thread_num"])
+
+if not (Config.CONFIGURATIONS["zeros_mean_shift"] and Config.CONFIGURATIONS["normalize_by_std"]):
+    raise Exception("WeightMatIncremental.py only supports the Pearson correlation coefficient. "
+                    "Please set both zeros_mean_shift and normalize_by_std to True.")
+
+if Config.CONFIGURATIONS["projection_method"]:
+    raise Exception("WeightMatIncremental.py does not support the projection since the projection "
+                    "of the previous calculation is not saved.")
+
+correlation_matrix_file = str(output_folder + "/partial_correlation_matrix.h5")
+
+"""
+Step One: Initialization
+"""
+if comm_rank == 0:
+    # The previous calculation
+    with h5py.File(correlation_matrix_file, 'r') as h5file:
+        data_num_old = int(np.array(h5file['matrix_shape'])[0])
+        neighbor_number = int(h5file['values'].shape[1])
+        if not np.array_equal(np.array(h5file['mask']), np.load(mask_file)):
+            raise Exception("The mask is not the same as that of the previous calculation.")
+
+    data_source = DataSource.DataSourceFromH5pyList(source_list_file=input_file_list)
+
+    # The new patterns are one batch along dimension 0. Each process handles a share of the batches along dimension 1.
+    tic_local = time.time()
+    data_source.make_incremental_batches(data_num_old=data_num_old, batch_num_dim0=1,
+                                         batch_num_dim1=max(batch_num_dim1, comm_size))
+    toc_local = time.time()
+    print("It takes {} seconds to construct the batches.".format(toc_local - tic_local))
+    print("There are {} old patterns and {} new patterns.".format(data_num_old,
+                                                                  data_source.data_num_total - data_num_old))
+else:
+    data_source, data_num_old, neighbor_number = None, None, None
+
+comm.Barrier()  # Synchronize
+data_source, data_num_old, neighbor_number = comm.bcast(obj=(data_source, data_num_old, neighbor_number), root=0)
+comm.Barrier()  # Synchronize
+
+# Global timer
+tic = time.time()
+
+"""
+Step Two: Load the new patterns
+"""
+data_shape = data_source.source_dict["shape"]
+data_num_new = data_source.batch_num_list_dim0[0]
+global_idx_range_new = data_source.batch_global_idx_range_dim0[0]
+
+[dataset_new, data_mean_new,
+ data_std_new, bool_mask_1d, mask] = abbr.get_data_and_stat(batch_info=data_source.batch_ends_local_dim0[0],
+                                                            maskfile=mask_file,
+                                                            data_num=data_num_new,
+                                                            data_shape=data_shape,
+                                                            standardize=True)
+pixel_num = int(np.sum(bool_mask_1d))
+
+"""
+Step Three: Calculate the tiles between the new patterns and all the patterns
+"""
+holder_size_new = np.array([data_num_new, neighbor_number], dtype=np.int64)
+idx_to_keep_new = np.zeros((data_num_new, neighbor_number), dtype=np.int64)
+val_to_keep_new = (-2e+100) * np.ones((data_num_new, neighbor_number), dtype=np.float64)
+
+# The updated rows of the old patterns in the batches of this process
+old_rows = []
+
+# Each process handles consecutive batches so that it can write its rows of the result on its own.
+batch_idx_list = [int(x) for x in np.array_split(np.arange(len(data_source.batch_num_list_dim1)),
+                                                 comm_size)[comm_rank]]
+for batch_idx_dim1, dataset_dim1 in abbr.get_masked_batches_dim1(data_source=data_source,
+                                                                  batch_idx_list=batch_idx_list,
+                                                                  data_shape=data_shape,
+                                                                  bool_mask_1d=bool_mask_1d,
+                                                                  prefetch=prefetch,
+                                                                  standardize=True):
+    global_idx_range_dim1 = data_source.batch_global_idx_range_dim1[batch_idx_dim1]
+
+    # The existing nearest neighbors of the old patterns in this batch
+    old_range = (global_idx_range_dim1[0], min(global_idx_range_dim1[1], data_num_old))
+    if old_range[1] > old_range[0]:
+        val_to_keep_old, idx_to_keep_old, _ = util.load_distance_matrix_rows(
+            correlation_matrix_file=correlation_matrix_file,
+            neighbor_number=neighbor_number,
+            row_range=old_range)
+        val_to_keep_old = np.ascontiguousarray(val_to_keep_old, dtype=np.float64)
+        idx_to_keep_old = np.ascontiguousarray(idx_to_keep_old, dtype=np.int64)
+        holder_size_old = np.array(val_to_keep_old.shape, dtype=np.int64)
+        old_rows.append((old_range, val_to_keep_old, idx_to_keep_old))
+    else:
+        val_to_keep_old, idx_to_keep_old, holder_size_old = None, None, None
+
+    abbr.update_nearest_neighbors_incremental(dataset_new=dataset_new,
+                                              dataset_dim1=dataset_dim1,
+                                              global_idx_range_new=global_idx_range_new,
+                                              global_idx_range_dim1=global_idx_range_dim1,
+                                              data_num_old=data_num_old,
+                                              pixel_num=pixel_num,
+                                              holder_size_new=holder_size_new,
+                                              idx_to_keep_new=idx_to_keep_new,
+                                              val_to_keep_new=val_to_keep_new,
+                                              holder_size_old=holder_size_old,
+                                              idx_to_keep_old=idx_to_keep_old,
+                                              val_to_keep_old=val_to_keep_old)
+    print("Process {} finishes batch {} along dimension 1.".format(comm_rank, batch_idx_dim1))
+
+"""
+Step Four: Merge the results and save them
+"""
+# Merge the nearest neighbors of the new patterns found by each process
+new_data = comm.gather((val_to_keep_new, idx_to_keep_new), root=0)
+if comm_rank == 0:
+    for val_part, idx_part in new_data[1:]:
+        abbr.merge_nearest_neighbors(values=val_part, indexes=idx_part, holder_size=holder_size_new,
+                                     idx_to_keep_dim1=idx_to_keep_new, val_to_keep=val_to_keep_new)
+del new_data
+val_to_keep_new, idx_to_keep_new = comm.bcast((val_to_keep_new, idx_to_keep_new), root=0)
+
+# The rows of the batches of this process
+if batch_idx_list:
+    row_start = int(data_source.batch_global_idx_range_dim1[batch_idx_list[0]][0])
+    row_end = int(data_source.batch_global_idx_range_dim1[batch_idx_list[-1]][1])
+    old_end = min(row_end, data_num_old)
+    new_rows = slice(max(row_start, data_num_old) - data_num_old, max(row_end, data_num_old) - data_num_old)
+
+    with h5py.File(correlation_matrix_file, 'r') as h5file:
+        mean_old = np.array(h5file['means'][row_start:old_end]) if old_end > row_start else np.zeros(0)
+        std_old = np.array(h5file['std'][row_start:old_end]) if old_end > row_start else np.zeros(0)
+
+    values_rows = np.concatenate([x[1] for x in old_rows] + [val_to_keep_new[new_rows]])
+    index_rows = np.concatenate([x[2] for x in old_rows] + [idx_to_keep_new[new_rows]])
+    means_rows = np.concatenate([mean_old, data_mean_new[new_rows]])
+    std_rows = np.concatenate([std_old, data_std_new[new_rows]])
+    row_range = (row_start, row_end)
+else:
+    values_rows, index_rows, means_rows, std_rows, row_range = None, None, None, None, None
+del old_rows
+
+# Write the result next to the previous one first. The previous file is only replaced when the new one
+# is complete. The name with the time stamp keeps the shards of the two files apart.
+stamp = comm.bcast(datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d_%H_%M_%S'), root=0)
+new_file_name = "partial_correlation_matrix_{}.h5".format(stamp)
+util.save_correlation_values_and_positions_parallel(comm=comm,
+                                                    values=values_rows,
+                                                    index_dim1=index_rows,
+                                                    means=means_rows,
+                                                    std=std_rows,
+                                                    global_idx_range=row_range,
+                                                    mask=mask,
+                                                    output_address=output_folder,
+                                                    file_name=new_file_name)
+
+if comm_rank == 0:
+    # The shards of the previous file, if it has any
+    with h5py.File(correlation_matrix_file, 'r') as h5file:
+        mean_old = np.array(h5file['means'])
+        std_old = np.array(h5file['std'])
+        old_shards = set()
+        for key in ['values', 'index_dim1', 'means', 'std']:
+            if h5file[key].is_virtual:
+                old_shards.update([x.file_name for x in h5file[key].virtual_sources()])
+
+    os.replace(output_folder + "/" + new_file_name, correlation_matrix_file)
+
+    # The shards of the previous file are not used anymore.
+    for shard in old_shards:
+        shard_address = os.path.join(output_folder, shard)
+        if os.path.isfile(shard_address) and not shard.startswith(os.path.splitext(new_file_name)[0]):
+            os.remove(shard_address)
+
+    # Keep the mean and std of the patterns next to the list of the h5 files for the later stages
+    util.save_pattern_stat(stat_file=util.get_pattern_stat_file(input_file_list),
+                           means=np.concatenate([mean_old, data_mean_new]),
+                           std=np.concatenate([std_old, data_std_new]),
+                           mask=mask,
+                           signature=util.get_pattern_stat_signature(source_dict=data_source.source_dict,
+                                                                     mask=mask))
+    # Finishes the calculation.
+    toc = time.time()
+    print("The total calculation time is {} seconds".format(toc - tic))
@@ -247,3 +247,51 @@ class DataSourceFromH5pyList:
                                                          global_index_range_list=self.batch_global_idx_range_dim1,
                                                          file_list=self.file_list,
                                                          source_dict=self.source_dict)
+
+    def make_incremental_batches(self, data_num_old, batch_num_dim0, batch_num_dim1):
+        """
+        Get the info to extract the batches when new files are appended to the file list of a previous
+        calculation. The batches along dimension 0 only contain the new patterns, i.e. the global
+        indexes from data_num_old to the end. The batches along dimension 1 contain all the patterns.
+
+        :param data_num_old: The number of patterns in the previous calculation.
+        :param batch_num_dim0: the number of batches of the new patterns along dimension 0.
+        :param batch_num_dim1: the number of batches along dimension 1.
+        :return: None
+        """
+        # The old patterns have to be the patterns in the first files of the list.
+        file_ends = np.cumsum([0, ] + list(self.data_num_per_file))
+        if data_num_old not in file_ends or data_num_old >= self.data_num_total:
+            raise Exception("The first {} patterns do not fill the first files of the list. ".format(data_num_old) +
+                            "The new files have to be appended to the end of the file list.")
+
+        global_index_map = util.get_global_index_map(data_num_total=self.data_num_total,
+                                                     file_num=self.file_num,
+                                                     data_num_per_file=self.data_num_per_file,
+                                                     dataset_num_per_file=self.dataset_num_per_file,
+                                                     data_num_per_dataset=self.data_num_per_dataset)
+
+        # Dimension 0: the new patterns
+        self.batch_num_list_dim0 = util.get_batch_num_list(total_num=self.data_num_total - data_num_old,
+                                                           batch_num=batch_num_dim0)
+        self.batch_global_idx_range_dim0 = np.zeros((batch_num_dim0, 2), dtype=np.int64)
+        tmp = np.cumsum([data_num_old, ] + self.batch_num_list_dim0)
+        self.batch_global_idx_range_dim0[:, 0] = tmp[:-1]
+        self.batch_global_idx_range_dim0[:, 1] = tmp[1:]
+
+        self.batch_ends_local_dim0 = util.get_batch_ends(index_map=global_index_map,
+                                                         global_index_range_list=self.batch_global_idx_range_dim0,
+                                                         file_list=self.file_list,
+                                                         source_dict=self.source_dict)
+
+        # Dimension 1: all the patterns
+        self.batch_num_list_dim1 = util.get_batch_num_list(total_num=self.data_num_total, batch_num=batch_num_dim1)
+        self.batch_global_idx_range_dim1 = np.zeros((batch_num_dim1, 2), dtype=np.int64)
+        tmp = np.cumsum([0, ] + self.batch_num_list_dim1)
+        self.batch_global_idx_range_dim1[:, 0] = tmp[:-1]
+        self.batch_global_idx_range_dim1[:, 1] = tmp[1:]
+
+        self.batch_ends_local_dim1 = util.get_batch_ends(index_map=global_index_map,
+                                                         global_index_range_list=self.batch_global_idx_range_dim1,
+                                                         file_list=self.file_list,
+                                                         source_dict=self.source_dict)
@@ -9,7 +9,7 @@ Notice that in this script, the matrix needs to be sparse.
 
 import numpy as np
 import scipy.sparse
-from numba import jit, int64, float64
+from numba import jit, prange, int64, float64
 
 
 ##################################################################
@@ -110,12 +110,240 @@ def get_symmetric_normalized_laplacian(degree_matrix, weight_matrix):
                             format="csr") - degree_matrix * weight_matrix * degree_matrix
 
 
+##################################################################
+#
+#       Sparse Laplacian matrix
+#
+##################################################################
+@jit(["void(int64[:, :], float64[:, :])"], nopython=True, parallel=True)
+def sort_rows_by_index(indexes, values):
+    """
+    Sort the nearest neighbors of each row by the index in place.
+
+    :param indexes: The indexes of the nearest neighbors of each row.
+    :param values: The values of the nearest neighbors of each row.
+    :return: None
+    """
+    for l in prange(indexes.shape[0]):
+        order = np.argsort(indexes[l])
+        indexes[l] = indexes[l][order]
+        values[l] = values[l][order]
+
+
+@jit(["void(int64[:], int64[:], float64[:], int64, int64[:], int64[:], float64[:])"], nopython=True, parallel=True)
+def coo_to_csr(rows, cols, vals, row_start, indptr, indices, data):
+    """
+    Convert the entries in the coo format into the csr format with the indexes of each row in
+    increasing order.
+
+    :param rows: The global row index of each entry.
+    :param cols: The column index of each entry.
+    :param vals: The value of each entry.
+    :param row_start: The global row index of the first row of the csr matrix.
+    :param indptr: The indptr of the csr matrix. This has to be zeros initially.
+    :param indices: The holder of the indices of the csr matrix.
+    :param data: The holder of the data of the csr matrix.
+    :return: None
+    """
+    row_num = indptr.shape[0] - 1
+
+    # Count the entries of each row
+    for p in range(rows.shape[0]):
+        indptr[rows[p] - row_start + 1] += 1
+    for l in range(row_num):
+        indptr[l + 1] += indptr[l]
+
+    # Put each entry into its row
+    position = indptr[:row_num].copy()
+    for p in range(rows.shape[0]):
+        row = rows[p] - row_start
+        indices[position[row]] = cols[p]
+        data[position[row]] = vals[p]
+        position[row] += 1
+
+    # Sort each row
+    for l in prange(row_num):
+        order = np.argsort(indices[indptr[l]:indptr[l + 1]])
+        indices[indptr[l]:indptr[l + 1]] = indices[indptr[l]:indptr[l + 1]][order]
+        data[indptr[l]:indptr[l + 1]] = data[indptr[l]:indptr[l + 1]][order]
+
+
+@jit(nopython=True)
+def _emit(indices_out, data_out, position, fill, index, value):
+    """
+    Write the entry at the position if fill is True.
+    """
+    if fill:
+        indices_out[position] = index
+        data_out[position] = value
+    return position + 1
+
+
+@jit(["void(int64[:], int64[:], float64[:], int64[:], int64[:], float64[:], int64, boolean, "
+      "int64[:], int64[:], float64[:], boolean)"], nopython=True, parallel=True)
+def symmetrize_csr(indptr_a, indices_a, data_a, indptr_b, indices_b, data_b, row_start, keep_diagonal,
+                   indptr_out, indices_out, data_out, fill):
+    """
+    Symmetrize the matrix A with its transpose B in the same way as util.load_distance_matrix
+    i.e. (A + B) / 2 + |A - B| / 2 where the missing entries are 0 and the resulting 0 entries are removed.
+    If keep_diagonal is False, the diagonal entry of each row is set to 0 explicitly.
+
+    Call this function with fill=False to get the number of entries of each row in indptr_out[1:]. Then
+    call it with fill=True and the cumulative sum in indptr_out to fill indices_out and data_out.
+
+    :param indptr_a: The indptr of the rows of A.
+    :param indices_a: The indices of the rows of A. The indices of each row have to be in increasing order.
+    :param data_a: The data of the rows of A.
+    :param indptr_b: The indptr of the same rows of the transpose of A.
+    :param indices_b: The indices of the rows of the transpose of A in increasing order.
+    :param data_b: The data of the rows of the transpose of A.
+    :param row_start: The global row index of the first row.
+    :param keep_diagonal: Whether to keep the diagonal term.
+    :param indptr_out: The indptr of the symmetric rows.
+    :param indices_out: The holder of the indices of the symmetric rows.
+    :param data_out: The holder of the data of the symmetric rows.
+    :param fill: Whether to fill the entries or to count them.
+    :return: None
+    """
+    for l in prange(indptr_a.shape[0] - 1):
+        diagonal = l + row_start
+        diagonal_done = keep_diagonal
+        position = indptr_out[l] if fill else 0
+
+        pa = indptr_a[l]
+        pb = indptr_b[l]
+        while pa < indptr_a[l + 1] or pb < indptr_b[l + 1]:
+            # Merge the two sorted rows
+            if pb >= indptr_b[l + 1] or (pa < indptr_a[l + 1] and indices_a[pa] < indices_b[pb]):
+                index = indices_a[pa]
+                val_a = data_a[pa]
+                val_b = 0.
+                pa += 1
+            elif pa >= indptr_a[l + 1] or indices_b[pb] < indices_a[pa]:
+                index = indices_b[pb]
+                val_a = 0.
+                val_b = data_b[pb]
+                pb += 1
+            else:
+                index = indices_a[pa]
+                val_a = data_a[pa]
+                val_b = data_b[pb]
+                pa += 1
+                pb += 1
+
+            if not diagonal_done and index >= diagonal:
+                position = _emit(indices_out, data_out, position, fill, diagonal, 0.)
+                diagonal_done = True
+                if index == diagonal:
+                    continue
+
+            value = (val_a + val_b) / 2. + abs(val_a - val_b) / 2.
+            if value != 0.:
+                position = _emit(indices_out, data_out, position, fill, index, value)
+
+        if not diagonal_done:
+            position = _emit(indices_out, data_out, position, fill, diagonal, 0.)
+
+        if not fill:
+            indptr_out[l + 1] = position
+
+
+@jit(["void(int64[:], float64[:], float64, float64[:])",
+      "void(int32[:], float64[:], float64, float64[:])"], nopython=True, parallel=True)
+def exp_kernel_and_degree(indptr, data, tau, degree):
+    """
+    Cast the distances into the weights np.exp(-distance / tau) in place and calculate the degree of each row.
+
+    :param indptr: The indptr of the csr distance matrix.
+    :param data: The data of the csr distance matrix.
+    :param tau: The casting parameter.
+    :param degree: The holder of the degree of each row.
+    :return: None
+    """
+    for l in prange(indptr.shape[0] - 1):
+        row_sum = 0.
+        for p in range(indptr[l], indptr[l + 1]):
+            data[p] = np.exp(-data[p] / tau)
+            row_sum += data[p]
+        degree[l] = row_sum
+
+
+@jit(["void(int64[:], int64[:], int64, int64[:])",
+      "void(int32[:], int32[:], int64, int32[:])"], nopython=True, parallel=True)
+def get_laplacian_row_nnz(indptr, indices, row_start, row_nnz):
+    """
+    Get the number of entries of each row of the Laplacian matrix, i.e. the number of entries of
+    the weight matrix plus one if the diagonal entry is missing.
+
+    :param indptr: The indptr of the csr weight matrix.
+    :param indices: The indices of the csr weight matrix.
+    :param row_start: The global row index of the first row.
+    :param row_nnz: The holder of the number of entries of each row.
+    :return: None
+    """
+    for l in prange(indptr.shape[0] - 1):
+        row_nnz[l] = indptr[l + 1] - indptr[l] + 1
+        for p in range(indptr[l], indptr[l + 1]):
+            if indices[p] == l + row_start:
+                row_nnz[l] -= 1
+                break
+
+
+@jit(["void(int64[:], int64[:], float64[:], int64, float64[:], int64[:], int64[:], float64[:])",
+      "void(int32[:], int32[:], float64[:], int64, float64[:], int32[:], int32[:], float64[:])"],
+     nopython=True, parallel=True)
+def symmetric_normalized_laplacian(indptr, indices, data, row_start, inv_sqrt_degree,
+                                   indptr_out, indices_out, data_out):
+    """
+    Construct the rows of the normalized symmetric laplacian matrix
+    I - D^(-1/2) W D^(-1/2)
+    The output can be the same arrays as the input if the diagonal entry of each row exists.
+
+    :param indptr: The indptr of the rows of the csr weight matrix W.
+    :param indices: The indices of the rows of the weight matrix in increasing order.
+    :param data: The data of the rows of the weight matrix.
+    :param row_start: The global row index of the first row.
+    :param inv_sqrt_degree: The inverse square root of the degree of all the rows.
+    :param indptr_out: The indptr of the rows of the laplacian matrix from get_laplacian_row_nnz.
+    :param indices_out: The holder of the indices of the rows of the laplacian matrix.
+    :param data_out: The holder of the data of the rows of the laplacian matrix.
+    :return: None
+    """
+    for l in prange(indptr.shape[0] - 1):
+        diagonal = l + row_start
+        position = indptr_out[l]
+        diagonal_done = False
+
+        for p in range(indptr[l], indptr[l + 1]):
+            index = indices[p]
+            value = data[p]
+            if not diagonal_done and index > diagonal:
+                # The diagonal entry of the weight matrix is missing.
+                indices_out[position] = diagonal
+                data_out[position] = 1.
+                position += 1
+                diagonal_done = True
+
+            indices_out[position] = index
+            if index == diagonal:
+                data_out[position] = 1. - value * inv_sqrt_degree[diagonal] * inv_sqrt_degree[diagonal]
+                diagonal_done = True
+            else:
+                data_out[position] = - value * inv_sqrt_degree[diagonal] * inv_sqrt_degree[index]
+            position += 1
+
+        if not diagonal_done:
+            indices_out[position] = diagonal
+            data_out[position] = 1.
+
+
 ##################################################################
 #
 #       Normalization
 #
 ##################################################################
-@jit(["void(float64[:, :], float64[:], float64[:], int64[2])"], nopython=True, parallel=True)
+@jit(["void(float64[:, :], float64[:], float64[:], int64[2])",
+      "void(float32[:, :], float64[:], float64[:], int64[2])"], nopython=True, parallel=True)
 def normalization(matrix, std_dim0, std_dim1, matrix_shape):
     """
     Convert the inner product matrix to Pearson correlation coefficient matrix.
@@ -136,7 +364,8 @@ def normalization(matrix, std_dim0, std_dim1, matrix_shape):
         matrix[:, m] /= std_dim1[m]
 
 
-@jit(["void(float64[:, :], float64[:], float64[:], int64[2])"], nopython=True, parallel=True)
+@jit(["void(float64[:, :], float64[:], float64[:], int64[2])",
+      "void(float32[:, :], float64[:], float64[:], int64[2])"], nopython=True, parallel=True)
 def shift(matrix, mean_dim0, mean_dim1, matrix_shape):
     """
     Convert the inner product matrix to Pearson correlation coefficient matrix.
@@ -154,7 +383,8 @@ def shift(matrix, mean_dim0, mean_dim1, matrix_shape):
         matrix[l, :] -= mean_dim0[l] * mean_dim1
 
 
-@jit(["void(float64[:, :], float64[:], float64[:],  float64[:], float64[:], int64[2])"],
+@jit(["void(float64[:, :], float64[:], float64[:],  float64[:], float64[:], int64[2])",
+      "void(float32[:, :], float64[:], float64[:],  float64[:], float64[:], int64[2])"],
      nopython=True, parallel=True)
 def shift_and_normalization(matrix, std_dim0, std_dim1, mean_dim0, mean_dim1, matrix_shape):
     """
@@ -179,6 +409,61 @@ def shift_and_normalization(matrix, std_dim0, std_dim1, mean_dim0, mean_dim1, ma
         matrix[:, m] /= std_dim1[m]
 
 
+@jit(nopython=True)
+def _row_mean_and_std(row):
+    """
+    Calculate the mean value and the standard deviation of one pattern in float64 in a single pass.
+    The sums are taken relative to the first pixel so that the variance does not lose its precision
+    when the mean value is large compared with the standard deviation.
+
+    :param row: The masked pattern.
+    :return: mean, std
+    """
+    pixel_num = row.shape[0]
+    reference = np.float64(row[0])
+    total = 0.
+    total_square = 0.
+    for m in range(pixel_num):
+        value = np.float64(row[m]) - reference
+        total += value
+        total_square += value * value
+
+    mean = total / pixel_num
+    return reference + mean, np.sqrt(max(total_square / pixel_num - mean * mean, 0.))
+
+
+@jit(["void(float64[:, :], float64[:], float64[:])",
+      "void(float32[:, :], float64[:], float64[:])"], nopython=True, parallel=True)
+def pattern_mean_and_std(dataset, means, std):
+    """
+    Calculate the mean value and the standard deviation of each pattern in float64 in a single pass.
+
+    :param dataset: The masked dataset of the shape [data number, pixel number]
+    :param means: The holder for the mean value of each pattern.
+    :param std: The holder for the standard deviation of each pattern.
+    :return: None
+    """
+    for l in prange(dataset.shape[0]):
+        means[l], std[l] = _row_mean_and_std(dataset[l])
+
+
+@jit(["void(float64[:, :], float64[:], float64[:])",
+      "void(float32[:, :], float64[:], float64[:])"], nopython=True)
+def pattern_mean_and_std_serial(dataset, means, std):
+    """
+    The same as pattern_mean_and_std without the parallel loop. Use this one from the threads that load
+    the patterns. Numba parallel regions started from several threads at the same time abort the
+    workqueue threading layer.
+
+    :param dataset: The masked dataset of the shape [data number, pixel number]
+    :param means: The holder for the mean value of each pattern.
+    :param std: The holder for the standard deviation of each pattern.
+    :return: None
+    """
+    for l in range(dataset.shape[0]):
+        means[l], std[l] = _row_mean_and_std(dataset[l])
+
+
 ##################################################################
 #
 #       Value Extraction
@@ -213,3 +498,467 @@ def get_values_float(source, indexes, holder, holder_size):
     for l in range(holder_size[0]):
         for m in range(holder_size[1]):
             holder[l, m] = source[l, indexes[l, m]]
+
+
+##################################################################
+#
+#       Top k selection
+#
+##################################################################
+@jit(nopython=True)
+def _sift_down(val_row, idx_row, start, end):
+    """
+    Restore the min-heap property of val_row[start:end] assuming only the root is out of place.
+    The idx_row is permuted in the same way as the val_row.
+
+    :param val_row: The values in the heap.
+    :param idx_row: The global index of each value in the heap.
+    :param start: The position of the root
+    :param end: The end of the heap.
+    """
+    root = start
+    while True:
+        child = 2 * root + 1
+        if child >= end:
+            break
+        if child + 1 < end and val_row[child + 1] < val_row[child]:
+            child += 1
+        if val_row[child] < val_row[root]:
+            val_row[root], val_row[child] = val_row[child], val_row[root]
+            idx_row[root], idx_row[child] = idx_row[child], idx_row[root]
+            root = child
+        else:
+            break
+
+
+@jit(nopython=True)
+def _reverse(val_row, idx_row, length):
+    """
+    Reverse the order of the values and the global indexes in place.
+
+    :param val_row: The values to reverse.
+    :param idx_row: The global index of each value.
+    :param length: The length of the row.
+    """
+    for m in range(length // 2):
+        n = length - 1 - m
+        val_row[m], val_row[n] = val_row[n], val_row[m]
+        idx_row[m], idx_row[n] = idx_row[n], idx_row[m]
+
+
+@jit(nopython=True)
+def _heap_to_descending(val_row, idx_row, length):
+    """
+    Sort the min-heap in place so that the values decrease along the row.
+
+    :param val_row: The values in the heap.
+    :param idx_row: The global index of each value in the heap.
+    :param length: The size of the heap.
+    """
+    for end in range(length - 1, 0, -1):
+        val_row[0], val_row[end] = val_row[end], val_row[0]
+        idx_row[0], idx_row[end] = idx_row[end], idx_row[0]
+        _sift_down(val_row, idx_row, 0, end)
+
+
+@jit(["void(float64[:, :], int64, int64[:, :], float64[:, :], int64[2])",
+      "void(float32[:, :], int64, int64[:, :], float64[:, :], int64[2])"], nopython=True, parallel=True)
+def update_top_k(matrix, idx_start, idx_holder, val_holder, holder_size):
+    """
+    Merge the new block of the inner product matrix into the holders of the nearest neighbors.
+
+    The values along each row of val_holder decrease before and after the update. The column m
+    of the matrix corresponds to the global index idx_start + m.
+
+    :param matrix: The new block of the inner product matrix.
+    :param idx_start: The global index of the first column of the matrix.
+    :param idx_holder: The holder variable: idx_to_keep_dim1
+    :param val_holder: The holder variable: val_to_keep
+    :param holder_size: The shape of val_to_keep
+    """
+    for l in prange(holder_size[0]):
+        val_row = val_holder[l]
+        idx_row = idx_holder[l]
+
+        # Reverse the decreasing row. An increasing array is a min-heap.
+        _reverse(val_row, idx_row, holder_size[1])
+
+        updated = False
+        threshold = val_row[0]
+        for m in range(matrix.shape[1]):
+            if matrix[l, m] > threshold:
+                val_row[0] = matrix[l, m]
+                idx_row[0] = idx_start + m
+                _sift_down(val_row, idx_row, 0, holder_size[1])
+                threshold = val_row[0]
+                updated = True
+
+        if updated:
+            _heap_to_descending(val_row, idx_row, holder_size[1])
+        else:
+            _reverse(val_row, idx_row, holder_size[1])
+
+
+@jit(["void(float32[:, :], float32[:, :], float32[:, :], float64[:], float64[:], float64[:], float64[:], "
+      "float64[:], float64[:], float64, float64, int64, int64[:, :], float64[:, :], int64[2])"],
+     nopython=True, parallel=True)
+def update_top_k_with_recheck(matrix, dataset_dim0, dataset_dim1, mean_dim0, mean_dim1, std_dim0, std_dim1,
+                              scale_dim0, scale_dim1, denominator, tolerance, idx_start,
+                              idx_holder, val_holder, holder_size):
+    """
+    Merge the new block of the inner product matrix calculated in float32 into the holders of the
+    nearest neighbors.
+
+    The float32 value only decides whether a candidate can be among the nearest neighbors. A candidate
+    whose float32 value is larger than the smallest kept value minus tolerance * scale_dim0[l] * scale_dim1[m]
+    is calculated again in float64 and only the float64 value is kept.
+
+    :param matrix: The new block of the inner product matrix in float32.
+    :param dataset_dim0: The masked dataset along dimension 0
+    :param dataset_dim1: The masked dataset along dimension 1
+    :param mean_dim0: mean value for each element along dimension 0. Zeros if the values are not shifted.
+    :param mean_dim1: mean value for each element along dimension 1. Zeros if the values are not shifted.
+    :param std_dim0: standard deviation for each element along dimension 0. Ones if not normalized.
+    :param std_dim1: standard deviation for each element along dimension 1. Ones if not normalized.
+    :param scale_dim0: The upper bound of the absolute value is scale_dim0[l] * scale_dim1[m].
+    :param scale_dim1: The upper bound of the absolute value is scale_dim0[l] * scale_dim1[m].
+    :param denominator: The inner product is divided by this value.
+    :param tolerance: The relative tolerance of the float32 values.
+    :param idx_start: The global index of the first column of the matrix.
+    :param idx_holder: The holder variable: idx_to_keep_dim1
+    :param val_holder: The holder variable: val_to_keep
+    :param holder_size: The shape of val_to_keep
+    """
+    for l in prange(holder_size[0]):
+        val_row = val_holder[l]
+        idx_row = idx_holder[l]
+
+        # Reverse the decreasing row. An increasing array is a min-heap.
+        _reverse(val_row, idx_row, holder_size[1])
+
+        updated = False
+        threshold = val_row[0]
+        for m in range(matrix.shape[1]):
+            if matrix[l, m] + tolerance * scale_dim0[l] * scale_dim1[m] > threshold:
+                # Calculate the value again in float64
+                value = 0.
+                for n in range(dataset_dim0.shape[1]):
+                    value += np.float64(dataset_dim0[l, n]) * np.float64(dataset_dim1[m, n])
+                value = value / denominator - mean_dim0[l] * mean_dim1[m]
+                value /= std_dim0[l]
+                value /= std_dim1[m]
+
+                if value > threshold:
+                    val_row[0] = value
+                    idx_row[0] = idx_start + m
+                    _sift_down(val_row, idx_row, 0, holder_size[1])
+                    threshold = val_row[0]
+                    updated = True
+
+        if updated:
+            _heap_to_descending(val_row, idx_row, holder_size[1])
+        else:
+            _reverse(val_row, idx_row, holder_size[1])
+
+
+@jit(["void(float64[:, :], int64[:, :], int64[:, :], float64[:, :], int64[2])"], nopython=True, parallel=True)
+def merge_top_k(values, indexes, idx_holder, val_holder, holder_size):
+    """
+    Merge candidates with explicit global indexes into the holders of the nearest neighbors.
+
+    The values along each row of val_holder decrease before and after the update.
+
+    :param values: The values of the candidates.
+    :param indexes: The global index of each candidate.
+    :param idx_holder: The holder variable: idx_to_keep_dim1
+    :param val_holder: The holder variable: val_to_keep
+    :param holder_size: The shape of val_to_keep
+    """
+    for l in prange(holder_size[0]):
+        val_row = val_holder[l]
+        idx_row = idx_holder[l]
+
+        # Reverse the decreasing row. An increasing array is a min-heap.
+        _reverse(val_row, idx_row, holder_size[1])
+
+        updated = False
+        threshold = val_row[0]
+        for m in range(values.shape[1]):
+            if values[l, m] > threshold:
+                val_row[0] = values[l, m]
+                idx_row[0] = indexes[l, m]
+                _sift_down(val_row, idx_row, 0, holder_size[1])
+                threshold = val_row[0]
+                updated = True
+
+        if updated:
+            _heap_to_descending(val_row, idx_row, holder_size[1])
+        else:
+            _reverse(val_row, idx_row, holder_size[1])
+
+
+##################################################################
+#
+#       Approximate nearest neighbors
+#
+##################################################################
+@jit(nopython=True)
+def _contains(idx_row, index, length):
+    """
+    Check whether the global index is among the first length entries of idx_row.
+
+    :param idx_row: The global index of each value in the heap.
+    :param index: The global index to look for.
+    :param length: The size of the heap.
+    :return: True if the index is in the heap.
+    """
+    for n in range(length):
+        if idx_row[n] == index:
+            return True
+    return False
+
+
+@jit(nopython=True)
+def _insert_candidate(val_row, idx_row, value, index, length):
+    """
+    Insert the candidate into the min-heap unless it is too small or its global index is
+    in the heap already.
+
+    :param val_row: The values in the heap.
+    :param idx_row: The global index of each value in the heap.
+    :param value: The value of the candidate.
+    :param index: The global index of the candidate.
+    :param length: The size of the heap.
+    :return: True if the candidate is inserted.
+    """
+    if value <= val_row[0] or _contains(idx_row, index, length):
+        return False
+
+    val_row[0] = value
+    idx_row[0] = index
+    _sift_down(val_row, idx_row, 0, length)
+    return True
+
+
+@jit(["void(float64[:, :], int64[:], int64[:], int64[:, :], float64[:, :], int64[2])"],
+     nopython=True, parallel=True)
+def update_top_k_rows(matrix, rows, cols, idx_holder, val_holder, holder_size):
+    """
+    Merge the similarity matrix between two groups of patterns into the holders of the nearest
+    neighbors. Contrary to update_top_k, the rows of the holders to update are given explicitly and
+    the candidates which are among the nearest neighbors already are skipped. The empty entries of
+    idx_holder have to be -1.
+
+    The values along each row of val_holder decrease before and after the update.
+
+    :param matrix: The similarity matrix of the shape [rows.shape[0], cols.shape[0]]
+    :param rows: The global index of the pattern of each row of the matrix. Each index appears only once.
+    :param cols: The global index of the pattern of each column of the matrix.
+    :param idx_holder: The holder variable: idx_to_keep_dim1
+    :param val_holder: The holder variable: val_to_keep
+    :param holder_size: The shape of val_to_keep
+    """
+    for l in prange(rows.shape[0]):
+        val_row = val_holder[rows[l]]
+        idx_row = idx_holder[rows[l]]
+
+        # Reverse the decreasing row. An increasing array is a min-heap.
+        _reverse(val_row, idx_row, holder_size[1])
+
+        updated = False
+        for m in range(cols.shape[0]):
+            if _insert_candidate(val_row, idx_row, matrix[l, m], cols[m], holder_size[1]):
+                updated = True
+
+        if updated:
+            _heap_to_descending(val_row, idx_row, holder_size[1])
+        else:
+            _reverse(val_row, idx_row, holder_size[1])
+
+
+@jit(["void(int64[:, :], int64, int64[:, :])"], nopython=True)
+def get_reverse_neighbors(neighbors, sample_number, reverse_neighbors):
+    """
+    Find the patterns having each pattern among their first sample_number nearest neighbors.
+
+    :param neighbors: The global index of the nearest neighbors of each pattern.
+    :param sample_number: The number of the nearest neighbors of each pattern to consider.
+    :param reverse_neighbors: The holder of the shape [pattern number, maximal number of reverse
+                              neighbors]. The unused entries are set to -1.
+    """
+    reverse_neighbors[:, :] = -1
+    counts = np.zeros(neighbors.shape[0], dtype=np.int64)
+
+    for l in range(neighbors.shape[0]):
+        for m in range(min(sample_number, neighbors.shape[1])):
+            n = neighbors[l, m]
+            if n >= 0 and n != l and counts[n] < reverse_neighbors.shape[1]:
+                reverse_neighbors[n, counts[n]] = l
+                counts[n] += 1
+
+
+@jit(["void(float32[:, :], int64[:, :], int64[:, :], boolean[:], int64, float64, "
+      "int64[:, :], float64[:, :], int64[:], int64[2])",
+      "void(float64[:, :], int64[:, :], int64[:, :], boolean[:], int64, float64, "
+      "int64[:, :], float64[:, :], int64[:], int64[2])"],
+     nopython=True, parallel=True)
+def nn_descent_update(dataset, neighbors, reverse_neighbors, is_new, sample_number, denominator,
+                      idx_holder, val_holder, update_num, holder_size):
+    """
+    One iteration of the nearest neighbor descent. The neighbors of the neighbors of each pattern,
+    in both directions, are candidates for its nearest neighbors. Only the candidates reached through
+    a pattern whose nearest neighbors changed in the last iteration are checked.
+
+    The similarity is the inner product divided by the denominator and it is calculated in float64.
+
+    :param dataset: The masked and standardized dataset of all the patterns.
+    :param neighbors: A copy of idx_holder from before this iteration.
+    :param reverse_neighbors: The reverse neighbors from get_reverse_neighbors. Unused entries are -1.
+    :param is_new: Whether the nearest neighbors of each pattern changed in the last iteration.
+    :param sample_number: The number of the nearest neighbors of each pattern to follow.
+    :param denominator: The inner product is divided by this value.
+    :param idx_holder: The holder variable: idx_to_keep_dim1. The empty entries have to be -1.
+    :param val_holder: The holder variable: val_to_keep
+    :param update_num: Output. The number of the new nearest neighbors of each pattern in this iteration.
+    :param holder_size: The shape of val_to_keep
+    """
+    forward_number = min(sample_number, neighbors.shape[1])
+    reverse_number = reverse_neighbors.shape[1]
+
+    for l in prange(holder_size[0]):
+        val_row = val_holder[l]
+        idx_row = idx_holder[l]
+
+        # Reverse the decreasing row. An increasing array is a min-heap.
+        _reverse(val_row, idx_row, holder_size[1])
+
+        change_num = 0
+        for p in range(forward_number + reverse_number):
+            if p < forward_number:
+                a = neighbors[l, p]
+            else:
+                a = reverse_neighbors[l, p - forward_number]
+            if a < 0 or not (is_new[l] or is_new[a]):
+                continue
+
+            for q in range(forward_number + reverse_number):
+                if q < forward_number:
+                    b = neighbors[a, q]
+                else:
+                    b = reverse_neighbors[a, q - forward_number]
+                if b < 0 or _contains(idx_row, b, holder_size[1]):
+                    continue
+
+                value = 0.
+                for n in range(dataset.shape[1]):
+                    value += np.float64(dataset[l, n]) * np.float64(dataset[b, n])
+                value /= denominator
+
+                if _insert_candidate(val_row, idx_row, value, b, holder_size[1]):
+                    change_num += 1
+
+        if change_num > 0:
+            _heap_to_descending(val_row, idx_row, holder_size[1])
+        else:
+            _reverse(val_row, idx_row, holder_size[1])
+
+        update_num[l] = change_num
+
+
+@jit(["void(float32[:, :], int64[:, :], int64, boolean[:], float64[:], float64, "
+      "int64[:, :], int64[:, :], float64[:, :], int64[:])",
+      "void(float64[:, :], int64[:, :], int64, boolean[:], float64[:], float64, "
+      "int64[:, :], int64[:, :], float64[:, :], int64[:])"],
+     nopython=True, parallel=True)
+def nn_descent_join(dataset, join_lists, row_start, is_new, thresholds, denominator,
+                    cand_row, cand_idx, cand_val, cand_num):
+    """
+    The local join of the nearest neighbor descent. Any two patterns in the join list of a pattern,
+    i.e. its nearest neighbors and its reverse neighbors, are candidates for the nearest neighbors of
+    each other. Only the pairs with a pattern whose nearest neighbors changed in the last iteration are
+    checked and only the candidates larger than the smallest kept value of the receiving pattern are
+    returned. Unlike nn_descent_update, the nearest neighbors of each pattern are only needed by the
+    process holding that pattern.
+
+    The similarity is the inner product divided by the denominator and it is calculated in float64.
+
+    :param dataset: The masked and standardized dataset of all the patterns.
+    :param join_lists: The nearest neighbors followed by the reverse neighbors of the patterns from
+                       row_start on. Unused entries are -1.
+    :param row_start: The global index of the pattern of the first row of join_lists.
+    :param is_new: Whether the nearest neighbors of each pattern changed in the last iteration.
+    :param thresholds: The smallest kept value of each pattern.
+    :param denominator: The inner product is divided by this value.
+    :param cand_row: Output. The global index of the pattern receiving each candidate. The shape is
+                     [join_lists.shape[0], join_lists.shape[1] * (join_lists.shape[1] - 1)]
+    :param cand_idx: Output. The global index of each candidate. The same shape as cand_row.
+    :param cand_val: Output. The value of each candidate. The same shape as cand_row.
+    :param cand_num: Output. The number of candidates from the join list of each pattern.
+    """
+    length = join_lists.shape[1]
+
+    for u in prange(join_lists.shape[0]):
+        count = 0
+        for p in range(length):
+            a = join_lists[u, p]
+            if a < 0:
+                continue
+
+            for q in range(p + 1, length):
+                b = join_lists[u, q]
+                if b < 0 or b == a or not (is_new[row_start + u] or is_new[a] or is_new[b]):
+                    continue
+
+                value = 0.
+                for n in range(dataset.shape[1]):
+                    value += np.float64(dataset[a, n]) * np.float64(dataset[b, n])
+                value /= denominator
+
+                if value > thresholds[a]:
+                    cand_row[u, count] = a
+                    cand_idx[u, count] = b
+                    cand_val[u, count] = value
+                    count += 1
+                if value > thresholds[b]:
+                    cand_row[u, count] = b
+                    cand_idx[u, count] = a
+                    cand_val[u, count] = value
+                    count += 1
+
+        cand_num[u] = count
+
+
+@jit(["void(int64[:], int64[:], float64[:], int64[:, :], float64[:, :], int64[:], int64[2])"],
+     nopython=True, parallel=True)
+def merge_candidates(offsets, cand_idx, cand_val, idx_holder, val_holder, update_num, holder_size):
+    """
+    Merge the candidates grouped by the row of the holders into the nearest neighbors. The candidates
+    which are among the nearest neighbors already are skipped. The empty entries of idx_holder have
+    to be -1.
+
+    :param offsets: The candidates of row l are cand_idx[offsets[l]:offsets[l + 1]].
+    :param cand_idx: The global index of each candidate.
+    :param cand_val: The value of each candidate.
+    :param idx_holder: The holder variable: idx_to_keep_dim1
+    :param val_holder: The holder variable: val_to_keep
+    :param update_num: Output. The number of the new nearest neighbors of each row.
+    :param holder_size: The shape of val_to_keep
+    """
+    for l in prange(holder_size[0]):
+        val_row = val_holder[l]
+        idx_row = idx_holder[l]
+
+        # Reverse the decreasing row. An increasing array is a min-heap.
+        _reverse(val_row, idx_row, holder_size[1])
+
+        change_num = 0
+        for c in range(offsets[l], offsets[l + 1]):
+            if _insert_candidate(val_row, idx_row, cand_val[c], cand_idx[c], holder_size[1]):
+                change_num += 1
+
+        if change_num > 0:
+            _heap_to_descending(val_row, idx_row, holder_size[1])
+        else:
+            _reverse(val_row, idx_row, holder_size[1])
+
+        update_num[l] = change_num
@@ -0,0 +1,151 @@
+"""
+This module contains the Nystrom extension to embed new patterns into an existing diffusion map
+without calculating the similarity matrix and the eigensystem again.
+"""
+
+import h5py
+import numpy as np
+
+from pDiffusionMap import abbr, util, DataSource, Graph
+
+
+class NystromExtension:
+    """
+    Embed new patterns with the eigenvectors of an existing calculation.
+
+    Each new pattern x is compared with all the reference patterns. Its nearest neighbors get the weights
+    w(x, j) = np.exp(-value / tau) as in convert_to_laplacian_matrix, and its degree d(x) includes the
+    weight 1 of the diagonal entry like the reference rows. With S = D^(-1/2) W D^(-1/2) and the eigenvalue
+    lambda_i of the laplacian matrix I - S, the coordinate along the eigenvector u_i is
+
+        u_i(x) = sum_j S(x, j) u_i(j) / (1 - lambda_i - 1 / d(x))
+
+    which gives back u_i(j) for a reference pattern whose neighbors are those of its symmetrized row.
+
+    The projection of WeightMat.py is not saved, so the calculation has to be done without the projection.
+    """
+
+    def __init__(self, correlation_matrix_file, eigensystem_file, input_file_list=None, reference_patterns=None,
+                 batch_num=1, dtype=np.float64, neighbor_number=None):
+        """
+        Load the reference patterns, the degree of each reference pattern and the eigensystem.
+
+        :param correlation_matrix_file: The partial_correlation_matrix.h5 file of the calculation. The mask
+                                        is loaded from this file.
+        :param eigensystem_file: The eigensystem_*.h5 file of the calculation. The tau and the neighbor number
+                                 are loaded from this file.
+        :param input_file_list: The txt file containing the h5 files of the reference patterns.
+        :param reference_patterns: The masked and standardized reference patterns of the shape
+                                   [data number, unmasked pixel number], e.g. a memory-mapped pattern cache.
+                                   If this is not None, input_file_list is not used.
+        :param batch_num: The number of batches to load the reference patterns with.
+        :param dtype: The dtype of the reference patterns kept in memory.
+        :param neighbor_number: The neighbor_number_Laplacian_matrix of the calculation. This is only used if
+                                the eigensystem file does not contain the neighbor number, e.g. a file
+                                saved by an earlier version of EigensSlepc.py.
+        """
+        with h5py.File(eigensystem_file, 'r') as h5file:
+            self.eigenvalues = np.array(h5file['eigenvalues'])
+            self.eigenvectors = np.array(h5file['eigenvectors'])
+            self.tau = float(np.array(h5file['tau']))
+            if 'neighbor_number' in h5file:
+                neighbor_number = int(np.array(h5file['neighbor_number']))
+
+        if neighbor_number is None:
+            raise Exception("The eigensystem file {} does not contain the neighbor number. ".format(eigensystem_file) +
+                            "Please specify the neighbor_number_Laplacian_matrix of the calculation " +
+                            "with the argument neighbor_number.")
+        self.neighbor_number = int(neighbor_number)
+
+        with h5py.File(correlation_matrix_file, 'r') as h5file:
+            self.mask = np.array(h5file['mask'])
+            matrix_shape = np.array(h5file['matrix_shape'])
+        self.bool_mask_1d = util.get_bool_mask_1d(mask=self.mask)
+        self.pixel_num = int(np.sum(self.bool_mask_1d))
+
+        if self.eigenvectors.shape[1] != matrix_shape[0]:
+            raise Exception("The eigenvectors do not belong to the partial correlation matrix.")
+
+        # The degree of each reference pattern in the same way as convert_to_laplacian_matrix
+        distance_matrix, _ = util.load_distance_matrix(correlation_matrix_file=correlation_matrix_file,
+                                                       neighbor_number=self.neighbor_number,
+                                                       symmetric=True,
+                                                       keep_diagonal=False)
+        self.degree = np.empty(distance_matrix.shape[0], dtype=np.float64)
+        Graph.exp_kernel_and_degree(distance_matrix.indptr, distance_matrix.data, self.tau, self.degree)
+        del distance_matrix
+
+        # The reference patterns
+        if reference_patterns is None:
+            if input_file_list is None:
+                raise Exception("Either input_file_list or reference_patterns has to be specified.")
+            self.reference_patterns = self._load_reference_patterns(input_file_list=input_file_list,
+                                                                    batch_num=batch_num,
+                                                                    dtype=dtype)
+        else:
+            self.reference_patterns = reference_patterns
+
+        if self.reference_patterns.shape != (matrix_shape[0], self.pixel_num):
+            raise Exception("The reference patterns do not belong to the partial correlation matrix.")
+
+    def _load_reference_patterns(self, input_file_list, batch_num, dtype):
+        """
+        Load, mask and standardize all the reference patterns.
+
+        :param input_file_list: The txt file containing the h5 files of the reference patterns.
+        :param batch_num: The number of batches to load the reference patterns with.
+        :param dtype: The dtype of the reference patterns.
+        :return: The reference patterns of the shape [data number, unmasked pixel number].
+        """
+        data_source = DataSource.DataSourceFromH5pyList(source_list_file=input_file_list)
+        data_source.make_batches(batch_num_dim0=1, batch_num_dim1=batch_num)
+
+        reference_patterns = np.empty((int(data_source.data_num_total), self.pixel_num), dtype=dtype)
+        for batch_idx_dim1 in range(len(data_source.batch_num_list_dim1)):
+            global_idx_start, global_idx_end = data_source.batch_global_idx_range_dim1[batch_idx_dim1]
+            reference_patterns[global_idx_start:global_idx_end] = abbr.get_masked_batch_dim1(
+                data_source=data_source,
+                batch_idx_dim1=batch_idx_dim1,
+                data_shape=data_source.source_dict["shape"],
+                bool_mask_1d=self.bool_mask_1d,
+                dtype=dtype,
+                standardize=True)
+
+        return reference_patterns
+
+    def get_nearest_neighbors(self, patterns):
+        """
+        Find the nearest neighbors of the new patterns among the reference patterns.
+
+        :param patterns: The new patterns of the shape [data number] + pattern shape.
+        :return: index_dim1, values of the shape [data number, neighbor number - 1]. The diagonal entry
+                 of each reference row is one of its neighbor_number entries, so a new pattern has one
+                 neighbor less.
+        """
+        patterns = np.reshape(patterns, (patterns.shape[0], self.mask.size))[:, self.bool_mask_1d]
+        query, _, _ = abbr.standardize_patterns(dataset=patterns)
+
+        return abbr.get_nearest_neighbors_of_patterns(query=query,
+                                                      dataset=self.reference_patterns,
+                                                      neighbor_number=self.neighbor_number - 1,
+                                                      pixel_num=self.pixel_num)
+
+    def embed(self, patterns):
+        """
+        Get the coordinates of the new patterns along each eigenvector.
+
+        :param patterns: The new patterns of the shape [data number] + pattern shape.
+        :return: The coordinates of the shape [eigenvector number, data number] in the same layout as
+                 the eigenvectors in the eigensystem file.
+        """
+        index_dim1, values = self.get_nearest_neighbors(patterns=patterns)
+
+        # The row of S for each new pattern
+        weights = np.exp(-values / self.tau)
+        degree = 1. + np.sum(weights, axis=1)
+        weights /= np.sqrt(degree)[:, np.newaxis] * np.sqrt(self.degree[index_dim1])
+
+        # sum_j S(x, j) u_i(j) for each eigenvector
+        coordinates = np.einsum('nk,ink->in', weights, self.eigenvectors[:, index_dim1])
+
+        return coordinates / (1. - self.eigenvalues[:, np.newaxis] - 1. / degree[np.newaxis, :])
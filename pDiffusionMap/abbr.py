@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from pDiffusionMap import Graph, util
 
@@ -7,7 +9,8 @@ def update_nearest_neighbors(data_source, dataset_dim0, data_num,
                              batch_idx_dim1, bool_mask_1d, data_std_dim0,
                              data_mean_dim0, holder_size,
                              idx_to_keep_dim1, val_to_keep,
-                             zeros_mean_shift, normalize_by_std):
+                             zeros_mean_shift, normalize_by_std, dataset_dim1=None,
+                             recheck_tolerance=None, standardize=False, projection=None):
     """
     This is an abbreviation of the original flow for to find the nearest neighbors.
 
@@ -29,40 +32,298 @@ def update_nearest_neighbors(data_source, dataset_dim0, data_num,
                              the mean value becomes zero
     :param normalize_by_std: Boolean value. Whether to normalize the pattern so that after the normalization,
                              the standard deviation becomes 1.
+    :param dataset_dim1: The masked dataset along dimension 1 if it has been loaded already.
+                         If this is None, the batch is loaded here.
+    :param recheck_tolerance: The relative tolerance to check the float32 candidates again in float64.
+                              None derives it from the pattern length with get_recheck_tolerance.
+    :param standardize: Boolean value. Whether the patterns are standardized when they are loaded. In this
+                        case, zeros_mean_shift and normalize_by_std should be False.
+    :param projection: The projection matrix from fit_projection or None.
     :return: None
     """
-    # Data number for this patch along dimension 1
-    data_num_dim1 = data_source.batch_num_list_dim1[batch_idx_dim1]
+    # Global index range for this patch along dimension 1
     global_idx_start = data_source.batch_global_idx_range_dim1[batch_idx_dim1, 0]
     global_idx_end = data_source.batch_global_idx_range_dim1[batch_idx_dim1, 1]
 
-    # Construct the data along dimension 1
-    info_holder_dim1 = data_source.batch_ends_local_dim1[batch_idx_dim1]
+    # Load the data along dimension 1
+    if dataset_dim1 is None:
+        dataset_dim1 = get_masked_batch_dim1(data_source=data_source,
+                                             batch_idx_dim1=batch_idx_dim1,
+                                             data_shape=data_shape,
+                                             bool_mask_1d=bool_mask_1d,
+                                             dtype=dataset_dim0.dtype,
+                                             standardize=standardize,
+                                             projection=projection)
+
+    # Calculate the correlation matrix.
+    inner_prod_matrix = get_inner_product_tile(dataset_dim0=dataset_dim0,
+                                               dataset_dim1=dataset_dim1,
+                                               data_std_dim0=data_std_dim0,
+                                               data_mean_dim0=data_mean_dim0,
+                                               data_std_dim1=std_all[global_idx_start:global_idx_end],
+                                               data_mean_dim1=mean_all[global_idx_start:global_idx_end],
+                                               bool_mask_1d=bool_mask_1d,
+                                               zeros_mean_shift=zeros_mean_shift,
+                                               normalize_by_std=normalize_by_std,
+                                               standardize=standardize)
+
+    # Merge the new values into the nearest neighbors
+    update_top_k_tile(inner_prod_matrix=inner_prod_matrix,
+                      dataset_dim0=dataset_dim0,
+                      dataset_dim1=dataset_dim1,
+                      data_std_dim0=data_std_dim0,
+                      data_mean_dim0=data_mean_dim0,
+                      data_std_dim1=std_all[global_idx_start:global_idx_end],
+                      data_mean_dim1=mean_all[global_idx_start:global_idx_end],
+                      bool_mask_1d=bool_mask_1d,
+                      zeros_mean_shift=zeros_mean_shift,
+                      normalize_by_std=normalize_by_std,
+                      idx_start=global_idx_start,
+                      idx_to_keep_dim1=idx_to_keep_dim1,
+                      val_to_keep=val_to_keep,
+                      holder_size=holder_size,
+                      recheck_tolerance=recheck_tolerance,
+                      standardize=standardize)
+
+
+def update_nearest_neighbors_symmetric(dataset_dim0, dataset_dim1,
+                                       global_idx_range_dim0, global_idx_range_dim1,
+                                       neighbor_number, bool_mask_1d,
+                                       data_std_dim0, data_mean_dim0,
+                                       data_std_dim1, data_mean_dim1, holder_size,
+                                       idx_to_keep_dim1, val_to_keep,
+                                       zeros_mean_shift, normalize_by_std, recheck_tolerance=None,
+                                       standardize=False):
+    """
+    Process the tile (batch dim0, batch dim1) of the symmetric similarity matrix only once.
+
+    The nearest neighbors of the patterns along dimension 0 are updated in place. The nearest
+    neighbors that the patterns along dimension 1 find in this tile, i.e. in the mirror tile
+    (batch dim1, batch dim0), are returned so that they can be sent to the process holding
+    the batch along dimension 1.
 
-    # Create dask arrays based on these h5 files
-    dataset_dim1 = np.reshape(util.h5_dataloader(batch_dict=info_holder_dim1,
-                                                 pattern_number=data_num_dim1,
-                                                 pattern_shape=data_shape),
-                              (data_num_dim1, np.prod(data_shape)))
-    # Apply the mask
-    dataset_dim1 = dataset_dim1[:, bool_mask_1d]
+    :param dataset_dim0: The masked dataset along dimension 0
+    :param dataset_dim1: The masked dataset along dimension 1
+    :param global_idx_range_dim0: [starting global index, ending global index] of the dimension 0 batch.
+    :param global_idx_range_dim1: [starting global index, ending global index] of the dimension 1 batch.
+    :param neighbor_number: The number of neighbors to keep.
+    :param bool_mask_1d: The 1D boolean mask
+    :param data_std_dim0: The standard deviation of the dimension 0 batch.
+    :param data_mean_dim0: The mean values of the dimension 0 batch.
+    :param data_std_dim1: The standard deviation of the dimension 1 batch.
+    :param data_mean_dim1: The mean values of the dimension 1 batch.
+    :param holder_size: The size of the following two holders.
+    :param idx_to_keep_dim1: The holder for the indexes
+    :param val_to_keep: The holder for the values.
+    :param zeros_mean_shift: Boolean value. Whether to shift the pattern in general so that after the shift,
+                             the mean value becomes zero
+    :param normalize_by_std: Boolean value. Whether to normalize the pattern so that after the normalization,
+                             the standard deviation becomes 1.
+    :param recheck_tolerance: The relative tolerance to check the float32 candidates again in float64.
+                              None derives it from the pattern length with get_recheck_tolerance.
+    :param standardize: Boolean value. Whether the patterns are standardized when they are loaded.
+    :return: None if this is a diagonal tile. Otherwise, the holders (idx_to_keep, val_to_keep) of the
+             patterns along dimension 1.
+    """
+    data_num_dim1 = global_idx_range_dim1[1] - global_idx_range_dim1[0]
 
     # Calculate the correlation matrix.
-    inner_prod_matrix = np.dot(dataset_dim0, np.transpose(dataset_dim1)) / float(bool_mask_1d.shape[0])
+    inner_prod_matrix = get_inner_product_tile(dataset_dim0=dataset_dim0,
+                                               dataset_dim1=dataset_dim1,
+                                               data_std_dim0=data_std_dim0,
+                                               data_mean_dim0=data_mean_dim0,
+                                               data_std_dim1=data_std_dim1,
+                                               data_mean_dim1=data_mean_dim1,
+                                               bool_mask_1d=bool_mask_1d,
+                                               zeros_mean_shift=zeros_mean_shift,
+                                               normalize_by_std=normalize_by_std,
+                                               standardize=standardize)
+
+    # Update the holders along dimension 0
+    update_top_k_tile(inner_prod_matrix=inner_prod_matrix,
+                      dataset_dim0=dataset_dim0,
+                      dataset_dim1=dataset_dim1,
+                      data_std_dim0=data_std_dim0,
+                      data_mean_dim0=data_mean_dim0,
+                      data_std_dim1=data_std_dim1,
+                      data_mean_dim1=data_mean_dim1,
+                      bool_mask_1d=bool_mask_1d,
+                      zeros_mean_shift=zeros_mean_shift,
+                      normalize_by_std=normalize_by_std,
+                      idx_start=global_idx_range_dim1[0],
+                      idx_to_keep_dim1=idx_to_keep_dim1,
+                      val_to_keep=val_to_keep,
+                      holder_size=holder_size,
+                      recheck_tolerance=recheck_tolerance,
+                      standardize=standardize)
+
+    if global_idx_range_dim0[0] == global_idx_range_dim1[0]:
+        # The diagonal tile is its own mirror.
+        return None
+
+    # Use the transposed tile to get the nearest neighbors of the patterns along dimension 1
+    holder_size_dim1 = np.array([data_num_dim1, neighbor_number], dtype=np.int64)
+    idx_to_keep_dim1_mirror = np.zeros((data_num_dim1, neighbor_number), dtype=np.int64)
+    val_to_keep_mirror = (-2e+100) * np.ones((data_num_dim1, neighbor_number), dtype=np.float64)
+
+    update_top_k_tile(inner_prod_matrix=np.transpose(inner_prod_matrix),
+                      dataset_dim0=dataset_dim1,
+                      dataset_dim1=dataset_dim0,
+                      data_std_dim0=data_std_dim1,
+                      data_mean_dim0=data_mean_dim1,
+                      data_std_dim1=data_std_dim0,
+                      data_mean_dim1=data_mean_dim0,
+                      bool_mask_1d=bool_mask_1d,
+                      zeros_mean_shift=zeros_mean_shift,
+                      normalize_by_std=normalize_by_std,
+                      idx_start=global_idx_range_dim0[0],
+                      idx_to_keep_dim1=idx_to_keep_dim1_mirror,
+                      val_to_keep=val_to_keep_mirror,
+                      holder_size=holder_size_dim1,
+                      recheck_tolerance=recheck_tolerance,
+                      standardize=standardize)
+
+    return idx_to_keep_dim1_mirror, val_to_keep_mirror
+
+
+def get_masked_batch_dim1(data_source, batch_idx_dim1, data_shape, bool_mask_1d, pattern_cache=None,
+                          dtype=np.float64, standardize=False, projection=None):
+    """
+    Load the batch along dimension 1 and apply the mask.
+
+    :param data_source: The data_source object.
+    :param batch_idx_dim1: The batch index along dimension 1
+    :param data_shape: The shape of each pattern.
+    :param bool_mask_1d: The 1D boolean mask
+    :param pattern_cache: The memory-mapped pattern cache created by build_pattern_cache. If this is
+                          not None, the batch is a slice of the cache rather than read from the h5 files.
+    :param dtype: The dtype of the returned dataset.
+    :param standardize: Boolean value. Whether to standardize the patterns with standardize_patterns. This
+                        is ignored for the pattern_cache which is standardized when it is built.
+    :param projection: The projection matrix from fit_projection or None. This is ignored for the
+                       pattern_cache which is projected when it is built.
+    :return: The masked dataset of the shape [data number, pixel number or projection dimension]
+    """
+    if pattern_cache is not None:
+        global_idx_start, global_idx_end = data_source.batch_global_idx_range_dim1[batch_idx_dim1]
+        if pattern_cache.dtype == dtype:
+            return pattern_cache[global_idx_start:global_idx_end]
+        return np.array(pattern_cache[global_idx_start:global_idx_end], dtype=dtype)
+
+    data_num_dim1 = data_source.batch_num_list_dim1[batch_idx_dim1]
+    raw = not standardize and projection is None
+
+    # Load only the unmasked pixels. The mean and std are calculated while loading if they are needed.
+    stat_holder = None if raw else np.empty((2, data_num_dim1), dtype=np.float64)
+    dataset_dim1 = util.h5_masked_dataloader(batch_dict=data_source.batch_ends_local_dim1[batch_idx_dim1],
+                                             pattern_number=data_num_dim1,
+                                             pattern_shape=data_shape,
+                                             bool_mask_1d=bool_mask_1d,
+                                             dtype=dtype if raw else np.float64,
+                                             stat_holder=stat_holder)
+    if raw:
+        return dataset_dim1
+    return prepare_patterns(dataset=dataset_dim1, dtype=dtype, standardize=standardize, projection=projection,
+                            data_mean=stat_holder[0], data_std=stat_holder[1])[0]
+
+
+def get_masked_batches_dim1(data_source, batch_idx_list, data_shape, bool_mask_1d, prefetch,
+                            pattern_cache=None, dtype=np.float64, standardize=False, projection=None):
+    """
+    Iterate through the batches along dimension 1 and yield the masked datasets.
+
+    If prefetch is True, the next batch is loaded and masked in a background thread while the
+    caller processes the current one. Since numpy releases the GIL in np.dot, reading the h5 files
+    overlaps with the calculation of the inner product. At most two batches are held in memory.
+
+    :param data_source: The data_source object.
+    :param batch_idx_list: The batch indexes along dimension 1 to load in order.
+    :param data_shape: The shape of each pattern.
+    :param bool_mask_1d: The 1D boolean mask
+    :param prefetch: Boolean value. Whether to load the next batch in the background.
+    :param pattern_cache: The memory-mapped pattern cache created by build_pattern_cache or None.
+    :param dtype: The dtype of the masked datasets.
+    :param standardize: Boolean value. Whether to standardize the patterns with standardize_patterns.
+    :param projection: The projection matrix from fit_projection or None.
+    :return: A generator yielding (batch_idx_dim1, masked dataset)
+    """
+    batch_idx_list = list(batch_idx_list)
+
+    if not prefetch:
+        for batch_idx_dim1 in batch_idx_list:
+            yield batch_idx_dim1, get_masked_batch_dim1(data_source=data_source,
+                                                        batch_idx_dim1=batch_idx_dim1,
+                                                        data_shape=data_shape,
+                                                        bool_mask_1d=bool_mask_1d,
+                                                        pattern_cache=pattern_cache,
+                                                        dtype=dtype,
+                                                        standardize=standardize,
+                                                        projection=projection)
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = None
+        for l in range(len(batch_idx_list)):
+            if future is None:
+                future = executor.submit(get_masked_batch_dim1, data_source, batch_idx_list[l],
+                                         data_shape, bool_mask_1d, pattern_cache, dtype, standardize,
+                                         projection)
+            dataset_dim1 = future.result()
+
+            # Start to load the next batch before handing over the current one.
+            if l + 1 < len(batch_idx_list):
+                future = executor.submit(get_masked_batch_dim1, data_source, batch_idx_list[l + 1],
+                                         data_shape, bool_mask_1d, pattern_cache, dtype, standardize,
+                                         projection)
+
+            yield batch_idx_list[l], dataset_dim1
+
+
+def get_inner_product_denominator(bool_mask_1d, standardize):
+    """
+    Get the number that the inner product between two masked patterns is divided by.
 
-    ################################################################################################################
-    #   Finish the calculation of a non diagonal term. Clean things up
-    ################################################################################################################
+    The standardized patterns have zero mean and unit standard deviation over the unmasked pixels.
+    Therefore, their inner product is divided by the number of the unmasked pixels. Otherwise, the
+    inner product is divided by the number of pixels as in the original flow.
 
-    # Construct the global index for each entry along dimension 1
-    aux_dim1_index = np.outer(np.ones(data_num, dtype=np.int64), np.arange(global_idx_start - neighbor_number,
-                                                                           global_idx_end, dtype=np.int64))
-    # Store the index for the entry from the last iteration
-    aux_dim1_index[:, :neighbor_number] = idx_to_keep_dim1
+    :param bool_mask_1d: The 1D boolean mask
+    :param standardize: Boolean value. Whether the patterns are standardized when they are loaded.
+    :return: The denominator as a float.
+    """
+    if standardize:
+        return float(np.sum(bool_mask_1d))
+    return float(bool_mask_1d.shape[0])
+
+
+def get_inner_product_tile(dataset_dim0, dataset_dim1, data_std_dim0, data_mean_dim0,
+                           data_std_dim1, data_mean_dim1, bool_mask_1d,
+                           zeros_mean_shift, normalize_by_std, standardize=False):
+    """
+    Calculate the inner product between the patterns along dimension 0 and dimension 1 and
+    then shift and normalize it according to the configuration.
+
+    :param dataset_dim0: The masked dataset along dimension 0
+    :param dataset_dim1: The masked dataset along dimension 1
+    :param data_std_dim0: The standard deviation of the dimension 0 batch.
+    :param data_mean_dim0: The mean values of the dimension 0 batch.
+    :param data_std_dim1: The standard deviation of the dimension 1 batch.
+    :param data_mean_dim1: The mean values of the dimension 1 batch.
+    :param bool_mask_1d: The 1D boolean mask
+    :param zeros_mean_shift: Boolean value. Whether to shift the pattern in general so that after the shift,
+                             the mean value becomes zero
+    :param normalize_by_std: Boolean value. Whether to normalize the pattern so that after the normalization,
+                             the standard deviation becomes 1.
+    :param standardize: Boolean value. Whether the patterns are standardized when they are loaded. In this
+                        case, the inner product is divided by the number of the unmasked pixels so that
+                        it is the Pearson correlation. Otherwise, it is divided by the number of pixels.
+    :return: The inner product matrix of the shape [data number dim0, data number dim1]
+    """
+    matrix_shape = np.array([dataset_dim0.shape[0], dataset_dim1.shape[0]], dtype=np.int64)
 
-    # prepare some auxiliary variables for later process
-    data_std_dim1 = std_all[global_idx_start:global_idx_end]
-    data_mean_dim1 = mean_all[global_idx_start:global_idx_end]
+    # Calculate the correlation matrix.
+    inner_prod_matrix = np.dot(dataset_dim0, np.transpose(dataset_dim1)) / get_inner_product_denominator(
+        bool_mask_1d=bool_mask_1d, standardize=standardize)
 
     if zeros_mean_shift:
         if normalize_by_std:
@@ -72,43 +333,205 @@ def update_nearest_neighbors(data_source, dataset_dim0, data_num,
                                           std_dim1=data_std_dim1,
                                           mean_dim0=data_mean_dim0,
                                           mean_dim1=data_mean_dim1,
-                                          matrix_shape=np.array([data_num, data_num_dim1]))
+                                          matrix_shape=matrix_shape)
         else:
             # Shift the inner product matrix
             Graph.shift(matrix=inner_prod_matrix,
                         mean_dim0=data_mean_dim0,
                         mean_dim1=data_mean_dim1,
-                        matrix_shape=np.array([data_num, data_num_dim1]))
+                        matrix_shape=matrix_shape)
     else:
         if normalize_by_std:
             # Normalize the inner product matrix
             Graph.normalization(matrix=inner_prod_matrix,
                                 std_dim0=data_std_dim0,
                                 std_dim1=data_std_dim1,
-                                matrix_shape=np.array([data_num, data_num_dim1]))
+                                matrix_shape=matrix_shape)
         else:
             pass
 
-    # Put previously selected values together with the new value and do the sort
-    inner_prod_matrix = np.concatenate((val_to_keep, inner_prod_matrix), axis=1)
+    return inner_prod_matrix
+
 
-    # Find the local index of the largest values
-    idx_pre_dim1 = np.argsort(a=inner_prod_matrix, axis=1)[:, :-(neighbor_number + 1):-1]
+def get_recheck_tolerance(pattern_length, factor=10.):
+    """
+    Get the relative tolerance to check the float32 candidates again in float64.
 
-    # Turn the local index into global index
-    Graph.get_values_int(source=aux_dim1_index,
-                         indexes=idx_pre_dim1,
-                         holder=idx_to_keep_dim1,
-                         holder_size=holder_size)
+    The rounding errors of the float32 inner product of two patterns add up like a random walk. Relative
+    to the upper bound of the absolute value, the error is therefore about sqrt(pattern_length) * eps of
+    float32. The factor leaves a margin above this typical error.
 
-    # Calculate the largest values
-    Graph.get_values_float(source=inner_prod_matrix,
-                           indexes=idx_pre_dim1,
-                           holder=val_to_keep,
+    :param pattern_length: The length of each pattern, i.e. the number of unmasked pixels or the
+                           dimension of the projection.
+    :param factor: The safety factor.
+    :return: factor * sqrt(pattern_length) * eps of float32
+    """
+    return float(factor * np.sqrt(pattern_length) * np.finfo(np.float32).eps)
+
+
+def update_top_k_tile(inner_prod_matrix, dataset_dim0, dataset_dim1, data_std_dim0, data_mean_dim0,
+                      data_std_dim1, data_mean_dim1, bool_mask_1d, zeros_mean_shift, normalize_by_std,
+                      idx_start, idx_to_keep_dim1, val_to_keep, holder_size, recheck_tolerance,
+                      standardize=False):
+    """
+    Merge the tile of the inner product matrix into the holders of the nearest neighbors.
+
+    If the tile is calculated in float32, the candidates close to the smallest kept value are
+    calculated again in float64 so that the nearest neighbors and their values are the same as those
+    of a float64 calculation.
+
+    :param inner_prod_matrix: The tile returned by get_inner_product_tile.
+    :param dataset_dim0: The masked dataset along dimension 0
+    :param dataset_dim1: The masked dataset along dimension 1
+    :param data_std_dim0: The standard deviation of the dimension 0 batch.
+    :param data_mean_dim0: The mean values of the dimension 0 batch.
+    :param data_std_dim1: The standard deviation of the dimension 1 batch.
+    :param data_mean_dim1: The mean values of the dimension 1 batch.
+    :param bool_mask_1d: The 1D boolean mask
+    :param zeros_mean_shift: Boolean value. Whether to shift the pattern in general so that after the shift,
+                             the mean value becomes zero
+    :param normalize_by_std: Boolean value. Whether to normalize the pattern so that after the normalization,
+                             the standard deviation becomes 1.
+    :param idx_start: The global index of the first column of the tile.
+    :param idx_to_keep_dim1: The holder for the indexes
+    :param val_to_keep: The holder for the values.
+    :param holder_size: The size of the two holders.
+    :param recheck_tolerance: The relative tolerance to check the float32 candidates again in float64.
+                              None derives it from the pattern length with get_recheck_tolerance.
+    :param standardize: Boolean value. Whether the patterns are standardized when they are loaded.
+    :return: None
+    """
+    if inner_prod_matrix.dtype == np.float64:
+        Graph.update_top_k(matrix=inner_prod_matrix,
+                           idx_start=idx_start,
+                           idx_holder=idx_to_keep_dim1,
+                           val_holder=val_to_keep,
                            holder_size=holder_size)
+        return
+
+    if recheck_tolerance is None:
+        recheck_tolerance = get_recheck_tolerance(pattern_length=dataset_dim0.shape[1])
+    denominator = get_inner_product_denominator(bool_mask_1d=bool_mask_1d, standardize=standardize)
+
+    # The shift and the normalization used by get_inner_product_tile
+    if zeros_mean_shift:
+        mean_dim0 = np.asarray(data_mean_dim0, dtype=np.float64)
+        mean_dim1 = np.asarray(data_mean_dim1, dtype=np.float64)
+    else:
+        mean_dim0 = np.zeros(dataset_dim0.shape[0], dtype=np.float64)
+        mean_dim1 = np.zeros(dataset_dim1.shape[0], dtype=np.float64)
+    if normalize_by_std:
+        std_dim0 = np.asarray(data_std_dim0, dtype=np.float64)
+        std_dim1 = np.asarray(data_std_dim1, dtype=np.float64)
+    else:
+        std_dim0 = np.ones(dataset_dim0.shape[0], dtype=np.float64)
+        std_dim1 = np.ones(dataset_dim1.shape[0], dtype=np.float64)
+
+    # By the Cauchy-Schwarz inequality, |value| <= scale_dim0[l] * scale_dim1[m].
+    # The rounding error of the float32 value is proportional to this bound.
+    scale_dim0 = np.sqrt(np.einsum('ij,ij->i', dataset_dim0, dataset_dim0, dtype=np.float64) / denominator) / std_dim0
+    scale_dim1 = np.sqrt(np.einsum('ij,ij->i', dataset_dim1, dataset_dim1, dtype=np.float64) / denominator) / std_dim1
+
+    Graph.update_top_k_with_recheck(matrix=inner_prod_matrix,
+                                    dataset_dim0=dataset_dim0,
+                                    dataset_dim1=dataset_dim1,
+                                    mean_dim0=mean_dim0,
+                                    mean_dim1=mean_dim1,
+                                    std_dim0=std_dim0,
+                                    std_dim1=std_dim1,
+                                    scale_dim0=scale_dim0,
+                                    scale_dim1=scale_dim1,
+                                    denominator=denominator,
+                                    tolerance=recheck_tolerance,
+                                    idx_start=idx_start,
+                                    idx_holder=idx_to_keep_dim1,
+                                    val_holder=val_to_keep,
+                                    holder_size=holder_size)
+
+
+def merge_nearest_neighbors(values, indexes, holder_size, idx_to_keep_dim1, val_to_keep):
+    """
+    Merge the candidates into the holders of the nearest neighbors.
+
+    :param values: The values of the candidates. The shape is [holder_size[0], candidate number]
+    :param indexes: The global index of each candidate. It has the same shape as values.
+    :param holder_size: The size of the following two holders.
+    :param idx_to_keep_dim1: The holder for the indexes
+    :param val_to_keep: The holder for the values.
+    :return: None
+    """
+    Graph.merge_top_k(values=values,
+                      indexes=indexes,
+                      idx_holder=idx_to_keep_dim1,
+                      val_holder=val_to_keep,
+                      holder_size=holder_size)
 
 
-def get_data_and_stat(batch_info, maskfile, data_num, data_shape):
+def get_pattern_mean_and_std(dataset):
+    """
+    Calculate the mean value and the standard deviation of each pattern in float64 in a single pass.
+
+    :param dataset: The masked dataset of the shape [data number, pixel number]
+    :return: data_mean, data_std
+    """
+    data_mean = np.empty(dataset.shape[0], dtype=np.float64)
+    data_std = np.empty(dataset.shape[0], dtype=np.float64)
+    if dataset.dtype != np.float32:
+        dataset = np.asarray(dataset, dtype=np.float64)
+    Graph.pattern_mean_and_std(dataset, data_mean, data_std)
+    return data_mean, data_std
+
+
+def standardize_patterns(dataset, dtype=np.float64, data_mean=None, data_std=None):
+    """
+    Shift and normalize each pattern so that its mean value is 0 and its standard deviation is 1.
+    The inner product of two standardized patterns divided by the pixel number is then the Pearson
+    correlation coefficient. The calculation is done in float64 before the patterns are cast to dtype.
+
+    :param dataset: The masked dataset of the shape [data number, pixel number]
+    :param dtype: The dtype of the returned dataset.
+    :param data_mean: The mean value of each pattern if it is calculated already, e.g. by the loader.
+    :param data_std: The standard deviation of each pattern if it is calculated already.
+    :return: standardized_dataset, data_mean, data_std. The mean and std are those of the original patterns.
+    """
+    dataset = np.asarray(dataset, dtype=np.float64)
+    if data_mean is None or data_std is None:
+        data_mean, data_std = get_pattern_mean_and_std(dataset=dataset)
+
+    dataset = (dataset - data_mean[:, np.newaxis]) / data_std[:, np.newaxis]
+
+    return dataset.astype(dtype), data_mean, data_std
+
+
+def prepare_patterns(dataset, dtype=np.float64, standardize=False, projection=None, data_mean=None, data_std=None):
+    """
+    Calculate the mean and std of the masked patterns. Then standardize and project the patterns
+    if requested.
+
+    :param dataset: The masked dataset of the shape [data number, pixel number]
+    :param dtype: The dtype of the returned dataset.
+    :param standardize: Boolean value. Whether to standardize the patterns with standardize_patterns.
+    :param projection: The projection matrix from fit_projection or None.
+    :param data_mean: The mean value of each pattern if it is calculated already, e.g. by the loader.
+    :param data_std: The standard deviation of each pattern if it is calculated already.
+    :return: prepared_dataset, data_mean, data_std. The mean and std are those of the original patterns.
+    """
+    if standardize:
+        dataset, data_mean, data_std = standardize_patterns(dataset=dataset,
+                                                            dtype=np.float64 if projection is not None else dtype,
+                                                            data_mean=data_mean,
+                                                            data_std=data_std)
+    elif data_mean is None or data_std is None:
+        data_mean, data_std = get_pattern_mean_and_std(dataset=dataset)
+
+    if projection is not None:
+        dataset = np.dot(np.asarray(dataset, dtype=np.float64), projection)
+
+    return np.asarray(dataset, dtype=dtype), data_mean, data_std
+
+
+def get_data_and_stat(batch_info, maskfile, data_num, data_shape, pattern_cache=None, global_idx_range=None,
+                      dtype=np.float64, pattern_stat=None, standardize=False, projection=None):
     """
     Use the batch_info to load the data along dimension 0 and calculate the mean value and standard deviation
     of each pattern.
@@ -116,23 +539,833 @@ def get_data_and_stat(batch_info, maskfile, data_num, data_shape):
     :param maskfile: A string containing the address of the numpy array
     :param data_num: Number of patterns in this batch.
     :param data_shape: Shape of each pattern
+    :param pattern_cache: The memory-mapped pattern cache created by build_pattern_cache. If this is
+                          not None, the masked patterns are copied from the cache.
+    :param global_idx_range: [starting global index, ending global index] of this batch. This is only
+                             used together with the pattern_cache.
+    :param dtype: The dtype of the returned dataset. The mean and std are always calculated in float64.
+    :param pattern_stat: The mean and std returned by build_pattern_cache together with the pattern_cache.
+    :param standardize: Boolean value. Whether to standardize the patterns with standardize_patterns. This
+                        is ignored for the pattern_cache which is standardized when it is built.
+    :param projection: The projection matrix from fit_projection or None. This is ignored for the
+                       pattern_cache which is projected when it is built.
     :return: reshaped_data_of_this_batch, data_mean, data_std, bool_mask_1d
     """
-    # Load data
-    dataset = util.h5_dataloader(batch_dict=batch_info,
-                                 pattern_number=data_num,
-                                 pattern_shape=data_shape)
-    dataset = dataset.reshape((data_num, np.prod(data_shape)))
-
     # Load the mask
     mask = np.load(maskfile)
     bool_mask_1d = util.get_bool_mask_1d(mask=mask)
-    # Apply the mask to the dataset_dim0
-    dataset = dataset[:, bool_mask_1d]
 
-    # Calculate the mean value of each pattern of the vector
-    data_mean = np.mean(dataset, axis=-1)
-    # Calculate the standard deviation of each pattern of the vector
-    data_std = np.std(dataset, axis=-1)
+    if pattern_cache is not None:
+        dataset = np.array(pattern_cache[global_idx_range[0]:global_idx_range[1]], dtype=dtype)
+        data_mean = np.array(pattern_stat[0, global_idx_range[0]:global_idx_range[1]])
+        data_std = np.array(pattern_stat[1, global_idx_range[0]:global_idx_range[1]])
+        return dataset, data_mean, data_std, bool_mask_1d, mask
+
+    # Load only the unmasked pixels of the data and calculate the mean value and the standard deviation
+    # of each pattern in the same pass
+    stat_holder = np.empty((2, data_num), dtype=np.float64)
+    dataset = util.h5_masked_dataloader(batch_dict=batch_info,
+                                        pattern_number=data_num,
+                                        pattern_shape=data_shape,
+                                        bool_mask_1d=bool_mask_1d,
+                                        dtype=dtype if not standardize and projection is None else np.float64,
+                                        stat_holder=stat_holder)
+
+    dataset, data_mean, data_std = prepare_patterns(dataset=dataset, dtype=dtype,
+                                                    standardize=standardize, projection=projection,
+                                                    data_mean=stat_holder[0], data_std=stat_holder[1])
 
     return dataset, data_mean, data_std, bool_mask_1d, mask
+
+
+def build_pattern_cache(node_comm, data_source, data_shape, bool_mask_1d, cache_file, stat_file, dtype,
+                        standardize=False, projection=None):
+    """
+    Create a node-local cache containing all the masked patterns in the specified dtype.
+
+    All the processes on the same node share one cache file. Each of them reads a share of the
+    batches along dimension 1 from the h5 files and writes them into the cache. Afterwards, the
+    processes read the patterns from the memory-mapped cache so that the dataset is only read
+    from the h5 files once per node.
+
+    :param node_comm: The MPI communicator of the processes on this node.
+    :param data_source: The data_source object with batches.
+    :param data_shape: The shape of each pattern.
+    :param bool_mask_1d: The 1D boolean mask
+    :param cache_file: The address of the .npy cache file. This should be on a node-local disk.
+    :param stat_file: The address of the .npy file to hold the mean and std of each pattern.
+    :param dtype: The dtype of the patterns in the cache.
+    :param standardize: Boolean value. Whether to store the patterns standardized with standardize_patterns.
+    :param projection: The projection matrix from fit_projection or None. If this is not None, the
+                       projected patterns are stored.
+    :return: pattern_cache, pattern_stat. The pattern_cache is the memory-mapped cache of the shape
+             [total data number, unmasked pixel number or projection dimension]. It is opened
+             copy-on-write so that the slices can be passed to the numba kernels. Nothing is written
+             to it. The pattern_stat of the shape [2, total data number] contains the mean and std of
+             the original patterns.
+    """
+    node_rank = node_comm.Get_rank()
+    node_size = node_comm.Get_size()
+    data_num_total = int(data_source.data_num_total)
+    if projection is None:
+        cache_shape = (data_num_total, int(np.sum(bool_mask_1d)))
+    else:
+        cache_shape = (data_num_total, int(projection.shape[1]))
+
+    if node_rank == 0:
+        pattern_cache = np.lib.format.open_memmap(cache_file, mode='w+', dtype=dtype, shape=cache_shape)
+        pattern_stat = np.lib.format.open_memmap(stat_file, mode='w+', dtype=np.float64, shape=(2, data_num_total))
+        del pattern_cache, pattern_stat
+    node_comm.Barrier()  # Synchronize
+
+    pattern_cache = np.load(cache_file, mmap_mode='r+')
+    pattern_stat = np.load(stat_file, mmap_mode='r+')
+    for batch_idx_dim1 in range(node_rank, len(data_source.batch_num_list_dim1), node_size):
+        global_idx_start, global_idx_end = data_source.batch_global_idx_range_dim1[batch_idx_dim1]
+        stat_holder = np.empty((2, global_idx_end - global_idx_start), dtype=np.float64)
+        dataset = util.h5_masked_dataloader(batch_dict=data_source.batch_ends_local_dim1[batch_idx_dim1],
+                                            pattern_number=global_idx_end - global_idx_start,
+                                            pattern_shape=data_shape,
+                                            bool_mask_1d=bool_mask_1d,
+                                            stat_holder=stat_holder)
+        dataset, data_mean, data_std = prepare_patterns(dataset=dataset, dtype=dtype,
+                                                        standardize=standardize, projection=projection,
+                                                        data_mean=stat_holder[0], data_std=stat_holder[1])
+
+        pattern_cache[global_idx_start:global_idx_end] = dataset
+        pattern_stat[0, global_idx_start:global_idx_end] = data_mean
+        pattern_stat[1, global_idx_start:global_idx_end] = data_std
+    pattern_cache.flush()
+    pattern_stat.flush()
+    del pattern_cache, pattern_stat
+    node_comm.Barrier()  # Synchronize
+
+    return np.load(cache_file, mmap_mode='c'), np.load(stat_file, mmap_mode='r')
+
+
+def get_pattern_stat(data_source, data_shape, mask, stat_file):
+    """
+    Get the mean and std of all the patterns.
+
+    They are loaded from the stat_file if it has been saved for the same datasets in the same unchanged
+    files with the same mask, e.g. by WeightMat.py. Otherwise, the patterns are read batch by batch along
+    dimension 1. The statistics are calculated while the patterns are loaded and saved into the stat_file.
+
+    :param data_source: The data_source object with batches.
+    :param data_shape: The shape of each pattern.
+    :param mask: The numpy mask.
+    :param stat_file: The h5 file from util.get_pattern_stat_file.
+    :return: means, std of the shape [total data number]
+    """
+    signature = util.get_pattern_stat_signature(source_dict=data_source.source_dict, mask=mask)
+    pattern_stat = util.load_pattern_stat(stat_file=stat_file, signature=signature)
+    if pattern_stat is not None:
+        return pattern_stat
+
+    bool_mask_1d = util.get_bool_mask_1d(mask=mask)
+    stat_holder = np.empty((2, int(data_source.data_num_total)), dtype=np.float64)
+    for batch_idx_dim1 in range(len(data_source.batch_num_list_dim1)):
+        global_idx_start, global_idx_end = data_source.batch_global_idx_range_dim1[batch_idx_dim1]
+        util.h5_masked_dataloader(batch_dict=data_source.batch_ends_local_dim1[batch_idx_dim1],
+                                  pattern_number=global_idx_end - global_idx_start,
+                                  pattern_shape=data_shape,
+                                  bool_mask_1d=bool_mask_1d,
+                                  stat_holder=stat_holder[:, global_idx_start:global_idx_end])
+
+    util.save_pattern_stat(stat_file=stat_file, means=stat_holder[0], std=stat_holder[1], mask=mask,
+                           signature=signature)
+    return stat_holder[0], stat_holder[1]
+
+
+##################################################################
+#
+#       Projection
+#
+##################################################################
+def fit_projection(comm, data_source, data_shape, bool_mask_1d, method, dimension, seed, oversampling=10):
+    """
+    Fit a linear projection of the standardized patterns to fewer dimensions. The inner product of
+    two projected patterns approximates that of the original standardized patterns.
+
+    gaussian: A random Gaussian matrix scaled by 1/sqrt(dimension). Nothing is read.
+    randomized_svd: The leading right singular vectors of the standardized dataset, which is read
+                    twice. Each process reads a share of the batches along dimension 1 and only the
+                    small matrices are summed over the processes.
+
+    :param comm: The MPI communicator. This has to be called by all processes.
+    :param data_source: The data_source object with batches.
+    :param data_shape: The shape of each pattern.
+    :param bool_mask_1d: The 1D boolean mask
+    :param method: "gaussian" or "randomized_svd"
+    :param dimension: The dimension of the projected patterns.
+    :param seed: The seed of the random matrices.
+    :param oversampling: The number of extra random vectors for the randomized SVD.
+    :return: The projection matrix of the shape [unmasked pixel number, dimension]. It is the same on
+             all processes.
+    """
+    pixel_num = int(np.sum(bool_mask_1d))
+    if dimension >= pixel_num:
+        raise Exception("The projection dimension has to be smaller than the number of unmasked pixels.")
+
+    random_state = np.random.RandomState(seed)
+
+    if method == "gaussian":
+        # E[(x R) . (y R)] = x . y
+        return random_state.normal(size=(pixel_num, dimension)) / np.sqrt(dimension)
+
+    if method != "randomized_svd":
+        raise Exception("The projection method has to be either \"gaussian\" or \"randomized_svd\".")
+
+    comm_rank = comm.Get_rank()
+    comm_size = comm.Get_size()
+    sketch_num = min(dimension + oversampling, pixel_num)
+    batch_idx_list = list(range(comm_rank, len(data_source.batch_num_list_dim1), comm_size))
+
+    # First pass: sketch the range of the dataset Y = X Omega and its Gram matrix.
+    omega = random_state.normal(size=(pixel_num, sketch_num))
+    sketch_list = []
+    gram_local = np.zeros((sketch_num, sketch_num), dtype=np.float64)
+    for batch_idx_dim1 in batch_idx_list:
+        dataset = get_masked_batch_dim1(data_source=data_source, batch_idx_dim1=batch_idx_dim1,
+                                        data_shape=data_shape, bool_mask_1d=bool_mask_1d, standardize=True)
+        sketch_list.append(np.dot(dataset, omega))
+        gram_local += np.dot(np.transpose(sketch_list[-1]), sketch_list[-1])
+    gram = np.empty_like(gram_local)
+    comm.Allreduce(gram_local, gram)
+
+    # Orthonormalize the sketch Q = Y W / sqrt(lambda) with the eigenvectors of the Gram matrix.
+    if comm_rank == 0:
+        eigenvalues, eigenvectors = np.linalg.eigh(gram)
+        keep = eigenvalues > eigenvalues[-1] * 1e-12
+        transform = eigenvectors[:, keep] / np.sqrt(eigenvalues[keep])
+    else:
+        transform = None
+    transform = comm.bcast(transform, root=0)
+
+    # Second pass: B = Q^T X
+    range_projection_local = np.zeros((transform.shape[1], pixel_num), dtype=np.float64)
+    for l in range(len(batch_idx_list)):
+        dataset = get_masked_batch_dim1(data_source=data_source, batch_idx_dim1=batch_idx_list[l],
+                                        data_shape=data_shape, bool_mask_1d=bool_mask_1d, standardize=True)
+        range_projection_local += np.dot(np.transpose(np.dot(sketch_list[l], transform)), dataset)
+    range_projection = np.empty_like(range_projection_local)
+    comm.Allreduce(range_projection_local, range_projection)
+
+    # The right singular vectors of B approximate those of X.
+    if comm_rank == 0:
+        _, _, right_singular_vectors = np.linalg.svd(range_projection, full_matrices=False)
+        projection = np.ascontiguousarray(np.transpose(right_singular_vectors[:dimension]))
+    else:
+        projection = np.empty((pixel_num, dimension), dtype=np.float64)
+    comm.Bcast(projection, root=0)
+
+    return projection
+
+
+##################################################################
+#
+#       Task queue
+#
+##################################################################
+def task_queue_master(comm, data_source, neighbor_number, symmetric_tiling,
+                      checkpoint_prefix=None, checkpoint_interval=1, resume=False, signature=None):
+    """
+    Hand out the tiles (batch dim0, batch dim1) to the workers on demand and merge the nearest
+    neighbors sent back by the workers. Faster workers simply process more tiles.
+
+    When a worker asks for a new tile, it receives a tile of the same row batch as its last tile if
+    there is any left, so that it does not need to load the row batch again. Otherwise, it receives
+    a tile from the row batch with the most tiles left.
+
+    :param comm: The MPI communicator. This has to be called by rank 0.
+    :param data_source: The data_source object with batches.
+    :param neighbor_number: The number of neighbors to keep.
+    :param symmetric_tiling: Boolean value. Whether to only calculate one of each pair of mirror tiles.
+    :param checkpoint_prefix: The address of the checkpoint without the extension. None disables the checkpoints.
+    :param checkpoint_interval: Save a checkpoint after this number of finished tiles.
+    :param resume: Boolean value. Whether to skip the finished tiles saved in the checkpoint.
+    :param signature: A numpy array describing the calculation. See util.save_checkpoint.
+    :return: values_all, idx_dim1_all, mean_all, std_all
+    """
+    data_num_total = data_source.data_num_total
+    batch_num_dim0 = len(data_source.batch_num_list_dim0)
+    batch_num_dim1 = len(data_source.batch_num_list_dim1)
+
+    # Create the holders for the whole similarity matrix
+    idx_dim1_all = np.zeros((data_num_total, neighbor_number), dtype=np.int64)
+    values_all = (-2e+100) * np.ones((data_num_total, neighbor_number), dtype=np.float64)
+    mean_all = np.empty(data_num_total, dtype=np.float64)
+    std_all = np.empty(data_num_total, dtype=np.float64)
+
+    # Tiles left for each row batch
+    if symmetric_tiling:
+        tiles_to_process = {l: list(range(l, batch_num_dim1)) for l in range(batch_num_dim0)}
+    else:
+        tiles_to_process = {l: list(range(batch_num_dim1)) for l in range(batch_num_dim0)}
+    tile_num_total = sum([len(x) for x in tiles_to_process.values()])
+    tiles_finished = []
+
+    # Skip the tiles finished before the interruption
+    if resume:
+        checkpoints = util.load_checkpoints(checkpoint_prefix=checkpoint_prefix, signature=signature)
+        if checkpoints:
+            values_all[:] = checkpoints[0]["values_all"]
+            idx_dim1_all[:] = checkpoints[0]["idx_dim1_all"]
+            mean_all[:] = checkpoints[0]["mean_all"]
+            std_all[:] = checkpoints[0]["std_all"]
+            for batch_idx_dim0, batch_idx_dim1 in checkpoints[0]["tiles_finished"]:
+                tiles_to_process[batch_idx_dim0].remove(batch_idx_dim1)
+                tiles_finished.append((batch_idx_dim0, batch_idx_dim1))
+            print("Resume from {} finished tiles.".format(len(tiles_finished)))
+    tile_num_finished = len(tiles_finished)
+
+    # The row batch of the last tile of each worker
+    last_batch_idx_dim0 = {}
+    worker_num = comm.Get_size() - 1
+
+    while worker_num > 0:
+        worker_rank, result = comm.recv()
+
+        if result is not None:
+            (batch_idx_dim0, batch_idx_dim1,
+             idx_to_keep_dim1, val_to_keep, data_mean_dim0, data_std_dim0, mirror_holders) = result
+
+            # Merge the result of the row batch
+            start, end = data_source.batch_global_idx_range_dim0[batch_idx_dim0]
+            merge_nearest_neighbors(values=val_to_keep, indexes=idx_to_keep_dim1,
+                                    holder_size=np.array([end - start, neighbor_number], dtype=np.int64),
+                                    idx_to_keep_dim1=idx_dim1_all[start:end],
+                                    val_to_keep=values_all[start:end])
+            mean_all[start:end] = data_mean_dim0
+            std_all[start:end] = data_std_dim0
+
+            # Merge the result of the mirror tile
+            if mirror_holders is not None:
+                start, end = data_source.batch_global_idx_range_dim1[batch_idx_dim1]
+                merge_nearest_neighbors(values=mirror_holders[1], indexes=mirror_holders[0],
+                                        holder_size=np.array([end - start, neighbor_number], dtype=np.int64),
+                                        idx_to_keep_dim1=idx_dim1_all[start:end],
+                                        val_to_keep=values_all[start:end])
+
+            tiles_finished.append((batch_idx_dim0, batch_idx_dim1))
+            tile_num_finished += 1
+            print("Process {} finishes tile {}. ".format(worker_rank, (batch_idx_dim0, batch_idx_dim1)) +
+                  "{} of {} tiles are finished.".format(tile_num_finished, tile_num_total))
+
+            if checkpoint_prefix is not None and tile_num_finished % checkpoint_interval == 0:
+                util.save_checkpoint(checkpoint_prefix=checkpoint_prefix,
+                                     progress=tile_num_finished,
+                                     signature=signature,
+                                     values_all=values_all,
+                                     idx_dim1_all=idx_dim1_all,
+                                     mean_all=mean_all,
+                                     std_all=std_all,
+                                     tiles_finished=np.array(tiles_finished, dtype=np.int64).reshape(-1, 2))
+
+        # Find the next tile for this worker
+        batch_idx_dim0 = last_batch_idx_dim0.get(worker_rank, -1)
+        if not tiles_to_process.get(batch_idx_dim0, []):
+            batch_idx_dim0 = max(tiles_to_process, key=lambda x: len(tiles_to_process[x]), default=-1)
+
+        if batch_idx_dim0 >= 0 and tiles_to_process[batch_idx_dim0]:
+            task = (batch_idx_dim0, tiles_to_process[batch_idx_dim0].pop(0))
+            last_batch_idx_dim0[worker_rank] = batch_idx_dim0
+        else:
+            # There is no tile left. Stop this worker.
+            task = None
+            worker_num -= 1
+
+        comm.send(task, dest=worker_rank)
+
+    return values_all, idx_dim1_all, mean_all, std_all
+
+
+def task_queue_worker(comm, data_source, mask_file, neighbor_number, symmetric_tiling,
+                      zeros_mean_shift, normalize_by_std, pattern_cache=None,
+                      dtype=np.float64, recheck_tolerance=None, pattern_stat=None, standardize=False,
+                      projection=None):
+    """
+    Ask rank 0 for tiles and send the nearest neighbors found in each tile back until there is no
+    tile left.
+
+    :param comm: The MPI communicator. This can not be called by rank 0.
+    :param data_source: The data_source object with batches.
+    :param mask_file: A string containing the address of the numpy array
+    :param neighbor_number: The number of neighbors to keep.
+    :param symmetric_tiling: Boolean value. Whether to only calculate one of each pair of mirror tiles.
+    :param zeros_mean_shift: Boolean value. Whether to shift the pattern in general so that after the shift,
+                             the mean value becomes zero
+    :param normalize_by_std: Boolean value. Whether to normalize the pattern so that after the normalization,
+                             the standard deviation becomes 1.
+    :param pattern_cache: The memory-mapped pattern cache created by build_pattern_cache or None.
+    :param dtype: The dtype to calculate the inner product matrix with.
+    :param recheck_tolerance: The relative tolerance to check the float32 candidates again in float64.
+                              None derives it from the pattern length with get_recheck_tolerance.
+    :param pattern_stat: The mean and std returned by build_pattern_cache together with the pattern_cache.
+    :param standardize: Boolean value. Whether the patterns are standardized when they are loaded. In this
+                        case, zeros_mean_shift and normalize_by_std should be False.
+    :param projection: The projection matrix from fit_projection or None.
+    :return: None
+    """
+    comm_rank = comm.Get_rank()
+    data_shape = data_source.source_dict["shape"]
+
+    # The row batch of the last tile is kept in memory.
+    batch_idx_dim0_loaded = -1
+    result = None
+
+    while True:
+        comm.send((comm_rank, result), dest=0)
+        task = comm.recv(source=0)
+        if task is None:
+            break
+
+        batch_idx_dim0, batch_idx_dim1 = task
+        global_idx_range_dim0 = data_source.batch_global_idx_range_dim0[batch_idx_dim0]
+        global_idx_range_dim1 = data_source.batch_global_idx_range_dim1[batch_idx_dim1]
+        data_num_dim0 = data_source.batch_num_list_dim0[batch_idx_dim0]
+
+        if batch_idx_dim0 != batch_idx_dim0_loaded:
+            [dataset_dim0, data_mean_dim0,
+             data_std_dim0, bool_mask_1d, _] = get_data_and_stat(
+                batch_info=data_source.batch_ends_local_dim0[batch_idx_dim0],
+                maskfile=mask_file,
+                data_num=data_num_dim0,
+                data_shape=data_shape,
+                pattern_cache=pattern_cache,
+                global_idx_range=global_idx_range_dim0,
+                dtype=dtype,
+                pattern_stat=pattern_stat,
+                standardize=standardize,
+                projection=projection)
+            batch_idx_dim0_loaded = batch_idx_dim0
+
+        # Load the batch along dimension 1
+        if symmetric_tiling and batch_idx_dim0 == batch_idx_dim1:
+            dataset_dim1, data_mean_dim1, data_std_dim1 = dataset_dim0, data_mean_dim0, data_std_dim0
+        else:
+            dataset_dim1 = get_masked_batch_dim1(data_source=data_source,
+                                                 batch_idx_dim1=batch_idx_dim1,
+                                                 data_shape=data_shape,
+                                                 bool_mask_1d=bool_mask_1d,
+                                                 pattern_cache=pattern_cache,
+                                                 dtype=dtype,
+                                                 standardize=standardize,
+                                                 projection=projection)
+            if standardize:
+                # The standardized patterns are not shifted or normalized again.
+                data_mean_dim1, data_std_dim1 = None, None
+            elif pattern_cache is not None and pattern_stat is not None:
+                # Use the same statistics as along dimension 0 rather than those of the cached patterns.
+                data_mean_dim1 = np.array(pattern_stat[0, global_idx_range_dim1[0]:global_idx_range_dim1[1]])
+                data_std_dim1 = np.array(pattern_stat[1, global_idx_range_dim1[0]:global_idx_range_dim1[1]])
+            else:
+                data_mean_dim1, data_std_dim1 = get_pattern_mean_and_std(dataset=dataset_dim1)
+
+        # Create holders for the nearest neighbors in this tile
+        holder_size = np.array([data_num_dim0, neighbor_number], dtype=np.int64)
+        idx_to_keep_dim1 = np.zeros((data_num_dim0, neighbor_number), dtype=np.int64)
+        val_to_keep = (-2e+100) * np.ones((data_num_dim0, neighbor_number), dtype=np.float64)
+
+        if symmetric_tiling:
+            mirror_holders = update_nearest_neighbors_symmetric(
+                dataset_dim0=dataset_dim0, dataset_dim1=dataset_dim1,
+                global_idx_range_dim0=global_idx_range_dim0,
+                global_idx_range_dim1=global_idx_range_dim1,
+                neighbor_number=neighbor_number, bool_mask_1d=bool_mask_1d,
+                data_std_dim0=data_std_dim0, data_mean_dim0=data_mean_dim0,
+                data_std_dim1=data_std_dim1, data_mean_dim1=data_mean_dim1,
+                holder_size=holder_size, idx_to_keep_dim1=idx_to_keep_dim1,
+                val_to_keep=val_to_keep, normalize_by_std=normalize_by_std,
+                zeros_mean_shift=zeros_mean_shift, recheck_tolerance=recheck_tolerance,
+                standardize=standardize)
+        else:
+            inner_prod_matrix = get_inner_product_tile(dataset_dim0=dataset_dim0,
+                                                       dataset_dim1=dataset_dim1,
+                                                       data_std_dim0=data_std_dim0,
+                                                       data_mean_dim0=data_mean_dim0,
+                                                       data_std_dim1=data_std_dim1,
+                                                       data_mean_dim1=data_mean_dim1,
+                                                       bool_mask_1d=bool_mask_1d,
+                                                       zeros_mean_shift=zeros_mean_shift,
+                                                       normalize_by_std=normalize_by_std,
+                                                       standardize=standardize)
+            update_top_k_tile(inner_prod_matrix=inner_prod_matrix,
+                              dataset_dim0=dataset_dim0,
+                              dataset_dim1=dataset_dim1,
+                              data_std_dim0=data_std_dim0,
+                              data_mean_dim0=data_mean_dim0,
+                              data_std_dim1=data_std_dim1,
+                              data_mean_dim1=data_mean_dim1,
+                              bool_mask_1d=bool_mask_1d,
+                              zeros_mean_shift=zeros_mean_shift,
+                              normalize_by_std=normalize_by_std,
+                              idx_start=global_idx_range_dim1[0],
+                              idx_to_keep_dim1=idx_to_keep_dim1,
+                              val_to_keep=val_to_keep,
+                              holder_size=holder_size,
+                              recheck_tolerance=recheck_tolerance,
+                              standardize=standardize)
+            mirror_holders = None
+
+        result = (batch_idx_dim0, batch_idx_dim1, idx_to_keep_dim1, val_to_keep,
+                  data_mean_dim0, data_std_dim0, mirror_holders)
+
+
+##################################################################
+#
+#       Approximate nearest neighbors
+#
+##################################################################
+def get_row_range_list(data_num, process_num):
+    """
+    Split the rows of the nearest neighbors of all the patterns into consecutive ranges, one for each process.
+
+    :param data_num: The total number of patterns.
+    :param process_num: The number of processes.
+    :return: A list of the global index ranges (start, end) of the rows of each process.
+    """
+    tmp = np.cumsum([0, ] + util.get_batch_num_list(total_num=data_num, batch_num=process_num))
+    return [(int(tmp[l]), int(tmp[l + 1])) for l in range(process_num)]
+
+
+def get_random_projection_leaves(dataset, tree_number, leaf_size, seed, batch_size=4096, comm=None):
+    """
+    Split the patterns with a forest of random projection trees.
+
+    Each level of a tree splits every node at the median of the projection onto a random direction.
+    The nodes on the same level share the direction so that all the projections are calculated
+    with one pass through the dataset.
+
+    :param dataset: The masked and standardized dataset of all the patterns, e.g. the pattern cache.
+    :param tree_number: The number of trees.
+    :param leaf_size: The maximal number of patterns in each leaf.
+    :param seed: The seed of the random directions.
+    :param batch_size: The number of patterns to project at a time.
+    :param comm: The MPI communicator or None. If this is given, each process projects the patterns of its
+                 rows from get_row_range_list and all the processes get the same leaves. This has to be
+                 called by all the processes in comm.
+    :return: A list of int64 arrays containing the sorted global indexes of the patterns in each leaf
+             of all the trees.
+    """
+    data_num = dataset.shape[0]
+    depth = int(np.ceil(np.log2(max(float(data_num) / leaf_size, 1.))))
+    if depth == 0:
+        return [np.arange(data_num, dtype=np.int64)]
+
+    if comm is None:
+        row_start, row_end = 0, data_num
+    else:
+        row_start, row_end = get_row_range_list(data_num=data_num, process_num=comm.Get_size())[comm.Get_rank()]
+
+    # Project the patterns onto all the random directions.
+    random_state = np.random.RandomState(seed)
+    directions = random_state.normal(size=(dataset.shape[1], tree_number * depth))
+    projections = np.empty((row_end - row_start, tree_number * depth), dtype=np.float64)
+    for start in range(row_start, row_end, batch_size):
+        end = min(start + batch_size, row_end)
+        projections[start - row_start:end - row_start] = np.dot(np.asarray(dataset[start:end], dtype=np.float64),
+                                                                directions)
+    if comm is not None:
+        projections = np.concatenate(comm.allgather(projections), axis=0)
+
+    leaves = []
+    for tree_idx in range(tree_number):
+        nodes = [np.arange(data_num, dtype=np.int64)]
+        for level in range(depth):
+            projection = projections[:, tree_idx * depth + level]
+
+            children = []
+            for node in nodes:
+                half = node.shape[0] // 2
+                order = np.argpartition(projection[node], half)
+                children += [node[order[:half]], node[order[half:]]]
+            nodes = children
+
+        leaves += [np.sort(node) for node in nodes]
+
+    return leaves
+
+
+def update_nearest_neighbors_in_leaves(dataset, leaves, holder_size, idx_to_keep_dim1, val_to_keep, pixel_num=None,
+                                       row_range=None):
+    """
+    Calculate the similarity matrix within each leaf and merge it into the nearest neighbors.
+
+    :param dataset: The masked and standardized dataset of all the patterns.
+    :param leaves: The leaves returned by get_random_projection_leaves.
+    :param holder_size: The size of the following two holders.
+    :param idx_to_keep_dim1: The holder for the indexes of the patterns in row_range. The empty entries
+                             have to be -1.
+    :param val_to_keep: The holder for the values of the patterns in row_range.
+    :param pixel_num: The number of unmasked pixels. The inner product is divided by this value.
+                      The default is the length of each pattern in the dataset.
+    :param row_range: The global index range [start, end) of the rows of the holders. None means all
+                      the patterns.
+    :return: None
+    """
+    denominator = float(pixel_num or dataset.shape[1])
+    row_start, row_end = row_range or (0, dataset.shape[0])
+
+    for leaf in leaves:
+        rows = leaf[(leaf >= row_start) & (leaf < row_end)]
+        if rows.shape[0] == 0:
+            continue
+
+        leaf_dataset = np.asarray(dataset[leaf], dtype=np.float64)
+        row_dataset = np.asarray(dataset[rows], dtype=np.float64)
+        Graph.update_top_k_rows(matrix=np.dot(row_dataset, np.transpose(leaf_dataset)) / denominator,
+                                rows=rows - row_start,
+                                cols=leaf,
+                                idx_holder=idx_to_keep_dim1,
+                                val_holder=val_to_keep,
+                                holder_size=holder_size)
+
+
+def nn_descent_iteration(dataset, holder_size, idx_to_keep_dim1, val_to_keep, is_new, sample_number,
+                         pixel_num=None):
+    """
+    Improve the nearest neighbors of all the patterns with one iteration of the nearest neighbor descent.
+
+    :param dataset: The masked and standardized dataset of all the patterns. This has to be writable
+                    to be passed to the numba kernel.
+    :param holder_size: The size of the following two holders.
+    :param idx_to_keep_dim1: The holder for the indexes of all the patterns. The empty entries have to be -1.
+    :param val_to_keep: The holder for the values of all the patterns.
+    :param is_new: Boolean array. Whether the nearest neighbors of each pattern changed in the last iteration.
+    :param sample_number: The number of the nearest neighbors and reverse neighbors of each pattern to follow.
+    :param pixel_num: The number of unmasked pixels. The inner product is divided by this value.
+                      The default is the length of each pattern in the dataset.
+    :return: update_num, updated. The number of the new nearest neighbors and whether the nearest neighbors
+             of each pattern changed in this iteration.
+    """
+    neighbors = np.copy(idx_to_keep_dim1)
+    reverse_neighbors = np.empty((holder_size[0], sample_number), dtype=np.int64)
+    Graph.get_reverse_neighbors(neighbors=neighbors,
+                                sample_number=sample_number,
+                                reverse_neighbors=reverse_neighbors)
+
+    update_num = np.zeros(holder_size[0], dtype=np.int64)
+    Graph.nn_descent_update(dataset=dataset,
+                            neighbors=neighbors,
+                            reverse_neighbors=reverse_neighbors,
+                            is_new=is_new,
+                            sample_number=sample_number,
+                            denominator=float(pixel_num or dataset.shape[1]),
+                            idx_holder=idx_to_keep_dim1,
+                            val_holder=val_to_keep,
+                            update_num=update_num,
+                            holder_size=holder_size)
+    return int(np.sum(update_num)), update_num > 0
+
+
+def nn_descent_iteration_parallel(comm, dataset, row_range_list, holder_size, idx_to_keep_dim1, val_to_keep,
+                                  is_new, sample_number, pixel_num=None, batch_size=1024):
+    """
+    Improve the nearest neighbors of all the patterns with one iteration of the nearest neighbor descent
+    when each process holds the nearest neighbors of a range of the patterns.
+
+    Each process sends its patterns to the processes holding their nearest neighbors, which collect
+    the reverse neighbors. Then each process joins the nearest neighbors and the reverse neighbors of
+    each of its patterns with Graph.nn_descent_join and sends the candidates to the processes holding
+    the patterns that receive them. This has to be called by all the processes in comm.
+
+    :param comm: The MPI communicator.
+    :param dataset: The masked and standardized dataset of all the patterns. This has to be writable
+                    to be passed to the numba kernel.
+    :param row_range_list: The global index range [start, end) of the rows of each process from
+                           get_row_range_list.
+    :param holder_size: The size of the following two holders.
+    :param idx_to_keep_dim1: The holder for the indexes of the patterns of this process. The empty entries
+                             have to be -1.
+    :param val_to_keep: The holder for the values of the patterns of this process.
+    :param is_new: Boolean array of all the patterns. Whether the nearest neighbors of each pattern changed
+                   in the last iteration.
+    :param sample_number: The number of the nearest neighbors and reverse neighbors of each pattern to follow.
+    :param pixel_num: The number of unmasked pixels. The inner product is divided by this value.
+                      The default is the length of each pattern in the dataset.
+    :param batch_size: The number of join lists to process at a time.
+    :return: update_num, updated. The number of the new nearest neighbors of all the patterns and whether
+             the nearest neighbors of each pattern changed in this iteration.
+    """
+    comm_size = comm.Get_size()
+    row_start, row_end = row_range_list[comm.Get_rank()]
+    row_ends = np.array([x[1] for x in row_range_list], dtype=np.int64)
+    forward_number = min(sample_number, holder_size[1])
+
+    # Send each pattern to the processes holding its nearest neighbors.
+    forward = np.ascontiguousarray(idx_to_keep_dim1[:, :forward_number])
+    sources = np.repeat(np.arange(row_start, row_end, dtype=np.int64), forward_number)
+    targets = forward.ravel()
+    keep = (targets >= 0) & (targets != sources)
+    sources, targets = sources[keep], targets[keep]
+    owners = np.searchsorted(row_ends, targets, side='right')
+    received = comm.alltoall([(targets[owners == l], sources[owners == l]) for l in range(comm_size)])
+    targets = np.concatenate([x[0] for x in received])
+    sources = np.concatenate([x[1] for x in received])
+
+    # Keep the first 2 * sample_number reverse neighbors of each pattern. In the local join a pattern only
+    # meets the neighbors of its nearest neighbor through the reverse list of that neighbor, so this list
+    # is longer than the one from get_reverse_neighbors to reach about the same candidates.
+    reverse_number = 2 * sample_number
+    reverse = -np.ones((row_end - row_start, reverse_number), dtype=np.int64)
+    order = np.lexsort((sources, targets))
+    targets, sources = targets[order], sources[order]
+    rank_in_group = np.arange(targets.shape[0]) - np.searchsorted(targets, targets, side='left')
+    keep = rank_in_group < reverse_number
+    reverse[targets[keep] - row_start, rank_in_group[keep]] = sources[keep]
+    join_lists = np.concatenate([forward, reverse], axis=1)
+
+    # Only the candidates larger than the smallest kept value of the receiving pattern are sent.
+    thresholds = np.concatenate(comm.allgather(np.ascontiguousarray(val_to_keep[:, -1])))
+    denominator = float(pixel_num or dataset.shape[1])
+
+    length = join_lists.shape[1]
+    cand_rows = [np.zeros(0, dtype=np.int64)]
+    cand_indexes = [np.zeros(0, dtype=np.int64)]
+    cand_values = [np.zeros(0, dtype=np.float64)]
+    for start in range(0, row_end - row_start, batch_size):
+        end = min(start + batch_size, row_end - row_start)
+        cand_row = np.empty((end - start, length * (length - 1)), dtype=np.int64)
+        cand_idx = np.empty((end - start, length * (length - 1)), dtype=np.int64)
+        cand_val = np.empty((end - start, length * (length - 1)), dtype=np.float64)
+        cand_num = np.zeros(end - start, dtype=np.int64)
+        Graph.nn_descent_join(dataset=dataset,
+                              join_lists=join_lists[start:end],
+                              row_start=row_start + start,
+                              is_new=is_new,
+                              thresholds=thresholds,
+                              denominator=denominator,
+                              cand_row=cand_row,
+                              cand_idx=cand_idx,
+                              cand_val=cand_val,
+                              cand_num=cand_num)
+        valid = np.arange(cand_row.shape[1]) < cand_num[:, np.newaxis]
+        cand_rows.append(cand_row[valid])
+        cand_indexes.append(cand_idx[valid])
+        cand_values.append(cand_val[valid])
+    cand_rows = np.concatenate(cand_rows)
+    cand_indexes = np.concatenate(cand_indexes)
+    cand_values = np.concatenate(cand_values)
+
+    # Send the candidates to the processes holding the patterns that receive them.
+    owners = np.searchsorted(row_ends, cand_rows, side='right')
+    received = comm.alltoall([(cand_rows[owners == l], cand_indexes[owners == l], cand_values[owners == l])
+                              for l in range(comm_size)])
+    cand_rows = np.concatenate([x[0] for x in received])
+    cand_indexes = np.concatenate([x[1] for x in received])
+    cand_values = np.concatenate([x[2] for x in received])
+
+    order = np.argsort(cand_rows, kind='stable')
+    offsets = np.searchsorted(cand_rows[order], np.arange(row_start, row_end + 1, dtype=np.int64))
+    update_num = np.zeros(row_end - row_start, dtype=np.int64)
+    Graph.merge_candidates(offsets=offsets.astype(np.int64),
+                           cand_idx=np.ascontiguousarray(cand_indexes[order]),
+                           cand_val=np.ascontiguousarray(cand_values[order]),
+                           idx_holder=idx_to_keep_dim1,
+                           val_holder=val_to_keep,
+                           update_num=update_num,
+                           holder_size=holder_size)
+
+    return comm.allreduce(int(np.sum(update_num))), np.concatenate(comm.allgather(update_num > 0))
+
+
+def get_exact_nearest_neighbors(dataset, global_idx_array, neighbor_number, batch_size=4096, pixel_num=None):
+    """
+    Find the exact nearest neighbors of some patterns among all the patterns.
+
+    :param dataset: The masked and standardized dataset of all the patterns.
+    :param global_idx_array: The global indexes of the patterns to find the nearest neighbors for.
+    :param neighbor_number: The number of neighbors to keep.
+    :param batch_size: The number of patterns to compare with at a time.
+    :param pixel_num: The number of unmasked pixels. The inner product is divided by this value.
+                      The default is the length of each pattern in the dataset.
+    :return: idx_to_keep_dim1, val_to_keep of the shape [global_idx_array.shape[0], neighbor_number]
+    """
+    return get_nearest_neighbors_of_patterns(query=dataset[global_idx_array],
+                                             dataset=dataset,
+                                             neighbor_number=neighbor_number,
+                                             batch_size=batch_size,
+                                             pixel_num=pixel_num)
+
+
+def get_nearest_neighbors_of_patterns(query, dataset, neighbor_number, batch_size=4096, pixel_num=None):
+    """
+    Find the exact nearest neighbors of some patterns, which need not belong to the dataset, among
+    all the patterns in the dataset.
+
+    :param query: The masked and standardized patterns to find the nearest neighbors for.
+    :param dataset: The masked and standardized dataset of all the patterns.
+    :param neighbor_number: The number of neighbors to keep.
+    :param batch_size: The number of patterns to compare with at a time.
+    :param pixel_num: The number of unmasked pixels. The inner product is divided by this value.
+                      The default is the length of each pattern in the dataset.
+    :return: idx_to_keep_dim1, val_to_keep of the shape [query.shape[0], neighbor_number]
+    """
+    data_num = query.shape[0]
+    denominator = float(pixel_num or dataset.shape[1])
+
+    holder_size = np.array([data_num, neighbor_number], dtype=np.int64)
+    idx_to_keep_dim1 = np.zeros((data_num, neighbor_number), dtype=np.int64)
+    val_to_keep = (-2e+100) * np.ones((data_num, neighbor_number), dtype=np.float64)
+
+    query = np.asarray(query, dtype=np.float64)
+    for start in range(0, dataset.shape[0], batch_size):
+        dataset_dim1 = np.asarray(dataset[start:start + batch_size], dtype=np.float64)
+        Graph.update_top_k(matrix=np.dot(query, np.transpose(dataset_dim1)) / denominator,
+                           idx_start=start,
+                           idx_holder=idx_to_keep_dim1,
+                           val_holder=val_to_keep,
+                           holder_size=holder_size)
+
+    return idx_to_keep_dim1, val_to_keep
+
+
+##################################################################
+#
+#       Incremental update
+#
+##################################################################
+def update_nearest_neighbors_incremental(dataset_new, dataset_dim1, global_idx_range_new, global_idx_range_dim1,
+                                         data_num_old, pixel_num, holder_size_new, idx_to_keep_new, val_to_keep_new,
+                                         holder_size_old=None, idx_to_keep_old=None, val_to_keep_old=None):
+    """
+    Update the nearest neighbors with the tile between the new patterns and a batch along dimension 1.
+
+    The nearest neighbors of the new patterns are updated with the whole tile. The part of the batch
+    before data_num_old contains old patterns whose nearest neighbors are already known. Only the
+    transpose of that part, i.e. the new patterns as candidates, is merged into their rows.
+
+    :param dataset_new: The masked and standardized new patterns.
+    :param dataset_dim1: The masked and standardized patterns of the batch along dimension 1.
+    :param global_idx_range_new: [starting global index, ending global index] of the new patterns.
+    :param global_idx_range_dim1: [starting global index, ending global index] of the batch along dimension 1.
+    :param data_num_old: The number of patterns of the previous calculation.
+    :param pixel_num: The number of unmasked pixels. The inner product is divided by this value.
+    :param holder_size_new: The shape of val_to_keep_new.
+    :param idx_to_keep_new: The holder of the indexes of the nearest neighbors of the new patterns.
+    :param val_to_keep_new: The holder of the values of the nearest neighbors of the new patterns.
+    :param holder_size_old: The shape of val_to_keep_old.
+    :param idx_to_keep_old: The indexes of the nearest neighbors of the old patterns in the batch along
+                            dimension 1. This is None if the batch does not contain any old pattern.
+    :param val_to_keep_old: The values of the nearest neighbors of the old patterns in the batch.
+    :return: None
+    """
+    inner_prod_matrix = np.dot(np.asarray(dataset_new, dtype=np.float64),
+                               np.transpose(np.asarray(dataset_dim1, dtype=np.float64))) / float(pixel_num)
+
+    Graph.update_top_k(matrix=inner_prod_matrix,
+                       idx_start=global_idx_range_dim1[0],
+                       idx_holder=idx_to_keep_new,
+                       val_holder=val_to_keep_new,
+                       holder_size=holder_size_new)
+
+    old_num = max(0, min(global_idx_range_dim1[1], data_num_old) - global_idx_range_dim1[0])
+    if old_num > 0:
+        candidate_idx = np.arange(global_idx_range_new[0], global_idx_range_new[1], dtype=np.int64)
+        merge_nearest_neighbors(values=np.ascontiguousarray(np.transpose(inner_prod_matrix[:, :old_num])),
+                                indexes=np.ascontiguousarray(np.broadcast_to(candidate_idx,
+                                                                             (old_num, candidate_idx.shape[0]))),
+                                holder_size=holder_size_old,
+                                idx_to_keep_dim1=idx_to_keep_old,
+                                val_to_keep=val_to_keep_old)
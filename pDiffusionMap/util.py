@@ -1,28 +1,204 @@
 """
 This module contains functions that I don't know where to put.
 """
+import os
+import json
 import time
+import hashlib
+import atexit
 import datetime
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import h5py
 import numpy as np
 import scipy
 import scipy.sparse
+import scipy.sparse.linalg
 from pDiffusionMap import Graph
 
 
+##################################################################
+#
+#       Pool of open h5 files
+#
+##################################################################
+
+class H5FilePool:
+    """
+    A pool of h5 files opened read-only. The files are kept open between the calls so that the data
+    files are not opened again for each batch or each sampled pattern. This matters on network file
+    systems where opening a file and reading its metadata are slow.
+
+    When there are more than max_file_num files, the least recently used file that is not being read
+    is closed. The pool can be used by several threads at the same time.
+
+    The chunk caches of all the open files share the budget total_rdcc_nbytes, so that the memory
+    of the pool does not grow with the number of files.
+    """
+
+    def __init__(self, max_file_num=64, total_rdcc_nbytes=64 * 1024 ** 2, rdcc_nslots=10007, read_thread_num=1):
+        """
+        :param max_file_num: The maximal number of files to keep open.
+        :param total_rdcc_nbytes: The total size of the chunk caches of the open files in bytes. Each file
+                                  gets total_rdcc_nbytes // max_file_num bytes. The default gives each
+                                  file the 1MB chunk cache of h5py.
+        :param rdcc_nslots: The number of slots in the chunk cache of each file. This should be a
+                            prime number about 100 times the number of chunks that fit in the cache.
+        :param read_thread_num: The default number of threads for h5_dataloader to read a batch with.
+        """
+        if max_file_num < 1:
+            raise Exception("max_file_num has to be a positive integer.")
+        if total_rdcc_nbytes < 0:
+            raise Exception("total_rdcc_nbytes has to be a non-negative integer.")
+        if read_thread_num < 1:
+            raise Exception("read_thread_num has to be a positive integer.")
+
+        self.max_file_num = max_file_num
+        self.rdcc_nbytes = int(total_rdcc_nbytes // max_file_num)
+        self.rdcc_nslots = rdcc_nslots
+        self.read_thread_num = read_thread_num
+
+        # address -> [h5py.File, number of readers]
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def open(self, address):
+        """
+        Get the open h5 file at the address. The file is opened if it is not in the pool.
+
+            with pool.open(address) as h5file:
+                ...
+
+        :param address: The address of the h5 file.
+        :return: A context manager giving the h5py.File object. Do not close the file.
+        """
+        with self._lock:
+            holder = self._files.get(address)
+            if holder is None:
+                holder = [h5py.File(address, 'r', rdcc_nbytes=self.rdcc_nbytes, rdcc_nslots=self.rdcc_nslots), 0]
+                self._files[address] = holder
+            self._files.move_to_end(address)
+            holder[1] += 1
+            self._close_least_recently_used()
+
+        try:
+            yield holder[0]
+        finally:
+            with self._lock:
+                holder[1] -= 1
+                # The file may have been removed from the pool while it was read
+                if self._files.get(address) is not holder and holder[1] == 0:
+                    holder[0].close()
+                self._close_least_recently_used()
+
+    def _close_least_recently_used(self):
+        """
+        Close the least recently used files that are not being read until there are at most
+        max_file_num files in the pool. The lock has to be held.
+
+        :return: None
+        """
+        if len(self._files) <= self.max_file_num:
+            return
+
+        for address in list(self._files.keys()):
+            if len(self._files) <= self.max_file_num:
+                break
+            holder = self._files[address]
+            if holder[1] == 0:
+                del self._files[address]
+                holder[0].close()
+
+    def invalidate(self, address):
+        """
+        Remove the file from the pool, e.g. because the file has been changed since it was opened.
+        A file being read is closed when the reading finishes.
+
+        :param address: The address of the h5 file.
+        :return: None
+        """
+        with self._lock:
+            holder = self._files.pop(address, None)
+            if holder is not None and holder[1] == 0:
+                holder[0].close()
+
+    def close_all(self):
+        """
+        Close all the files that are not being read and remove all the files from the pool.
+
+        :return: None
+        """
+        with self._lock:
+            for holder in self._files.values():
+                if holder[1] == 0:
+                    holder[0].close()
+            self._files.clear()
+
+
+_h5_file_pool = H5FilePool()
+atexit.register(lambda: _h5_file_pool.close_all())
+
+
+def get_h5_file_pool():
+    """
+    Get the pool of h5 files shared by all the readers in this module.
+
+    :return: The H5FilePool object.
+    """
+    return _h5_file_pool
+
+
+def set_h5_file_pool(max_file_num=64, total_rdcc_nbytes=64 * 1024 ** 2, rdcc_nslots=10007, read_thread_num=1):
+    """
+    Replace the pool of h5 files shared by all the readers in this module. The files in the old
+    pool are closed.
+
+    :param max_file_num: The maximal number of files to keep open.
+    :param total_rdcc_nbytes: The total size of the chunk caches of the open files in bytes.
+    :param rdcc_nslots: The number of slots in the chunk cache of each file.
+    :param read_thread_num: The default number of threads for h5_dataloader to read a batch with.
+    :return: The new H5FilePool object.
+    """
+    global _h5_file_pool
+    old_pool = _h5_file_pool
+    _h5_file_pool = H5FilePool(max_file_num=max_file_num, total_rdcc_nbytes=total_rdcc_nbytes, rdcc_nslots=rdcc_nslots,
+                               read_thread_num=read_thread_num)
+    old_pool.close_all()
+    return _h5_file_pool
+
+
+def open_h5_file(address):
+    """
+    Get an open h5 file from the shared pool.
+
+        with open_h5_file(address) as h5file:
+            ...
+
+    :param address: The address of the h5 file.
+    :return: A context manager giving the h5py.File object.
+    """
+    return _h5_file_pool.open(address)
+
+
 ##################################################################
 #
 #       Parse the list of data files
 #
 ##################################################################
 
-def parse_data_list(txt_file, file_type="h5"):
+def parse_data_list(txt_file, file_type="h5", index_file=None):
     """
     Provide an interface to parse the data list.
 
     :param txt_file: The txt file containing the list of all data files.
     :param file_type: The type of data files
+    :param index_file: The json file to keep the datasets, pattern numbers, shapes and dtypes of each h5
+                       file in. A file is only opened again if its modification time or size has changed.
+                       The default is txt_file + ".index.json". Use "" to disable the index file.
     :return: A dictionary in the following format.
 
             {"Files":[A list of all names in the txt file] ,
@@ -37,13 +213,94 @@ def parse_data_list(txt_file, file_type="h5"):
     available_file_type = ["h5", ]
 
     if file_type == "h5":
-        return _parse_h5_data_list(txt_file)
+        if index_file is None:
+            index_file = txt_file + ".index.json"
+        return _parse_h5_data_list(txt_file, index_file=index_file)
     else:
         raise Exception("Invalid value for file_type. Currently, available file types are: ",
                         available_file_type)
 
 
-def _parse_h5_data_list(txt_file):
+def _load_h5_file_index(index_file):
+    """
+    Load the index of the h5 files saved by _save_h5_file_index.
+
+    :param index_file: The json index file. Use "" to skip the loading.
+    :return: A dictionary {file address: {"mtime_ns", "size", "keys", "datasets": {key: [number, shape, dtype]}}}.
+             The dictionary is empty if the index file does not exist or can not be read.
+    """
+    if not index_file or not os.path.exists(index_file):
+        return {}
+
+    try:
+        with open(index_file, 'r') as json_file:
+            return json.load(json_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_h5_file_index(index_file, file_index):
+    """
+    Save the index of the h5 files. The index is first written to a temporary file and then renamed so that
+    processes reading the index at the same time never see a partial file. The index is not saved if the
+    folder is not writable.
+
+    :param index_file: The json index file. Use "" to skip the saving.
+    :param file_index: The dictionary from _get_h5_file_entry for each file.
+    :return: None
+    """
+    if not index_file:
+        return
+
+    tmp_file = index_file + ".{}.tmp".format(os.getpid())
+    try:
+        with open(tmp_file, 'w') as json_file:
+            json.dump(file_index, json_file)
+        os.replace(tmp_file, index_file)
+    except (IOError, OSError):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _get_h5_file_entry(address, file_index):
+    """
+    Get the keys of the h5 file and the pattern number, pattern shape and dtype of each dataset. The file is
+    only opened if the entry in the index is missing or the modification time or size of the file has changed.
+
+    :param address: The address of the h5 file.
+    :param file_index: The index from _load_h5_file_index.
+    :return: The entry {"mtime_ns", "size", "keys", "datasets": {key: [number, shape, dtype]}}
+    """
+    try:
+        stat = os.stat(address)
+    except OSError:
+        raise Exception("The file {} does not exit or is damaged.".format(address) +
+                        "Please make sure all the data source h5 files are intact" +
+                        "before launching this program.")
+
+    entry = file_index.get(address)
+    if entry is not None and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+        return entry
+
+    # The file may have changed since it was opened in the pool
+    _h5_file_pool.invalidate(address)
+
+    entry = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "keys": [], "datasets": {}}
+    try:
+        with open_h5_file(address) as h5file:
+            entry["keys"] = list(h5file.keys())
+            for key in entry["keys"]:
+                data_set = h5file[key]
+                if isinstance(data_set, h5py.Dataset):
+                    entry["datasets"][key] = [int(data_set.shape[0]), list(data_set.shape[1:]), str(data_set.dtype)]
+    except IOError:
+        raise Exception("The file {} does not exit or is damaged.".format(address) +
+                        "Please make sure all the data source h5 files are intact" +
+                        "before launching this program.")
+    return entry
+
+
+def _parse_h5_data_list(txt_file, index_file=""):
     """
     Exam each h5 files listed in the txt_file. It returns a dictionary contains the addresses to
     each h5 files and the datasets to process and the pattern number of each data sets.
@@ -59,12 +316,20 @@ def _parse_h5_data_list(txt_file):
 
     This also means, your dataset name can only use ASCII characters.
 
+    The keys of each h5 file and the pattern number, shape and dtype of each dataset are kept in
+    the index_file. An unchanged file is not opened again.
+
     :param txt_file: The txt file containing the list to parse.
+    :param index_file: The json index file of the h5 files. Use "" to disable the index file.
     :return: a dictionary containing the necessary information.
     """
 
     dict_holder = {"Files": []}
 
+    # The keys and datasets of each h5 file
+    file_index = _load_h5_file_index(index_file)
+    file_entries = {}
+
     # Read the lines. Do not change the order of the files in the txt file.
     with open(txt_file, 'r') as txtFile:
         lines_holder = txtFile.readlines()
@@ -104,24 +369,17 @@ def _parse_h5_data_list(txt_file):
 
             address = line[5:]
             # Check if the file exists and is intact
-            try:
-                with h5py.File(address, 'r'):
-                    pass
+            file_entries[address] = _get_h5_file_entry(address=address, file_index=file_index)
 
-                # Because the file exist, append the file address to dict_holder["Files"]
-                dict_holder["Files"].append(address)
+            # Because the file exist, append the file address to dict_holder["Files"]
+            dict_holder["Files"].append(address)
 
-                # Create entries for this h5 file.
-                dict_holder.update({address: {"Datasets": [],
-                                              "data_num": []}})
+            # Create entries for this h5 file.
+            dict_holder.update({address: {"Datasets": [],
+                                          "data_num": []}})
 
-                # Record the line number of this file
-                file_pos.append(num)
-
-            except IOError:
-                raise Exception("The file {} does not exit or is damaged.".format(address) +
-                                "Please make sure all the data source h5 files are intact" +
-                                "before launching this program.")
+            # Record the line number of this file
+            file_pos.append(num)
 
     file_list = dict_holder["Files"]
     # Check if all the files are different.
@@ -159,38 +417,54 @@ def _parse_h5_data_list(txt_file):
 
         # If it's to use default behavior.
         if default_flag == 1:
-            with h5py.File(file_list[file_idx], 'r') as h5file:
-                keys = list(h5file.keys())
-                # Make sure the keys are in lexicographical order
-                dict_holder[file_list[file_idx]]["Datasets"] = keys
+            # The keys are in the order of h5py, which is the lexicographical order
+            dict_holder[file_list[file_idx]]["Datasets"] = list(file_entries[file_list[file_idx]]["keys"])
 
     """
     Third loop, check for data number and data shape
     """
 
     # Get a shape
-    with h5py.File(file_list[0], 'r') as h5file:
-        key = dict_holder[file_list[0]]["Datasets"][0]
-        data_set = h5file[key]
-        dict_holder.update({"shape": data_set.shape[1:]})
+    key = dict_holder[file_list[0]]["Datasets"][0]
+    data_num, shape, dtype = _get_dataset_entry(file_entries[file_list[0]], file_list[0], key)
+    dict_holder.update({"shape": tuple(shape), "dtype": dtype})
 
     for file_address in file_list:
-
-        with h5py.File(file_address, 'r') as h5file:
-            for key in dict_holder[file_address]["Datasets"]:
-                data_set = h5file[key]
-                dict_holder[file_address]["data_num"].append(data_set.shape[0])
-                # Check if the data size is correct
-                if dict_holder["shape"] != data_set.shape[1:]:
-                    raise Exception("The shape of the dataset {}".format(key) +
-                                    "in file {}".format(file_address) +
-                                    "is different from the intended shape." +
-                                    "Please check if the shape of all samples are the same.")
+        for key in dict_holder[file_address]["Datasets"]:
+            data_num, shape, dtype = _get_dataset_entry(file_entries[file_address], file_address, key)
+            dict_holder[file_address]["data_num"].append(data_num)
+            # Check if the data size is correct
+            if dict_holder["shape"] != tuple(shape):
+                raise Exception("The shape of the dataset {}".format(key) +
+                                "in file {}".format(file_address) +
+                                "is different from the intended shape." +
+                                "Please check if the shape of all samples are the same.")
+
+    # Keep the index of all the files, including those not in this list.
+    file_index.update(file_entries)
+    _save_h5_file_index(index_file=index_file, file_index=file_index)
 
     # Return the result
     return dict_holder
 
 
+def _get_dataset_entry(file_entry, address, key):
+    """
+    Get the pattern number, pattern shape and dtype of a dataset from the entry of its h5 file. A dataset
+    inside a group is not in the entry at first. It is read from the file and added to the entry.
+
+    :param file_entry: The entry from _get_h5_file_entry.
+    :param address: The address of the h5 file.
+    :param key: The name of the dataset.
+    :return: data_num, shape, dtype
+    """
+    if key not in file_entry["datasets"]:
+        with open_h5_file(address) as h5file:
+            data_set = h5file[key]
+            file_entry["datasets"][key] = [int(data_set.shape[0]), list(data_set.shape[1:]), str(data_set.dtype)]
+    return file_entry["datasets"][key]
+
+
 ##################################################################
 #
 #       Get batch number list
@@ -225,13 +499,69 @@ def get_batch_num_list(total_num, batch_num):
 #
 ##################################################################
 
+class GlobalIndexMap:
+    """
+    The map from the global index to the file index, dataset index and local index of each pattern.
+
+    Only the global index of the first pattern of each dataset is stored. A global index is decoded
+    with a binary search through these offsets. The map is indexed in the same way as the dense array
+               [
+                [file index of each global index],
+                [dataset index of each global index],
+                [local index of each global index]
+               ]
+    i.e. index_map[0, start:end] returns the file indexes of the patterns from start to end.
+    """
+
+    def __init__(self, file_num, dataset_num_per_file, data_num_per_dataset):
+        """
+        Build the offsets of the datasets.
+
+        :param file_num: The number of files.
+        :param dataset_num_per_file: The dataset number in each file
+        :param data_num_per_dataset: The data point number in each dataset.
+        """
+        self.dataset_file_index = np.repeat(np.arange(file_num, dtype=np.int64),
+                                            np.asarray(dataset_num_per_file, dtype=np.int64))
+        self.dataset_local_index = np.concatenate([np.arange(x, dtype=np.int64) for x in dataset_num_per_file] +
+                                                  [np.zeros(0, dtype=np.int64)])
+        self.dataset_offsets = np.zeros(self.dataset_file_index.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.concatenate([np.asarray(x, dtype=np.int64) for x in data_num_per_dataset] +
+                                 [np.zeros(0, dtype=np.int64)]),
+                  out=self.dataset_offsets[1:])
+        self.shape = (3, int(self.dataset_offsets[-1]))
+
+    def decode(self, global_index):
+        """
+        Get the file index, dataset index and local index of the global indexes.
+
+        :param global_index: An integer or an array of global indexes.
+        :return: file index, dataset index, local index with the same shape as global_index.
+        """
+        dataset = np.searchsorted(self.dataset_offsets, global_index, side='right') - 1
+        return (self.dataset_file_index[dataset],
+                self.dataset_local_index[dataset],
+                global_index - self.dataset_offsets[dataset])
+
+    def __getitem__(self, key):
+        row, index = key
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(self.shape[1]), dtype=np.int64)
+        else:
+            index = np.asarray(index, dtype=np.int64)
+            index = np.where(index < 0, index + self.shape[1], index)
+
+        holder = np.stack(self.decode(index))
+        return holder[row]
+
+
 def get_global_index_map(data_num_total,
                          file_num,
                          data_num_per_file,
                          dataset_num_per_file,
                          data_num_per_dataset):
     """
-    Return an array containing the map from the global index to file index,
+    Return the map from the global index to file index,
     dataset index and the local index for the specific pattern.
 
     :param data_num_total: The total number of data points.
@@ -239,7 +569,7 @@ def get_global_index_map(data_num_total,
     :param data_num_per_file: The data point number in each file
     :param dataset_num_per_file: The dataset number in each file
     :param data_num_per_dataset: The data point number in each dataset.
-    :return: A numpy array containing the map
+    :return: A GlobalIndexMap that is indexed in the same way as the array
                            [
      global index -->       [file index, dataset index, local index]],
                             [file index, dataset index, local index]],
@@ -248,38 +578,15 @@ def get_global_index_map(data_num_total,
                            ]
 
     """
-    holder = np.zeros((3, data_num_total), dtype=np.int64)
-    # Starting point of the global index for different files
-    global_idx_file_start = 0
-    for file_idx in range(file_num):
-        # End point of the global index for different files
-        global_idx_file_end = global_idx_file_start + data_num_per_file[file_idx]
-        # Assign file index
-        holder[0, global_idx_file_start: global_idx_file_end] = file_idx
-        """
-        Postpone the update of the starting point until the end of the loop.
-        """
+    index_map = GlobalIndexMap(file_num=file_num,
+                               dataset_num_per_file=dataset_num_per_file,
+                               data_num_per_dataset=data_num_per_dataset)
+    if index_map.shape[1] != data_num_total or not np.array_equal(
+            index_map.dataset_offsets[np.cumsum([0, ] + list(dataset_num_per_file))],
+            np.cumsum([0, ] + list(data_num_per_file))):
+        raise Exception("The data numbers per file and per dataset do not agree with the total data number.")
 
-        # Process the dataset index
-        # Starting point of the global index for different dataset
-        global_idx_dataset_start = global_idx_file_start
-        for dataset_idx in range(dataset_num_per_file[file_idx]):
-            # End point of the global index for different dataset
-            global_idx_dataset_end = global_idx_dataset_start + data_num_per_dataset[file_idx][
-                dataset_idx]
-            # Assign the dataset index
-            holder[1, global_idx_dataset_start: global_idx_dataset_end] = dataset_idx
-            # Assign the local index within each dataset
-            holder[2, global_idx_dataset_start:global_idx_dataset_end] = np.arange(
-                data_num_per_dataset[file_idx][dataset_idx])
-
-            # Update the starting global index of the dataset
-            global_idx_dataset_start = global_idx_dataset_end
-
-        # update the start point for the global index of the file
-        global_idx_file_start = global_idx_file_end
-
-    return holder
+    return index_map
 
 
 ##################################################################
@@ -358,9 +665,8 @@ def get_batch_ends(index_map, global_index_range_list, file_list, source_dict):
         increasing, the returned result need not be sorted. Similar reason applies for 
         the other layers.
         """
-        file_pos_holder = index_map[0, global_idx_batch_start: global_idx_batch_end]
-        dataset_pos_holder = index_map[1, global_idx_batch_start: global_idx_batch_end]
-        data_pos_holder = index_map[2, global_idx_batch_start: global_idx_batch_end]
+        file_pos_holder, dataset_pos_holder, data_pos_holder = index_map[:, global_idx_batch_start:
+                                                                         global_idx_batch_end]
 
         file_range = np.unique(file_pos_holder)
 
@@ -437,6 +743,45 @@ def get_batch_idx_per_list(batch_num):
     return holder
 
 
+def get_symmetric_tile_schedule(batch_num):
+    """
+    Because the similarity matrix is symmetric, the tile (i, j) is the transpose of the tile (j, i).
+    This function arranges the tiles so that each pair is only calculated once.
+
+    The calculation is divided into rounds. In round d, the process holding the row batch i
+    calculates the tile (i, (i + d) % batch_num). e.g. for batch_num = 4
+
+                ---------------------
+                | 0  | 1  | 2  |    |
+                ---------------------
+                |    | 0  | 1  | 2  |
+                ---------------------
+                |    |    | 0  | 1  |
+                ---------------------
+                | 1  |    |    | 0  |
+                ---------------------
+
+    where the number in each tile is the round in which the tile is calculated. The empty tiles are
+    the mirror of some other tiles. When batch_num is even, in the last round, only the first half
+    of the processes have tiles to calculate.
+
+    :param batch_num: The number of batches along each line.
+    :return: A numpy array of the shape [round number, batch_num]. The element [d, i] is the dim1 idx of
+             the tile calculated by the row batch i in round d. It's -1 if the row batch i is idle.
+    """
+    round_num = batch_num // 2 + 1
+    holder = -np.ones((round_num, batch_num), dtype=np.int64)
+
+    for d in range(round_num):
+        for l in range(batch_num):
+            # The mirror tile has already been assigned to the row batch l - d
+            if 2 * d == batch_num and l >= d:
+                continue
+            holder[d, l] = (l + d) % batch_num
+
+    return holder
+
+
 ##################################################################
 #
 #       Sampling
@@ -453,15 +798,15 @@ def get_sampled_pattern(global_index, global_index_map, data_dict):
     :return: The corresponding pattern.
     """
     # Decipher the global index
-    file_index = global_index_map[global_index, 0]
-    dataset_index = global_index_map[global_index, 1]
-    local_index = global_index_map[global_index, 2]
+    file_index = global_index_map[0, global_index]
+    dataset_index = global_index_map[1, global_index]
+    local_index = global_index_map[2, global_index]
 
     # Get file name and dataset name
     file_name = data_dict["Files"][file_index]
     dataset_name = data_dict[file_name]["Datasets"][dataset_index]
 
-    with h5py.File(file_name, 'r') as h5file:
+    with open_h5_file(file_name) as h5file:
         return np.array(h5file[dataset_name][local_index])
 
 
@@ -474,75 +819,156 @@ def get_sampled_pattern_batch(global_index_array, global_index_map, data_dict):
     :param data_dict: The source_dict in data_source object
     :return: A numpy array containing all patterns of interests to us .
     """
+    return get_patterns_by_global_index(global_index_array=global_index_array,
+                                        global_index_map=global_index_map,
+                                        data_dict=data_dict,
+                                        max_gap=0)
 
-    holder_shape = tuple([global_index_array.shape[0], ] + list(data_dict['shape']))
-    pattern_holder = np.zeros(holder_shape)
-
-    for l in range(global_index_array.shape[0]):
-        global_index = global_index_array[l]
 
-        # Decipher the global index
-        file_index = global_index_map[0, global_index]
-        dataset_index = global_index_map[1, global_index]
-        local_index = global_index_map[2, global_index]
-
-        # Get file name and dataset name
-        file_name = data_dict["Files"][file_index]
-        dataset_name = data_dict[file_name]["Datasets"][dataset_index]
-
-        # Get the pattern
-        with h5py.File(file_name, 'r') as h5file:
-            pattern_holder[l] = np.array(h5file[dataset_name][local_index])
-
-    return pattern_holder
-
-
-def get_sampled_pattern_batch_efficient(global_index_array, global_index_map, data_dict):
+def get_sampled_pattern_batch_efficient(global_index_array, global_index_map, data_dict, max_gap=16):
     """
     This function return the data with the corresponding global index
 
     :param global_index_array: The array containing all global indexes of interests to us.
     :param global_index_map: The global_index_map which is defined in  get_global_index_map
     :param data_dict: The source_dict in data_source object
+    :param max_gap: Patterns that are at most max_gap patterns apart in a dataset are read with one slice.
     :return: A numpy array containing all patterns of interests to us .
     """
+    return get_patterns_by_global_index(global_index_array=global_index_array,
+                                        global_index_map=global_index_map,
+                                        data_dict=data_dict,
+                                        max_gap=max_gap)
 
-    holder_shape = tuple([global_index_array.shape[0], ] + list(data_dict['shape']))
-    pattern_holder = np.zeros(holder_shape)
-
-    counter = 0
 
+def get_index_runs(local_index, max_gap=0, max_run_length=None):
+    """
+    Merge sorted unique local indexes into runs that can be read with one slice.
+
+    :param local_index: The sorted unique local indexes in one dataset.
+    :param max_gap: Two neighboring indexes are in the same run if there are at most max_gap
+                    patterns between them that are not requested.
+    :param max_run_length: The maximal number of patterns that the slice of a run covers, including
+                           the patterns in the gaps. Longer runs are split. None does not limit the runs.
+    :return: run_starts, run_ends. The positions in local_index where each run starts and ends.
     """
-    Adopt the method in data source here.
+    breaks = np.nonzero(np.diff(local_index) > max_gap + 1)[0] + 1
+    run_starts = np.concatenate([[0, ], breaks]).astype(np.int64)
+    run_ends = np.concatenate([breaks, [local_index.shape[0], ]]).astype(np.int64)
+    if max_run_length is None:
+        return run_starts, run_ends
+
+    # Split the runs whose slices are too long
+    split_starts = []
+    split_ends = []
+    for run_start, run_end in zip(run_starts, run_ends):
+        while run_start < run_end:
+            split_end = run_start + np.searchsorted(local_index[run_start:run_end],
+                                                    local_index[run_start] + max_run_length)
+            split_starts.append(run_start)
+            split_ends.append(split_end)
+            run_start = split_end
+    return np.array(split_starts, dtype=np.int64), np.array(split_ends, dtype=np.int64)
+
+
+def get_patterns_by_global_index(global_index_array, global_index_map, data_dict, max_gap=16,
+                                 chunk_nbytes=64 * 1024 ** 2, dtype=np.float64):
     """
-    file_pos_holder = global_index_map[0, global_index_array]
-    dataset_pos_holder = global_index_map[1, global_index_array]
-    data_pos_holder = global_index_map[2, global_index_array]
+    Load the patterns with the corresponding global indexes.
 
-    # Get all the files
-    file_range = np.unique(file_pos_holder)
+    The global indexes are sorted and the repeated ones are removed. Since the global index increases
+    with the file index, the dataset index and the local index, the sorted indexes are grouped
+    by the dataset. In each dataset, the local indexes are merged into runs with get_index_runs and each
+    run is read with one slice of at most chunk_nbytes bytes. The files are taken from the shared pool
+    of open h5 files.
 
-    # Create the entry for the batch
-    for file_idx in file_range:
+    :param global_index_array: The array containing all global indexes of interests to us.
+    :param global_index_map: The global_index_map which is defined in  get_global_index_map
+    :param data_dict: The source_dict in data_source object
+    :param max_gap: Patterns that are at most max_gap patterns apart in a dataset are read with one slice.
+                    The patterns between them are read and dropped.
+    :param chunk_nbytes: The maximal size in bytes of the slice read at once, including the dropped patterns.
+    :param dtype: The dtype of the returned array.
+    :return: A numpy array containing the patterns in the order of global_index_array.
+    """
+    global_index_array = np.asarray(global_index_array, dtype=np.int64)
+    unique_index, inverse = np.unique(global_index_array, return_inverse=True)
+
+    holder = np.empty((unique_index.shape[0],) + tuple(data_dict['shape']), dtype=dtype)
+    if unique_index.shape[0] == 0:
+        return holder[inverse]
+
+    file_pos_holder, dataset_pos_holder, data_pos_holder = global_index_map[:, unique_index]
+
+    # The positions where the file or the dataset changes
+    group_breaks = np.nonzero((np.diff(file_pos_holder) != 0) | (np.diff(dataset_pos_holder) != 0))[0] + 1
+    group_starts = np.concatenate([[0, ], group_breaks]).astype(np.int64)
+    group_ends = np.concatenate([group_breaks, [unique_index.shape[0], ]]).astype(np.int64)
+
+    for group_start, group_end in zip(group_starts, group_ends):
+        file_name = data_dict["Files"][file_pos_holder[group_start]]
+        with open_h5_file(file_name) as h5file:
+            dataset = h5file[data_dict[file_name]["Datasets"][dataset_pos_holder[group_start]]]
+            local_index = data_pos_holder[group_start:group_end]
+
+            pattern_nbytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+            run_starts, run_ends = get_index_runs(local_index=local_index, max_gap=max_gap,
+                                                  max_run_length=max(1, int(chunk_nbytes // pattern_nbytes)))
+            for run_start, run_end in zip(run_starts, run_ends):
+                local_start = local_index[run_start]
+                local_end = local_index[run_end - 1] + 1
+
+                if run_end - run_start == local_end - local_start:
+                    # A contiguous run is read into the holder directly
+                    holder[group_start + run_start:group_start + run_end] = dataset[local_start:local_end]
+                else:
+                    holder[group_start + run_start:group_start + run_end] = dataset[
+                        local_start:local_end][local_index[run_start:run_end] - local_start]
+
+    # Return the patterns in the order of global_index_array
+    if unique_index.shape[0] == global_index_array.shape[0] and np.array_equal(unique_index, global_index_array):
+        return holder
+    return holder[inverse]
 
-        # Directly open this h5file
-        file_name = data_dict["Files"][file_idx]
-        with h5py.File(file_name, 'r') as h5file:
 
-            # Get all the dataset within this file
-            dataset_range = np.unique(dataset_pos_holder[file_pos_holder == file_idx])
-            # Load each dataset
-            for dataset_idx in dataset_range:
-                dataset_name = data_dict[file_name]["Datasets"][dataset_idx]
-                # Get all the pattern local index
-                local_index = data_pos_holder[
-                    (file_pos_holder == file_idx) & (dataset_pos_holder == dataset_idx)]
+##################################################################
+#
+#       Approximate nearest neighbors
+#
+##################################################################
 
-                for l in local_index:
-                    pattern_holder[counter] = np.array(h5file[dataset_name][l])
-                    counter += 1
+def get_recall(index_approximate, index_exact):
+    """
+    Calculate the fraction of the exact nearest neighbors that are found by an approximate method.
+
+    :param index_approximate: The global indexes of the approximate nearest neighbors of some patterns.
+                              The shape is [pattern number, neighbor number].
+    :param index_exact: The global indexes of the exact nearest neighbors of the same patterns.
+    :return: The recall averaged over the patterns.
+    """
+    found_num = 0
+    for l in range(index_exact.shape[0]):
+        found_num += np.intersect1d(index_approximate[l], index_exact[l]).shape[0]
+
+    return found_num / float(index_exact.size)
+
+
+def get_recall_parallel(comm, index_approximate, index_exact):
+    """
+    Calculate the recall of an approximate method when each process holds the nearest neighbors of a
+    part of the sampled patterns. This has to be called by all the processes in comm.
+
+    :param comm: The MPI communicator.
+    :param index_approximate: The global indexes of the approximate nearest neighbors of the sampled patterns
+                              of this process. The shape is [pattern number, neighbor number].
+    :param index_exact: The global indexes of the exact nearest neighbors of the same patterns.
+    :return: The recall averaged over the sampled patterns of all the processes.
+    """
+    found_num = 0.
+    if index_exact.size > 0:
+        found_num = get_recall(index_approximate=index_approximate, index_exact=index_exact) * index_exact.size
 
-    return pattern_holder
+    return comm.allreduce(found_num) / float(max(comm.allreduce(index_exact.size), 1))
 
 
 ##################################################################
@@ -551,18 +977,20 @@ def get_sampled_pattern_batch_efficient(global_index_array, global_index_map, da
 #
 ##################################################################
 
-def save_correlation_values_and_positions(values, index_dim0, index_dim1,
+def save_correlation_values_and_positions(values, index_dim1,
                                           means, std, mask, output_address):
     """
     Save the arrays that can be converted into the Laplacian matrix into a hdf5 file.
     As I imagine, no one would want to calculate the correlation matrix a lot of times,
     therefore I don't need a timestamp to automatically distinguish different calculations.
 
+    The index along dimension 0 of values[i, j] is simply i. Therefore, it is not saved.
+    Use get_index_dim0 to get it.
+
     :param values: The values to save. Notice that this is a 2D numpy array. Dimension 0 represent
                     the index of the sample. Dimension 1 represent the nearest neighbors. The values
                     along each row decrease. i.e. values[i,j] >= values[i,j+1] holds for any i
                     and j.
-    :param index_dim0: The index along dimension 0 for each value.
     :param index_dim1: The index along dimension 1 for each value.
     :param means: The mean value of each data pattern.
     :param std: The standard deviation for each data pattern
@@ -575,7 +1003,6 @@ def save_correlation_values_and_positions(values, index_dim0, index_dim1,
 
     with h5py.File(output_address + "/partial_correlation_matrix.h5", 'w') as h5file:
         h5file.create_dataset('values', data=values, dtype=np.float64)
-        h5file.create_dataset('index_dim0', data=index_dim0, dtype=np.int64)
         h5file.create_dataset('index_dim1', data=index_dim1, dtype=np.int64)
         h5file.create_dataset('matrix_shape',
                               data=np.array([values.shape[0], values.shape[0]], dtype=np.int64),
@@ -586,6 +1013,115 @@ def save_correlation_values_and_positions(values, index_dim0, index_dim1,
         h5file.create_dataset('time_stamp', data=stamp)
 
 
+def save_correlation_values_and_positions_parallel(comm, values, index_dim1, means, std, global_idx_range,
+                                                   mask, output_address, file_name="partial_correlation_matrix.h5"):
+    """
+    Save the arrays that can be converted into the Laplacian matrix into a hdf5 file. Each process
+    writes its own rows, so that no process has to hold the whole matrix. This has to be called by
+    all the processes in comm.
+
+    If h5py is built with MPI, all the processes write to the same file with the MPI-IO driver.
+    Otherwise, each process writes its rows to a shard partial_correlation_matrix_rank_*.h5 and
+    partial_correlation_matrix.h5 contains virtual datasets mapping to the shards. In this case,
+    the shards have to stay in the same folder as partial_correlation_matrix.h5. With another
+    file_name, the shards are named after it, e.g. name_rank_*.h5 for name.h5.
+
+    :param comm: The MPI communicator.
+    :param values: The values of the rows of this process. None if this process has no row.
+    :param index_dim1: The index along dimension 1 for each value. None if this process has no row.
+    :param means: The mean value of each data pattern of this process. None if this process has no row.
+    :param std: The standard deviation for each data pattern of this process. None if this process has no row.
+    :param global_idx_range: The global index range [start, end) of the rows of this process.
+                             None if this process has no row.
+    :param mask: The mask utilized here.
+    :param output_address: The output folder to save the result.
+    :param file_name: The name of the output file in the output folder.
+    :return: None
+    """
+    comm_rank = comm.Get_rank()
+    output_file = output_address + "/" + file_name
+    shard_pattern = os.path.splitext(file_name)[0] + "_rank_{}.h5"
+
+    # Collect the row range of each process.
+    if values is None:
+        global_idx_range = (0, 0)
+    range_list = comm.allgather((int(global_idx_range[0]), int(global_idx_range[1])))
+    row_num = max([x[1] for x in range_list])
+    neighbor_number = max(comm.allgather(0 if values is None else values.shape[1]))
+    stamp = comm.bcast(datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d_%H_%M_%S'), root=0)
+
+    if h5py.get_config().mpi:
+        # All the processes write to the same file. Creating the datasets is collective.
+        with h5py.File(output_file, 'w', driver='mpio', comm=comm) as h5file:
+            values_dataset = h5file.create_dataset('values', shape=(row_num, neighbor_number), dtype=np.float64)
+            index_dataset = h5file.create_dataset('index_dim1', shape=(row_num, neighbor_number), dtype=np.int64)
+            means_dataset = h5file.create_dataset('means', shape=(row_num,), dtype=np.float64)
+            std_dataset = h5file.create_dataset('std', shape=(row_num,), dtype=np.float64)
+            h5file.create_dataset('matrix_shape', data=np.array([row_num, row_num], dtype=np.int64),
+                                  dtype=np.int64)
+            h5file.create_dataset('mask', data=mask, dtype=np.int64)
+            h5file.create_dataset('time_stamp', data=stamp)
+
+            if values is not None:
+                start, end = global_idx_range
+                values_dataset[start:end] = values
+                index_dataset[start:end] = index_dim1
+                means_dataset[start:end] = means
+                std_dataset[start:end] = std
+        return
+
+    # Each process writes its own shard.
+    shard_name = shard_pattern.format(comm_rank)
+    if values is not None:
+        with h5py.File(output_address + "/" + shard_name, 'w') as h5file:
+            h5file.create_dataset('values', data=values, dtype=np.float64)
+            h5file.create_dataset('index_dim1', data=index_dim1, dtype=np.int64)
+            h5file.create_dataset('means', data=means, dtype=np.float64)
+            h5file.create_dataset('std', data=std, dtype=np.float64)
+    comm.Barrier()  # Synchronize
+
+    if comm_rank == 0:
+        # Map the shards into the virtual datasets. The shards are found relative to the output file.
+        layouts = {'values': h5py.VirtualLayout(shape=(row_num, neighbor_number), dtype=np.float64),
+                   'index_dim1': h5py.VirtualLayout(shape=(row_num, neighbor_number), dtype=np.int64),
+                   'means': h5py.VirtualLayout(shape=(row_num,), dtype=np.float64),
+                   'std': h5py.VirtualLayout(shape=(row_num,), dtype=np.float64)}
+        for rank, (start, end) in enumerate(range_list):
+            if end == start:
+                continue
+            shard_name = shard_pattern.format(rank)
+            for key, layout in layouts.items():
+                shard_shape = (end - start,) + layout.shape[1:]
+                layout[start:end] = h5py.VirtualSource(shard_name, key, shape=shard_shape)
+
+        with h5py.File(output_file, 'w') as h5file:
+            for key, layout in layouts.items():
+                h5file.create_virtual_dataset(key, layout)
+            h5file.create_dataset('matrix_shape', data=np.array([row_num, row_num], dtype=np.int64),
+                                  dtype=np.int64)
+            h5file.create_dataset('mask', data=mask, dtype=np.int64)
+            h5file.create_dataset('time_stamp', data=stamp)
+    comm.Barrier()  # Synchronize
+
+
+def get_index_dim0(h5file, neighbor_number):
+    """
+    Get the index along dimension 0 for each value in the partial correlation matrix file.
+    The old files contain the dataset index_dim0. For the new files, the index along dimension 0
+    of values[i, j] is simply i.
+
+    :param h5file: The opened partial_correlation_matrix.h5 file.
+    :param neighbor_number: The number of neighbors to keep.
+    :return: The index along dimension 0 with the same shape as values[:, :neighbor_number].
+    """
+    if 'index_dim0' in h5file:
+        return np.array(h5file['index_dim0'])[:, :neighbor_number]
+
+    row_num, column_num = h5file['values'].shape
+    return np.outer(np.arange(row_num, dtype=np.int64),
+                    np.ones(min(neighbor_number, column_num), dtype=np.int64))
+
+
 def load_distance_matrix(correlation_matrix_file, neighbor_number,
                          symmetric=True, keep_diagonal=False):
     """
@@ -599,37 +1135,146 @@ def load_distance_matrix(correlation_matrix_file, neighbor_number,
     # Load the data first
     with h5py.File(correlation_matrix_file, 'r') as h5file:
         values = np.array(h5file['values'])[:, :neighbor_number]
-        idx_dim0 = np.array(h5file['index_dim0'])[:, :neighbor_number]
+        idx_dim0 = get_index_dim0(h5file=h5file, neighbor_number=neighbor_number)
         idx_dim1 = np.array(h5file['index_dim1'])[:, :neighbor_number]
         matrix_shape = np.array(h5file['matrix_shape'])
 
-    # Extract some meta data
-    site_number = np.prod(values.shape)
-    values = values.reshape(site_number)
-    idx_dim0 = idx_dim0.reshape(site_number)
-    idx_dim1 = idx_dim1.reshape(site_number)
-
-    # Construct a sparse weight matrix
-    matrix = scipy.sparse.coo_matrix((values, (idx_dim0, idx_dim1)),
-                                     shape=tuple(matrix_shape))
-
     # Depending on the parameter, decide whether to symmetrize the matrix or not.
     if symmetric:
-        # Cast the weight matrix to a symmetric format.
-        matrix_trans = matrix.transpose(copy=True)
-        matrix_sym = (matrix + matrix_trans) / 2.
-        matrix_asym = (matrix - matrix_trans) / 2.
-        np.absolute(matrix_asym.data, out=matrix_asym.data)
-        matrix_sym += matrix_asym
-        # Remove the diagonal term
-        if not keep_diagonal:
-            matrix_sym.setdiag(values=0, k=0)
-
+        # The transposed entries are the same entries with the two indexes swapped.
+        matrix_sym = get_symmetric_distance_csr(values=values,
+                                                index_dim1=idx_dim1,
+                                                rows_trans=idx_dim1.reshape(-1),
+                                                cols_trans=idx_dim0.reshape(-1),
+                                                values_trans=values.reshape(-1),
+                                                row_range=(0, int(matrix_shape[0])),
+                                                column_num=int(matrix_shape[1]),
+                                                keep_diagonal=keep_diagonal)
         return matrix_sym, matrix_shape
     else:
+        # Extract some meta data
+        site_number = np.prod(values.shape)
+        values = values.reshape(site_number)
+        idx_dim0 = idx_dim0.reshape(site_number)
+        idx_dim1 = idx_dim1.reshape(site_number)
+
+        # Construct a sparse weight matrix
+        matrix = scipy.sparse.coo_matrix((values, (idx_dim0, idx_dim1)),
+                                         shape=tuple(matrix_shape))
         return matrix, matrix_shape
 
 
+def get_symmetric_distance_csr(values, index_dim1, rows_trans, cols_trans, values_trans, row_range, column_num,
+                               keep_diagonal=False):
+    """
+    Symmetrize the rows of the distance matrix with (M + M^T) / 2 + |M - M^T| / 2 directly in the csr
+    format without temporary sparse matrices. If keep_diagonal is False, the diagonal entry of each
+    row is set to 0.
+
+    :param values: The values of the nearest neighbors of the rows. This is sorted in place if it is
+                   a contiguous float64 array.
+    :param index_dim1: The index along dimension 1 for each value. This is sorted in place if it is
+                       a contiguous int64 array.
+    :param rows_trans: The global row index of each transposed entry belonging to the rows.
+    :param cols_trans: The column index of each transposed entry.
+    :param values_trans: The value of each transposed entry.
+    :param row_range: The global index range [start, end) of the rows.
+    :param column_num: The number of columns of the whole matrix.
+    :param keep_diagonal: Whether to keep the diagonal term.
+    :return: The csr sparse matrix of the symmetrized rows.
+    """
+    start, end = row_range
+    row_num = end - start
+
+    # The transposed entries of the rows. This is done before the sorting since the transposed
+    # entries might be views of the values and index_dim1.
+    indptr_trans = np.zeros(row_num + 1, dtype=np.int64)
+    indices_trans = np.empty(rows_trans.shape[0], dtype=np.int64)
+    data_trans = np.empty(rows_trans.shape[0], dtype=np.float64)
+    Graph.coo_to_csr(rows_trans.astype(np.int64, copy=False), cols_trans.astype(np.int64, copy=False),
+                     values_trans.astype(np.float64, copy=False),
+                     start, indptr_trans, indices_trans, data_trans)
+
+    # The rows themselves with the indexes in increasing order
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    index_dim1 = np.ascontiguousarray(index_dim1, dtype=np.int64)
+    Graph.sort_rows_by_index(index_dim1, values)
+    indptr = np.arange(row_num + 1, dtype=np.int64) * values.shape[1]
+
+    # Count the entries of each symmetric row first and then fill them
+    indptr_sym = np.zeros(row_num + 1, dtype=np.int64)
+    Graph.symmetrize_csr(indptr, index_dim1.reshape(-1), values.reshape(-1), indptr_trans, indices_trans, data_trans,
+                         start, keep_diagonal, indptr_sym, np.zeros(0, dtype=np.int64), np.zeros(0), False)
+    np.cumsum(indptr_sym, out=indptr_sym)
+
+    indices_sym = np.empty(indptr_sym[-1], dtype=np.int64)
+    data_sym = np.empty(indptr_sym[-1], dtype=np.float64)
+    Graph.symmetrize_csr(indptr, index_dim1.reshape(-1), values.reshape(-1), indptr_trans, indices_trans, data_trans,
+                         start, keep_diagonal, indptr_sym, indices_sym, data_sym, True)
+
+    return scipy.sparse.csr_matrix((data_sym, indices_sym, indptr_sym), shape=(row_num, column_num))
+
+
+def get_symmetric_distance_matrix_from_neighbors(values, index_dim1, neighbor_number, matrix_shape,
+                                                 keep_diagonal=False):
+    """
+    Symmetrize the distance matrix of the first neighbor_number nearest neighbors of all the rows in the
+    same way as load_distance_matrix. The neighbors are kept in memory so that the matrices with different
+    neighbor numbers can be derived without loading the h5 file again.
+
+    :param values: The values of the nearest neighbors of all the rows with the nearest ones first as in
+                   partial_correlation_matrix.h5. This is not modified.
+    :param index_dim1: The index along dimension 1 for each value. This is not modified.
+    :param neighbor_number: The number of neighbors to keep.
+    :param matrix_shape: The shape of the whole matrix.
+    :param keep_diagonal: Whether to keep the diagonal term.
+    :return: The csr sparse matrix of the symmetrized distance matrix.
+    """
+    row_num = values.shape[0]
+
+    # Copy the neighbors since they are sorted by the index in place.
+    values = np.array(values[:, :neighbor_number], dtype=np.float64)
+    index_dim1 = np.array(index_dim1[:, :neighbor_number], dtype=np.int64)
+
+    return get_symmetric_distance_csr(values=values,
+                                      index_dim1=index_dim1,
+                                      rows_trans=index_dim1.reshape(-1),
+                                      cols_trans=np.repeat(np.arange(row_num, dtype=np.int64), values.shape[1]),
+                                      values_trans=values.reshape(-1),
+                                      row_range=(0, row_num),
+                                      column_num=int(matrix_shape[1]),
+                                      keep_diagonal=keep_diagonal)
+
+
+def get_laplacian_csr(weight_matrix, row_start, inv_sqrt_degree):
+    """
+    Construct the rows of the symmetric normalized laplacian matrix I - D^(-1/2) W D^(-1/2). The weight
+    matrix is reused for the laplacian matrix when each row contains its diagonal entry.
+
+    :param weight_matrix: The csr sparse matrix of the rows of the weight matrix with sorted indices.
+    :param row_start: The global row index of the first row.
+    :param inv_sqrt_degree: The inverse square root of the degree of all the rows.
+    :return: The csr sparse matrix of the rows of the laplacian matrix.
+    """
+    indptr, indices, data = weight_matrix.indptr, weight_matrix.indices, weight_matrix.data
+    row_num = indptr.shape[0] - 1
+
+    row_nnz = np.empty(row_num, dtype=indptr.dtype)
+    Graph.get_laplacian_row_nnz(indptr, indices, row_start, row_nnz)
+    if np.sum(row_nnz) == indices.shape[0]:
+        # All the diagonal entries exist. Calculate in place.
+        indptr_out, indices_out, data_out = indptr, indices, data
+    else:
+        indptr_out = np.zeros(row_num + 1, dtype=indptr.dtype)
+        np.cumsum(row_nnz, out=indptr_out[1:])
+        indices_out = np.empty(indptr_out[-1], dtype=indices.dtype)
+        data_out = np.empty(indptr_out[-1], dtype=np.float64)
+
+    Graph.symmetric_normalized_laplacian(indptr, indices, data, row_start, inv_sqrt_degree,
+                                         indptr_out, indices_out, data_out)
+    return scipy.sparse.csr_matrix((data_out, indices_out, indptr_out), shape=weight_matrix.shape)
+
+
 def convert_to_laplacian_matrix(laplacian_type,
                                 distance_matrix,
                                 tau):
@@ -644,16 +1289,16 @@ def convert_to_laplacian_matrix(laplacian_type,
     """
     if laplacian_type == "symmetric normalized laplacian":
 
-        # Add the exponential to get connection matrix
-        np.exp(-distance_matrix.data / tau, out=distance_matrix.data)
+        distance_matrix = distance_matrix.tocsr().astype(np.float64, copy=False)
+        distance_matrix.sort_indices()
 
-        # Get the degree matrix
-        degree = Graph.inverse_sqrt_degree_mat(weight_matrix=distance_matrix)
+        # Add the exponential to get connection matrix and get the degree
+        degree = np.empty(distance_matrix.shape[0], dtype=np.float64)
+        Graph.exp_kernel_and_degree(distance_matrix.indptr, distance_matrix.data, float(tau), degree)
 
         # Calculate the laplacian matrix
-        csr_matrix = Graph.get_symmetric_normalized_laplacian(degree_matrix=degree,
-                                                              weight_matrix=distance_matrix)
-        csr_matrix.tocsr()
+        csr_matrix = get_laplacian_csr(weight_matrix=distance_matrix, row_start=0,
+                                       inv_sqrt_degree=1. / np.sqrt(degree))
     else:
         raise Exception(
             "Currently, the only available Laplacian matrix " +
@@ -662,7 +1307,169 @@ def convert_to_laplacian_matrix(laplacian_type,
     return csr_matrix
 
 
-def save_eigensystem_and_calculation_parameters(eigenvectors, eigenvalues, tau, config):
+def load_distance_matrix_rows(correlation_matrix_file, neighbor_number, row_range):
+    """
+    Load the nearest neighbors of the rows in row_range from the specified h5 file.
+
+    :param correlation_matrix_file: The hdf5 file containing the information of the weight matrix.
+    :param neighbor_number: The number of neighbors to keep.
+    :param row_range: The global index range [start, end) of the rows to load.
+    :return: values, index_dim1, matrix_shape
+    """
+    start, end = row_range
+    with h5py.File(correlation_matrix_file, 'r') as h5file:
+        values = np.array(h5file['values'][start:end, :neighbor_number])
+        idx_dim1 = np.array(h5file['index_dim1'][start:end, :neighbor_number])
+        matrix_shape = np.array(h5file['matrix_shape'])
+
+    return values, idx_dim1, matrix_shape
+
+
+def get_symmetric_distance_matrix_rows(comm, values, index_dim1, row_range_list, matrix_shape,
+                                       keep_diagonal=False):
+    """
+    Symmetrize the distance matrix in the same way as load_distance_matrix while each process only
+    holds the rows in its own row range. The transposed entries are sent to the process holding
+    the corresponding rows with an all-to-all exchange. This has to be called by all the processes in comm.
+
+    :param comm: The MPI communicator.
+    :param values: The values of the rows of this process.
+    :param index_dim1: The index along dimension 1 for each value.
+    :param row_range_list: The global index range [start, end) of the rows of each process.
+    :param matrix_shape: The shape of the whole matrix.
+    :param keep_diagonal: Whether to keep the diagonal term.
+    :return: The csr sparse matrix of the symmetrized rows of this process. The shape is
+             (end - start, matrix_shape[1]).
+    """
+    start, end = row_range_list[comm.Get_rank()]
+
+    # The entries of the local rows
+    idx_dim0 = np.repeat(np.arange(start, end, dtype=np.int64), values.shape[1])
+    idx_dim1 = index_dim1.reshape(-1)
+
+    # Send the transposed entries to the process holding the corresponding rows
+    row_ends = np.array([x[1] for x in row_range_list], dtype=np.int64)
+    destination = np.searchsorted(row_ends, idx_dim1, side='right')
+    order = np.argsort(destination, kind='stable')
+    splits = np.searchsorted(destination[order], np.arange(1, len(row_range_list)))
+    send_list = [(x, y, z) for x, y, z in zip(np.split(idx_dim1[order], splits),
+                                              np.split(idx_dim0[order], splits),
+                                              np.split(values.reshape(-1)[order], splits))]
+    del idx_dim0, destination, order
+    recv_list = comm.alltoall(send_list)
+    del send_list
+
+    rows_trans = np.concatenate([x[0] for x in recv_list])
+    cols_trans = np.concatenate([x[1] for x in recv_list])
+    values_trans = np.concatenate([x[2] for x in recv_list])
+    del recv_list
+
+    return get_symmetric_distance_csr(values=np.array(values, dtype=np.float64),
+                                      index_dim1=np.array(index_dim1, dtype=np.int64),
+                                      rows_trans=rows_trans,
+                                      cols_trans=cols_trans,
+                                      values_trans=values_trans,
+                                      row_range=(start, end),
+                                      column_num=int(matrix_shape[1]),
+                                      keep_diagonal=keep_diagonal)
+
+
+def convert_to_laplacian_matrix_rows(comm, laplacian_type, distance_matrix, row_range, tau):
+    """
+    Assemble the rows of the Laplacian matrix of this process from the rows of the symmetric distance
+    matrix in the same way as convert_to_laplacian_matrix. This has to be called by all the processes in comm.
+
+    :param comm: The MPI communicator.
+    :param laplacian_type: The type of Laplacian matrix to construct.
+    :param distance_matrix: The csr sparse matrix of the rows of this process from
+                            get_symmetric_distance_matrix_rows.
+    :param row_range: The global index range [start, end) of the rows of this process.
+    :param tau: The casting parameter: correlation np.exp(correlation/tau)
+    :return: The csr sparse matrix of the rows of the Laplacian matrix of this process.
+    """
+    if laplacian_type != "symmetric normalized laplacian":
+        raise Exception(
+            "Currently, the only available Laplacian matrix " +
+            "type is \"symmetric normalized laplacian\".")
+
+    start, end = row_range
+    row_num = distance_matrix.shape[0]
+
+    distance_matrix.sort_indices()
+
+    # Add the exponential to get connection matrix and get the degree.
+    # Because the weight matrix is symmetric, the degree of the local rows is the sum along dimension 1.
+    degree = np.empty(row_num, dtype=np.float64)
+    Graph.exp_kernel_and_degree(distance_matrix.indptr, distance_matrix.data, float(tau), degree)
+
+    # The degrees of all the columns are collected from the other processes.
+    inv_sqrt_degree = np.concatenate(comm.allgather(1. / np.sqrt(degree)))
+
+    # Calculate the laplacian matrix
+    return get_laplacian_csr(weight_matrix=distance_matrix, row_start=start, inv_sqrt_degree=inv_sqrt_degree)
+
+
+def solve_laplacian_eigensystem(laplacian_matrix, eig_num, solver="arpack", tol=1e-8, max_iteration=10000, seed=0,
+                                initial_vectors=None):
+    """
+    Solve for the eig_num smallest eigenvalues and the corresponding eigenvectors of the symmetric
+    normalized laplacian matrix in this process without PETSc and SLEPc.
+
+    The eigenvalues of L = I - D^(-1/2) W D^(-1/2) are within [0, 2]. The "arpack" solver finds the
+    largest eigenvalues of 2I - L with the implicitly restarted Lanczos method, which are the smallest
+    eigenvalues of L, so no factorization of the matrix is needed. The "lobpcg" solver finds the smallest
+    eigenvalues of L directly from a random initial block. When the eigenvectors of a previous calculation
+    are given, the "lobpcg" solver starts from them and the "arpack" solver starts from their sum.
+
+    :param laplacian_matrix: The csr sparse laplacian matrix from convert_to_laplacian_matrix.
+    :param eig_num: The number of (eigenvector, eigenvalue) pairs to compute.
+    :param solver: "arpack" or "lobpcg".
+    :param tol: The relative tolerance of the eigenvalues.
+    :param max_iteration: The maximal number of iterations.
+    :param seed: The seed of the initial vectors.
+    :param initial_vectors: The eigenvectors of a previous calculation of the shape [number, matrix size]
+                            to start from, e.g. from load_initial_eigenvectors. Leave None to start from
+                            random vectors.
+    :return: The eigenvalues in increasing order and the eigenvectors of the shape [eig_num, matrix size].
+    """
+    size = laplacian_matrix.shape[0]
+    if eig_num >= size:
+        raise Exception("eig_num has to be smaller than the size of the laplacian matrix.")
+
+    rng = np.random.RandomState(seed)
+
+    # The initial block. The missing vectors are random.
+    initial_block = rng.standard_normal((size, eig_num))
+    if initial_vectors is not None:
+        vector_num = min(eig_num, initial_vectors.shape[0])
+        initial_block[:, :vector_num] = initial_vectors[:vector_num].T
+
+    if solver == "arpack":
+        # The operator 2I - L shares the eigenvectors with L.
+        shifted = scipy.sparse.linalg.LinearOperator(shape=laplacian_matrix.shape,
+                                                     matvec=lambda x: 2. * x - laplacian_matrix.dot(x),
+                                                     dtype=np.float64)
+        eigenvalues, eigenvectors = scipy.sparse.linalg.eigsh(shifted, k=eig_num, which="LA", tol=tol,
+                                                              maxiter=max_iteration,
+                                                              v0=np.sum(initial_block, axis=1))
+        eigenvalues = 2. - eigenvalues
+
+    elif solver == "lobpcg":
+        eigenvalues, eigenvectors = scipy.sparse.linalg.lobpcg(laplacian_matrix,
+                                                               X=initial_block,
+                                                               tol=tol,
+                                                               maxiter=max_iteration,
+                                                               largest=False)
+    else:
+        raise Exception("The solver has to be either \"arpack\" or \"lobpcg\".")
+
+    # Sort the eigen-pairs by the eigenvalues
+    order = np.argsort(eigenvalues)
+    return eigenvalues[order], np.ascontiguousarray(eigenvectors[:, order].T)
+
+
+def save_eigensystem_and_calculation_parameters(eigenvectors, eigenvalues, tau, config, neighbor_number=None,
+                                                suffix=""):
     """
     Save the eigensystem and the parameters used to obtain this result.
     Use a timestamp to distinguish different calculations.
@@ -671,65 +1478,472 @@ def save_eigensystem_and_calculation_parameters(eigenvectors, eigenvalues, tau,
     :param eigenvalues: The eigenvalue for each eigenvector.
     :param config: The configuration dictionary.
     :param tau: The calculated sigma value
-    :return: None
+    :param neighbor_number: The neighbor number of the Laplacian matrix. Leave None to use the value in config.
+    :param suffix: A string appended to the timestamp to distinguish the calculations within the same second.
+    :return: The name of the eigensystem file.
     """
+    if neighbor_number is None:
+        neighbor_number = config["neighbor_number_Laplacian_matrix"]
+
     # Create a time stamp
     stamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d_%H_%M_%S')
+    file_name = config["output_folder"] + "/eigensystem_{}{}.h5".format(stamp, suffix)
 
-    with h5py.File(config["output_folder"] + "/eigensystem_{}.h5".format(stamp), 'w') as h5file:
+    with h5py.File(file_name, 'w') as h5file:
         h5file.create_dataset("eigenvalues", data=eigenvalues, dtype=np.float64)
         h5file.create_dataset("eigenvectors", data=eigenvectors, dtype=np.float64)
-        h5file.create_dataset("neighbor_number", data=config["neighbor_number_Laplacian_matrix"],
-                              dtype=np.int64)
+        h5file.create_dataset("neighbor_number", data=neighbor_number, dtype=np.int64)
         h5file.create_dataset("tau", data=tau, dtype=np.float64)
         h5file.create_dataset("keep_diagonal", data=config["keep_diagonal"], dtype=np.float64)
 
+    return file_name
+
+
+def append_to_sweep_index(index_file, eigensystem_file, neighbor_number, tau):
+    """
+    Record which eigensystem file belongs to which parameters of a sweep. Each line of the index file
+    contains the eigensystem file, the neighbor number and tau separated by commas.
+
+    :param index_file: The csv index file. It is created with a header if it does not exist.
+    :param eigensystem_file: The eigensystem file from save_eigensystem_and_calculation_parameters.
+    :param neighbor_number: The neighbor number of the Laplacian matrix.
+    :param tau: The tau of the Laplacian matrix.
+    :return: None
+    """
+    new_file = not os.path.exists(index_file)
+    with open(index_file, 'a') as txtfile:
+        if new_file:
+            txtfile.write("eigensystem_file,neighbor_number,tau\n")
+        txtfile.write("{},{},{!r}\n".format(os.path.basename(eigensystem_file), neighbor_number, float(tau)))
+
+
+def load_initial_eigenvectors(eigensystem_file, matrix_size, row_range=None):
+    """
+    Load the eigenvectors from a previous eigensystem_*.h5 file to start the eigensolver from.
+
+    :param eigensystem_file: The eigensystem file saved by save_eigensystem_and_calculation_parameters.
+    :param matrix_size: The size of the current laplacian matrix.
+    :param row_range: The global index range [start, end) of the rows to load. Leave None to load all the rows.
+    :return: The eigenvectors of the shape [number of eigenvectors, end - start].
+    """
+    with h5py.File(eigensystem_file, 'r') as h5file:
+        if h5file['eigenvectors'].shape[1] != matrix_size:
+            raise Exception("The eigenvectors in {} do not have the same size ".format(eigensystem_file) +
+                            "as the current laplacian matrix.")
+        if row_range is None:
+            return np.array(h5file['eigenvectors'])
+        return np.array(h5file['eigenvectors'][:, row_range[0]:row_range[1]])
+
+
+def get_distance_matrix_cache_signature(correlation_matrix_file, neighbor_number, keep_diagonal, row_range):
+    """
+    Get the signature of the symmetrized rows of the distance matrix. A cache is only loaded if the
+    signature is the same.
+
+    :param correlation_matrix_file: The hdf5 file containing the information of the weight matrix.
+    :param neighbor_number: The number of neighbors to keep.
+    :param keep_diagonal: Whether to keep the diagonal term.
+    :param row_range: The global index range [start, end) of the rows.
+    :return: A numpy array describing the rows.
+    """
+    return np.array([neighbor_number, int(keep_diagonal), row_range[0], row_range[1],
+                     os.stat(correlation_matrix_file).st_mtime_ns], dtype=np.int64)
+
+
+def save_distance_matrix_cache(cache_prefix, matrix, signature):
+    """
+    Save the symmetrized rows of the distance matrix so that the next calculation with a different tau
+    does not have to load and symmetrize them again.
+
+    :param cache_prefix: The address of the cache without the extension.
+    :param matrix: The csr sparse matrix of the symmetrized rows.
+    :param signature: The signature from get_distance_matrix_cache_signature.
+    :return: None
+    """
+    tmp_file = cache_prefix + "_tmp.npz"
+    with open(tmp_file, 'wb') as cache:
+        np.savez(cache, signature=signature, shape=np.array(matrix.shape, dtype=np.int64),
+                 indptr=matrix.indptr, indices=matrix.indices, data=matrix.data)
+    os.replace(tmp_file, cache_prefix + ".npz")
+
+
+def load_distance_matrix_cache(cache_prefix, signature):
+    """
+    Load the symmetrized rows of the distance matrix saved by save_distance_matrix_cache.
+
+    :param cache_prefix: The address of the cache without the extension.
+    :param signature: The signature from get_distance_matrix_cache_signature.
+    :return: The csr sparse matrix of the symmetrized rows. None if there is no cache with the same signature.
+    """
+    if not os.path.exists(cache_prefix + ".npz"):
+        return None
+
+    with np.load(cache_prefix + ".npz") as cache:
+        if not np.array_equal(cache["signature"], signature):
+            return None
+        return scipy.sparse.csr_matrix((cache["data"], cache["indices"], cache["indptr"]),
+                                       shape=tuple(cache["shape"]))
+
+
+##################################################################
+#
+#       Checkpoint
+#
+##################################################################
+def save_checkpoint(checkpoint_prefix, progress, signature, **arrays):
+    """
+    Save the progress of a calculation and the arrays to continue it.
+
+    The checkpoint is first written to a temporary file and then renamed so that an interrupted write
+    never damages an existing checkpoint. The previous checkpoint is kept as a second generation.
+
+    :param checkpoint_prefix: The address of the checkpoint without the extension.
+    :param progress: An integer describing how much of the calculation is finished.
+    :param signature: A numpy array describing the calculation. A checkpoint is only loaded if the
+                      signature is the same.
+    :param arrays: The numpy arrays to save.
+    :return: None
+    """
+    tmp_file = checkpoint_prefix + "_tmp.npz"
+    with open(tmp_file, 'wb') as checkpoint:
+        np.savez(checkpoint, progress=progress, signature=signature, **arrays)
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+
+    if os.path.exists(checkpoint_prefix + ".npz"):
+        os.replace(checkpoint_prefix + ".npz", checkpoint_prefix + "_previous.npz")
+    os.replace(tmp_file, checkpoint_prefix + ".npz")
+
+
+def load_checkpoints(checkpoint_prefix, signature):
+    """
+    Load the checkpoints saved by save_checkpoint.
+
+    :param checkpoint_prefix: The address of the checkpoint without the extension.
+    :param signature: The signature of the current calculation.
+    :return: A list of dictionaries containing the progress and the arrays of each checkpoint. The latest
+             checkpoint comes first. The list is empty if there is no checkpoint.
+    """
+    checkpoints = []
+    for checkpoint_file in [checkpoint_prefix + ".npz", checkpoint_prefix + "_previous.npz"]:
+        if not os.path.exists(checkpoint_file):
+            continue
+
+        with np.load(checkpoint_file) as checkpoint:
+            if not np.array_equal(checkpoint["signature"], signature):
+                raise Exception("The checkpoint {} does not belong to the current calculation.".format(checkpoint_file))
+            checkpoints.append({key: checkpoint[key] for key in checkpoint.files})
+
+    return checkpoints
+
+
+def remove_checkpoints(checkpoint_prefix):
+    """
+    Remove the checkpoints saved by save_checkpoint.
+
+    :param checkpoint_prefix: The address of the checkpoint without the extension.
+    :return: None
+    """
+    for checkpoint_file in [checkpoint_prefix + ".npz", checkpoint_prefix + "_previous.npz"]:
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
 
 ##################################################################
 #
 #       Data Loader
 #
 ##################################################################
-def h5_dataloader(batch_dict, pattern_number, pattern_shape):
+def get_batch_read_list(batch_dict):
+    """
+    List the pattern ranges to read for a batch and where each range goes in the batch.
+
+    :param batch_dict: The dictionary specifying which dataset to read and how many
+                        patterns to read from each dataset.
+    :return: A list of (file name, dataset name, starting local index, ending local index,
+             starting position in the batch)
+    """
+    read_list = []
+    counter = 0
+    for file_name in batch_dict["files"]:
+        data_name_list = batch_dict[file_name]["Datasets"]
+        data_ends_list = batch_dict[file_name]["Ends"]
+
+        for data_idx in range(len(data_name_list)):
+            start, end = int(data_ends_list[data_idx][0]), int(data_ends_list[data_idx][1])
+            read_list.append((file_name, data_name_list[data_idx], start, end, counter))
+            counter += end - start
+
+    return read_list
+
+
+def _read_pattern_range(file_name, data_name, start, end, holder, position):
+    """
+    Read the patterns from start to end of the dataset directly into holder[position:].
+
+    :param file_name: The h5 file.
+    :param data_name: The dataset in the h5 file.
+    :param start: The starting local index.
+    :param end: The ending local index.
+    :param holder: The C-contiguous array to read into.
+    :param position: The position in the holder of the first pattern.
+    :return: None
+    """
+    if end <= start:
+        return
+    with open_h5_file(file_name) as h5file:
+        h5file[data_name].read_direct(holder, source_sel=np.s_[start:end],
+                                      dest_sel=np.s_[position:position + end - start])
+
+
+def h5_dataloader(batch_dict, pattern_number, pattern_shape, dtype=np.float64, thread_num=None):
     """
     Use this function to load the data
+
+    Each range of patterns is read with read_direct into its slice of the returned array, so the
+    patterns are converted to dtype without an intermediate copy. With thread_num > 1, the ranges are
+    read by a pool of threads. Notice that h5py holds a global lock during each call to the HDF5
+    library, so the threads only help when the file system latency, rather than the HDF5 library,
+    limits the reading.
+
     :param batch_dict: The dictionary specifying which dataset to read and how many
                         patterns to read from each dataset.
     :param pattern_number: The number of patterns in this batch
     :param pattern_shape: The shape of each pattern.
+    :param dtype: The dtype of the returned array.
+    :param thread_num: The number of threads to read with. The default is read_thread_num of the shared
+                       pool of h5 files.
     :return: A numpy array containing the corresponding patterns.
     """
     # First, create a holder for the data
-    holder = np.empty((pattern_number,) + tuple(pattern_shape), dtype=np.float64)
-    # Get a counter to remember where we are when loading the patterns
-    counter = 0
+    holder = np.empty((pattern_number,) + tuple(pattern_shape), dtype=dtype)
 
-    # Second, iteratively open each file and load the dataset
-    for file_name in batch_dict["files"]:
-        with h5py.File(file_name, 'r') as h5file:
-            # Get the dataset names and the range in that dataset
-            data_name_list = batch_dict[file_name]["Datasets"]
-            data_ends_list = batch_dict[file_name]["Ends"]
+    # Second, find the slice of the holder for each range of patterns
+    read_list = get_batch_read_list(batch_dict=batch_dict)
+    if read_list and read_list[-1][4] + read_list[-1][3] - read_list[-1][2] != pattern_number:
+        raise Exception("The pattern number does not agree with the batch.")
+
+    if thread_num is None:
+        thread_num = _h5_file_pool.read_thread_num
+
+    # Third, load each range of patterns into its slice
+    if thread_num <= 1 or len(read_list) <= 1:
+        for file_name, data_name, start, end, position in read_list:
+            _read_pattern_range(file_name, data_name, start, end, holder, position)
+    else:
+        with ThreadPoolExecutor(max_workers=min(thread_num, len(read_list))) as executor:
+            futures = [executor.submit(_read_pattern_range, file_name, data_name, start, end, holder, position)
+                       for file_name, data_name, start, end, position in read_list]
+            for future in futures:
+                future.result()
+
+    return holder
+
+
+def get_mask_bounding_box(bool_mask_1d, pattern_shape):
+    """
+    Get the smallest box containing all the unmasked pixels.
 
-            for data_idx in range(len(data_name_list)):
-                data_name = data_name_list[data_idx]
+    :param bool_mask_1d: The 1D boolean mask
+    :param pattern_shape: The shape of each pattern.
+    :return: crop, crop_mask_1d. crop is a tuple of slices along each axis of the pattern. crop_mask_1d
+             is the 1D boolean mask of the pixels in the box. The unmasked pixels in the box are in the
+             same order as in the full pattern.
+    """
+    bool_mask = np.reshape(bool_mask_1d, pattern_shape)
+    if not np.any(bool_mask):
+        raise Exception("The mask does not contain any unmasked pixel.")
+
+    crop = []
+    for axis in range(bool_mask.ndim):
+        pixel_along_axis = np.nonzero(np.any(bool_mask, axis=tuple(x for x in range(bool_mask.ndim) if x != axis)))[0]
+        crop.append(slice(int(pixel_along_axis[0]), int(pixel_along_axis[-1]) + 1))
+    crop = tuple(crop)
+
+    return crop, bool_mask[crop].reshape(-1)
+
+
+def _read_masked_pattern_range(file_name, data_name, start, end, holder, position, crop, crop_mask_1d,
+                               chunk_pattern_num, stat_holder=None):
+    """
+    Read the unmasked pixels of the patterns from start to end of the dataset into holder[position:].
+
+    The patterns are read chunk by chunk. Only the bounding box of the mask is read for each pattern.
+    The unmasked pixels in the box are then copied into the holder. The mean and std of each chunk are
+    calculated while the chunk is still in the cache.
+
+    :param file_name: The h5 file.
+    :param data_name: The dataset in the h5 file.
+    :param start: The starting local index.
+    :param end: The ending local index.
+    :param holder: The array of the shape [pattern number, unmasked pixel number] to read into.
+    :param position: The position in the holder of the first pattern.
+    :param crop: The bounding box from get_mask_bounding_box.
+    :param crop_mask_1d: The 1D boolean mask of the pixels in the bounding box.
+    :param chunk_pattern_num: The number of patterns to read at a time.
+    :param stat_holder: The holder of the shape [2, pattern number] for the mean and std of each pattern
+                        or None.
+    :return: None
+    """
+    if end <= start:
+        return
+
+    crop_shape = tuple(x.stop - x.start for x in crop)
+    full_box = bool(np.all(crop_mask_1d))
+    buffer = None if full_box else np.empty((min(chunk_pattern_num, end - start),) + crop_shape,
+                                            dtype=holder.dtype)
+
+    with open_h5_file(file_name) as h5file:
+        dataset = h5file[data_name]
+        for chunk_start in range(start, end, chunk_pattern_num):
+            chunk_end = min(chunk_start + chunk_pattern_num, end)
+            chunk_num = chunk_end - chunk_start
+            holder_start = position + chunk_start - start
+
+            if full_box:
+                # All the pixels in the box are unmasked. Read into the holder directly.
+                dataset.read_direct(holder[holder_start:holder_start + chunk_num].reshape((chunk_num,) + crop_shape),
+                                    source_sel=(slice(chunk_start, chunk_end),) + crop)
+            else:
+                dataset.read_direct(buffer, source_sel=(slice(chunk_start, chunk_end),) + crop,
+                                    dest_sel=np.s_[:chunk_num])
+                np.compress(crop_mask_1d, buffer[:chunk_num].reshape((chunk_num, -1)), axis=1,
+                            out=holder[holder_start:holder_start + chunk_num])
+
+            if stat_holder is not None:
+                # This may run in a loader thread, so the kernel must not start a parallel region.
+                Graph.pattern_mean_and_std_serial(holder[holder_start:holder_start + chunk_num],
+                                                  stat_holder[0, holder_start:holder_start + chunk_num],
+                                                  stat_holder[1, holder_start:holder_start + chunk_num])
+
+
+def h5_masked_dataloader(batch_dict, pattern_number, pattern_shape, bool_mask_1d, dtype=np.float64,
+                         chunk_nbytes=64 * 1024 ** 2, thread_num=None, stat_holder=None):
+    """
+    Load the unmasked pixels of the patterns. This gives the same result as
+
+        h5_dataloader(...).reshape((pattern_number, -1))[:, bool_mask_1d]
+
+    but the full patterns are never held in memory. Only the bounding box of the mask is read,
+    chunk by chunk, and the unmasked pixels are copied into the returned array.
 
-                # Obtain a holder for this dataset
-                tmp_data_holder = h5file[data_name]
-                # Calculate the patter number
-                p_num = data_ends_list[data_idx][1] - data_ends_list[data_idx][0]
+    :param batch_dict: The dictionary specifying which dataset to read and how many
+                        patterns to read from each dataset.
+    :param pattern_number: The number of patterns in this batch
+    :param pattern_shape: The shape of each pattern.
+    :param bool_mask_1d: The 1D boolean mask
+    :param dtype: The dtype of the returned array.
+    :param chunk_nbytes: The size in bytes of the buffer of the bounding boxes of each thread.
+    :param thread_num: The number of threads to read with. The default is read_thread_num of the shared
+                       pool of h5 files.
+    :param stat_holder: A float64 array of the shape [2, pattern number] or None. If this is not None, the mean
+                        value and the standard deviation of the unmasked pixels of each pattern are calculated
+                        with Graph.pattern_mean_and_std_serial in the same pass and saved into it.
+    :return: A numpy array of the shape [pattern number, unmasked pixel number].
+    """
+    crop, crop_mask_1d = get_mask_bounding_box(bool_mask_1d=bool_mask_1d, pattern_shape=pattern_shape)
+    chunk_pattern_num = max(1, int(chunk_nbytes // (crop_mask_1d.shape[0] * np.dtype(dtype).itemsize)))
+
+    holder = np.empty((pattern_number, int(np.sum(crop_mask_1d))), dtype=dtype)
 
-                # Load the range of patterns into memory
-                holder[counter:counter + p_num] = np.array(
-                    tmp_data_holder[data_ends_list[data_idx][0]:
-                                    data_ends_list[data_idx][1]])
+    read_list = get_batch_read_list(batch_dict=batch_dict)
+    if read_list and read_list[-1][4] + read_list[-1][3] - read_list[-1][2] != pattern_number:
+        raise Exception("The pattern number does not agree with the batch.")
 
-                # update the counter
-                counter += p_num
+    if thread_num is None:
+        thread_num = _h5_file_pool.read_thread_num
+
+    if thread_num <= 1 or len(read_list) <= 1:
+        for file_name, data_name, start, end, position in read_list:
+            _read_masked_pattern_range(file_name, data_name, start, end, holder, position, crop, crop_mask_1d,
+                                       chunk_pattern_num, stat_holder)
+    else:
+        with ThreadPoolExecutor(max_workers=min(thread_num, len(read_list))) as executor:
+            futures = [executor.submit(_read_masked_pattern_range, file_name, data_name, start, end, holder,
+                                       position, crop, crop_mask_1d, chunk_pattern_num, stat_holder)
+                       for file_name, data_name, start, end, position in read_list]
+            for future in futures:
+                future.result()
 
     return holder
 
 
+##################################################################
+#
+#       Pattern statistics
+#
+##################################################################
+
+def get_pattern_stat_file(source_list_file):
+    """
+    Get the file to keep the mean and std of each pattern in. It is next to the index of the h5 files.
+
+    :param source_list_file: The txt file containing the list of all data files.
+    :return: The address of the h5 file.
+    """
+    return source_list_file + ".stat.h5"
+
+
+def get_pattern_stat_signature(source_dict, mask):
+    """
+    Get the signature of the mean and std of the patterns. The saved values are only used if the
+    signature is the same, i.e. the same datasets in the same unchanged files with the same mask.
+
+    :param source_dict: The source_dict in data_source object
+    :param mask: The numpy mask.
+    :return: A string describing the patterns.
+    """
+    files = []
+    for address in source_dict["Files"]:
+        stat = os.stat(address)
+        files.append([address, stat.st_mtime_ns, stat.st_size, list(source_dict[address]["Datasets"]),
+                      [int(x) for x in source_dict[address]["data_num"]]])
+
+    mask_hash = hashlib.sha1(np.packbits(get_bool_mask_1d(mask=mask)).tobytes()).hexdigest()
+    return json.dumps({"files": files, "mask": mask_hash})
+
+
+def save_pattern_stat(stat_file, means, std, mask, signature):
+    """
+    Save the mean and std of each pattern so that the later stages and the notebooks do not have to read
+    the patterns again. The datasets have the same names as in the partial correlation matrix file.
+
+    :param stat_file: The address of the h5 file from get_pattern_stat_file.
+    :param means: The mean value of each pattern.
+    :param std: The standard deviation of each pattern.
+    :param mask: The numpy mask.
+    :param signature: The signature from get_pattern_stat_signature.
+    :return: None
+    """
+    tmp_file = stat_file + ".{}.tmp".format(os.getpid())
+    with h5py.File(tmp_file, 'w') as h5file:
+        h5file.create_dataset("means", data=means)
+        h5file.create_dataset("std", data=std)
+        h5file.create_dataset("mask", data=mask)
+        h5file.create_dataset("signature", data=signature)
+    os.replace(tmp_file, stat_file)
+
+
+def load_pattern_stat(stat_file, signature):
+    """
+    Load the mean and std of each pattern saved by save_pattern_stat.
+
+    :param stat_file: The address of the h5 file from get_pattern_stat_file.
+    :param signature: The signature from get_pattern_stat_signature.
+    :return: means, std. None if there is no file with the same signature.
+    """
+    if not os.path.exists(stat_file):
+        return None
+
+    with h5py.File(stat_file, 'r') as h5file:
+        saved_signature = h5file["signature"][()]
+        if isinstance(saved_signature, bytes):
+            saved_signature = saved_signature.decode()
+        if saved_signature != signature:
+            return None
+        return np.array(h5file["means"]), np.array(h5file["std"])
+
+
 ##################################################################
 #
 #       Get Bool mask
@@ -759,7 +1973,64 @@ def get_bool_mask_1d(mask):
 #
 ##################################################################
 
-def find_tau(mat_data, target_value=0.5, log_eps_min=-10.0, log_eps_max=10.0, search_num=20):
+def split_smallest_distances(mat_data, exact_number=8192):
+    """
+    Split the distance data into the smallest distances and the rest. For a small tau, the density is
+    dominated by the smallest distances. Therefore, they are kept exactly rather than in the histogram.
+
+    :param mat_data: The distance data.
+    :param exact_number: The number of the smallest distances to keep exactly.
+    :return: The smallest distances and the rest of the distances.
+    """
+    if mat_data.size <= exact_number:
+        return np.array(mat_data, dtype=np.float64), np.zeros(0, dtype=np.float64)
+
+    partitioned = np.partition(mat_data, exact_number)
+    return partitioned[:exact_number].astype(np.float64), partitioned[exact_number:]
+
+
+def get_distance_bin_edges(samples, value_range, bin_num=4096):
+    """
+    Get the bin edges of the histogram of the distances. The edges are the union of bin_num uniform bins
+    and bin_num bins with the same number of samples in each, so that the bins are narrow both where
+    the distances are dense and where they are sparse.
+
+    :param samples: A sample of the distance data to get the quantiles from.
+    :param value_range: The (min, max) of the distance data.
+    :param bin_num: The number of the uniform bins and of the quantile bins.
+    :return: The sorted bin edges.
+    """
+    edges = np.linspace(value_range[0], value_range[1], num=bin_num + 1)
+    if samples.size > 0:
+        quantiles = np.quantile(samples, np.linspace(0., 1., num=bin_num + 1))
+        edges = np.unique(np.concatenate([edges, np.clip(quantiles, value_range[0], value_range[1])]))
+    return edges
+
+
+def get_distance_histogram(mat_data, edges, chunk_size=2 ** 24):
+    """
+    Get the number of distances and the sum of the distances in each bin. The histograms of different
+    processes with the same edges can simply be added together.
+
+    :param mat_data: The distance data.
+    :param edges: The bin edges from get_distance_bin_edges.
+    :param chunk_size: The number of distances to process at once to limit the memory usage.
+    :return: The number of distances in each bin and the sum of the distances in each bin.
+    """
+    bin_num = edges.shape[0] - 1
+    counts = np.zeros(bin_num, dtype=np.float64)
+    sums = np.zeros(bin_num, dtype=np.float64)
+    for start in range(0, mat_data.shape[0], chunk_size):
+        chunk = mat_data[start:start + chunk_size]
+        # The last bin includes the right edge.
+        bin_idx = np.clip(np.searchsorted(edges, chunk, side='right') - 1, 0, bin_num - 1)
+        counts += np.bincount(bin_idx, minlength=bin_num)
+        sums += np.bincount(bin_idx, weights=chunk, minlength=bin_num)
+    return counts, sums
+
+
+def find_tau(mat_data, target_value=0.5, log_eps_min=-10.0, log_eps_max=10.0, search_num=20,
+             exact_number=8192, bin_num=4096, sample_number=100000):
     """
     Search through the space to find the optimal tau to calculate the diffusion map.
 
@@ -768,17 +2039,100 @@ def find_tau(mat_data, target_value=0.5, log_eps_min=-10.0, log_eps_max=10.0, se
     :param log_eps_min:
     :param log_eps_max:
     :param search_num:
+    :param exact_number: The number of the smallest distances to keep exactly.
+    :param bin_num: The number of the uniform bins and of the quantile bins of the other distances.
+    :param sample_number: The number of distances to get the quantiles from.
+    :return:
+    """
+    smallest, rest = split_smallest_distances(mat_data=mat_data, exact_number=exact_number)
+
+    if rest.size > 0:
+        edges = get_distance_bin_edges(samples=rest[::max(1, rest.size // sample_number)],
+                                       value_range=(np.min(rest), np.max(rest)),
+                                       bin_num=bin_num)
+        counts, sums = get_distance_histogram(mat_data=rest, edges=edges)
+    else:
+        counts, sums = np.zeros(0), np.zeros(0)
+
+    return find_tau_from_histogram(counts=counts, sums=sums, smallest=smallest, target_value=target_value,
+                                   log_eps_min=log_eps_min, log_eps_max=log_eps_max, search_num=search_num)
+
+
+def find_tau_parallel(comm, mat_data, target_value=0.5, log_eps_min=-10.0, log_eps_max=10.0, search_num=20,
+                      exact_number=8192, bin_num=4096, sample_number=100000):
+    """
+    The same as find_tau while the distance data are distributed among the processes. Only the smallest
+    distances, a sample of the distances and the histogram are communicated. This has to be called by
+    all the processes in comm.
+
+    :param comm: The MPI communicator.
+    :param mat_data: The distance data of this process.
+    :param target_value: The
+    :param log_eps_min:
+    :param log_eps_max:
+    :param search_num:
+    :param exact_number: The number of the smallest distances of each process to keep exactly.
+    :param bin_num: The number of the uniform bins and of the quantile bins of the other distances.
+    :param sample_number: The number of distances to get the quantiles from.
+    :return: The same tau on all the processes.
+    """
+    smallest, rest = split_smallest_distances(mat_data=mat_data, exact_number=exact_number)
+    smallest = np.concatenate(comm.allgather(smallest))
+
+    # All the processes use the same edges.
+    rest_num = comm.allgather(rest.size)
+    local_sample_number = int(np.ceil(sample_number * rest.size / max(1, sum(rest_num))))
+    samples = np.concatenate(comm.allgather(rest[::max(1, rest.size // max(1, local_sample_number))]))
+    value_min = min(comm.allgather(np.min(rest) if rest.size > 0 else np.inf))
+    value_max = max(comm.allgather(np.max(rest) if rest.size > 0 else -np.inf))
+
+    if samples.size > 0:
+        edges = get_distance_bin_edges(samples=samples, value_range=(value_min, value_max), bin_num=bin_num)
+        counts, sums = get_distance_histogram(mat_data=rest, edges=edges)
+        counts = comm.allreduce(counts)
+        sums = comm.allreduce(sums)
+    else:
+        counts, sums = np.zeros(0), np.zeros(0)
+
+    if comm.Get_rank() == 0:
+        tau = find_tau_from_histogram(counts=counts, sums=sums, smallest=smallest, target_value=target_value,
+                                      log_eps_min=log_eps_min, log_eps_max=log_eps_max, search_num=search_num)
+    else:
+        tau = None
+    return comm.bcast(tau, root=0)
+
+
+def find_tau_from_histogram(counts, sums, smallest, target_value=0.5, log_eps_min=-10.0, log_eps_max=10.0,
+                            search_num=20):
+    """
+    Search through the space to find the optimal tau to calculate the diffusion map.
+    The density curve is evaluated for all the tau at once from the smallest distances and the histogram
+    of the other distances. The distances in each bin are replaced by their mean value.
+
+    :param counts: The number of distances in each bin from get_distance_histogram.
+    :param sums: The sum of the distances in each bin from get_distance_histogram.
+    :param smallest: The smallest distances from split_smallest_distances.
+    :param target_value: The
+    :param log_eps_min:
+    :param log_eps_max:
+    :param search_num:
     :return:
     """
     log_eps = np.linspace(log_eps_min, log_eps_max, num=search_num)
     eps = np.exp(log_eps)
     log_sample_distance = log_eps[1] - log_eps[0]
 
+    # The smallest distances and the mean distance in each non-empty bin with their multiplicity
+    not_empty = counts > 0
+    distances = np.concatenate([smallest, sums[not_empty] / counts[not_empty]])
+    log_counts = np.concatenate([np.zeros(smallest.shape[0]), np.log(counts[not_empty])])
+
     # This variable contains the constructed global density function
-    density = np.zeros(search_num)
-    for i, e in enumerate(eps):
-        kernel = np.exp(-mat_data / e)  # kernel
-        density[i] = np.log(np.sum(kernel) + 1e-10)
+    # log(sum(exp(-x / e)) + 1e-10) is evaluated in the log space to avoid the overflow.
+    exponents = log_counts[np.newaxis, :] - distances[np.newaxis, :] / eps[:, np.newaxis]
+    exponent_max = np.max(exponents, axis=1)
+    log_kernel_sum = exponent_max + np.log(np.sum(np.exp(exponents - exponent_max[:, np.newaxis]), axis=1))
+    density = np.logaddexp(log_kernel_sum, np.log(1e-10))
 
     # Normalize the curve
     normlized_density = density - np.min(density)  # min is 0
@@ -852,39 +2206,30 @@ def assemble_laplacian_matrix(laplacian_type, correlation_matrix_file, neighbor_
 
     with h5py.File(correlation_matrix_file, 'r') as h5file:
         values = np.array(h5file['values'])[:, :neighbor_number]
-        idx_dim0 = np.array(h5file['index_dim0'])[:, :neighbor_number]
+        idx_dim0 = get_index_dim0(h5file=h5file, neighbor_number=neighbor_number)
         idx_dim1 = np.array(h5file['index_dim1'])[:, :neighbor_number]
         matrix_shape = np.array(h5file['matrix_shape'])
 
-    site_number = np.prod(values.shape)
-    values = values.reshape(site_number)
-    idx_dim0 = idx_dim0.reshape(site_number)
-    idx_dim1 = idx_dim1.reshape(site_number)
-
     # Cast the values to positive
+    values = values.astype(np.float64)
     np.exp(values / tau, out=values)
 
-    # Construct a sparse weight matrix
-    matrix = scipy.sparse.coo_matrix((values, (idx_dim0, idx_dim1)),
-                                     shape=tuple(matrix_shape))
-
     # Convert the weight matrix in to a Laplacian matrix
     if laplacian_type == "symmetric normalized laplacian":
         # Cast the weight matrix to a symmetric format.
-        matrix_trans = matrix.transpose(copy=True)
-        matrix_sym = (matrix + matrix_trans) / 2.
-        matrix_asym = (matrix - matrix_trans) / 2.
-        np.absolute(matrix_asym.data, out=matrix_asym.data)
-        matrix_sym += matrix_asym
-        # Remove the diagonal term
-        if not keep_diagonal:
-            matrix_sym.setdiag(values=0, k=0)
-        # Calculate the degree matrix for normalization
-        degree = Graph.inverse_sqrt_degree_mat(weight_matrix=matrix_sym)
+        matrix_sym = get_symmetric_distance_csr(values=values,
+                                                index_dim1=idx_dim1.astype(np.int64),
+                                                rows_trans=idx_dim1.reshape(-1),
+                                                cols_trans=idx_dim0.reshape(-1),
+                                                values_trans=values.reshape(-1),
+                                                row_range=(0, int(matrix_shape[0])),
+                                                column_num=int(matrix_shape[1]),
+                                                keep_diagonal=keep_diagonal)
+        # Calculate the degree for normalization
+        degree = np.asarray(matrix_sym.sum(axis=1)).reshape(-1)
         # Calculate the laplacian matrix
-        csr_matrix = Graph.get_symmetric_normalized_laplacian(degree_matrix=degree,
-                                                              weight_matrix=matrix_sym)
-        csr_matrix.tocsr()
+        csr_matrix = get_laplacian_csr(weight_matrix=matrix_sym, row_start=0,
+                                       inv_sqrt_degree=1. / np.sqrt(degree))
     else:
         raise Exception(
             "Currently, the only available Laplacian matrix " +
@@ -913,16 +2258,10 @@ def get_laplacian_matrix(laplacian_type, correlation_matrix_file, neighbor_numbe
                                                     neighbor_number=neighbor_number,
                                                     symmetric=True,
                                                     keep_diagonal=keep_diagonal)
-        # Add the exponential function
-        np.exp(- matrix.data / tau, out=matrix.data)
-
-        # Get the degree matrix
-        degree = Graph.inverse_sqrt_degree_mat(weight_matrix=matrix)
-
-        # Calculate the laplacian matrix
-        csr_matrix = Graph.get_symmetric_normalized_laplacian(degree_matrix=degree,
-                                                              weight_matrix=matrix)
-        csr_matrix.tocsr()
+        # Add the exponential function and calculate the laplacian matrix
+        csr_matrix = convert_to_laplacian_matrix(laplacian_type=laplacian_type,
+                                                 distance_matrix=matrix,
+                                                 tau=tau)
 
     else:
         raise Exception(
@@ -189,7 +189,9 @@ def construct_dataframe(dim0, dim1, eigensystem, correlation_matrix, attribute,
     :param dim1: The index of the eigenvector to be used as the y-coordinate
     :param eigensystem: The h5file containing the eigensystem to be visualized.
     :param correlation_matrix: The address to the h5file containing the
-                                correlation matrix.
+                                correlation matrix, or the file from
+                                util.get_pattern_stat_file containing the
+                                mean and std of each pattern.
     :param attribute: The address to the numpy file containing the interesting
                         attribute
     :param category: The address to the numpy file containing the
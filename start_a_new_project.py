@@ -64,9 +64,21 @@ for l in range(1000):
     # Copy the WeightMat.py file
     shutil.copyfile(src='./asset/WeightMat.py', dst=project_dir + '/src/WeightMat.py')
 
+    # Copy the WeightMatApprox.py file
+    shutil.copyfile(src='./asset/WeightMatApprox.py', dst=project_dir + '/src/WeightMatApprox.py')
+
+    # Copy the WeightMatIncremental.py file
+    shutil.copyfile(src='./asset/WeightMatIncremental.py', dst=project_dir + '/src/WeightMatIncremental.py')
+
     # Copy the EigensSlepc.py file
     shutil.copyfile(src='./asset/EigensSlepc.py', dst=project_dir + '/src/EigensSlepc.py')
 
+    # Copy the EigensScipy.py file
+    shutil.copyfile(src='./asset/EigensScipy.py', dst=project_dir + '/src/EigensScipy.py')
+
+    # Copy the EigensSweep.py file
+    shutil.copyfile(src='./asset/EigensSweep.py', dst=project_dir + '/src/EigensSweep.py')
+
     # Copy the Manifold_Browser1.ipynb file
     shutil.copyfile(src='./asset/Manifold_Browser1.ipynb', dst=project_dir + '/src/Manifold_Browser1.ipynb')
 